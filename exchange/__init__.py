@@ -1 +1,7 @@
-from .api import Email, Mail
\ No newline at end of file
+def __getattr__(name):
+    # the api is only loaded once used, e.g. not by mail_export --help
+    if name in ("Email", "Mail"):
+        from . import api
+
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,155 @@
+"""Senders and recipients of stored e-mails as normalized addresses"""
+import re
+from email.utils import parseaddr
+from typing import Iterable
+
+from peewee import JOIN, Case, chunked, fn
+from rich.progress import track
+
+from .models import SQLITE_MAX_VARIABLES, Address, Mail, Recipient
+
+ROLES = ("from", "to", "cc")
+# columns holding the addresses of each role
+ROLE_FIELDS = {"from": "sender", "to": "to", "cc": "cc"}
+NAME_ADDRESS = re.compile(r"\s*,?\s*([^<>]*?)\s*<([^<>]*)>")
+ADDRESS_FILTER = re.compile(r'\b(from|to|cc):("[^"]*"|\S+)', re.IGNORECASE)
+
+
+def parse_addresses(text: str) -> list:
+    """Split addresses as stored, e.g. "name <addr>,name <addr>", into
+    (address, name) pairs
+
+    Values without any <addr> are display names or bare addresses separated
+    by comma or semicolon, as display_cc stored by older downloads.
+
+    :param text: Sender, to or cc of an e-mail
+    :return: List of lower case address, or name if no address, and name
+    """
+    if not text or text == "None":
+        return []
+    if "<" in text:
+        pairs = [(addr, name) for name, addr in NAME_ADDRESS.findall(text)]
+    else:
+        parts = [part.strip() for part in re.split(r"[;,]", text)]
+        pairs = [parseaddr(p)[::-1] if "@" in p else ("", p) for p in parts]
+    parsed = []
+    for addr, name in pairs:
+        addr, name = addr.strip(), name.strip().strip('"')
+        if name == "None":
+            name = ""
+        if "@" not in addr:
+            # a display name only
+            addr, name = name or addr, name or addr
+        if addr:
+            parsed.append((addr.lower(), name or None))
+    return parsed
+
+
+def store_recipients(records: Iterable[dict]) -> int:
+    """Store senders and recipients of records, within the caller's transaction
+
+    :param records: Mail records as dicts including id
+    :return: Number of recipients stored
+    """
+    rows, names = [], {}
+    for r in records:
+        for role in ROLES:
+            for address, name in parse_addresses(r[ROLE_FIELDS[role]]):
+                names.setdefault(address, name)
+                rows.append((r["id"], address, role))
+    if not rows:
+        return 0
+    fields = [Address.address, Address.name]
+    for batch in chunked(names.items(), SQLITE_MAX_VARIABLES // 2):
+        Address.insert_many(batch, fields=fields).on_conflict_ignore().execute()
+    ids = {}
+    for batch in chunked(list(names), SQLITE_MAX_VARIABLES):
+        query = Address.select(Address.id, Address.address)
+        ids.update({a.address: a.id for a in query.where(Address.address.in_(batch))})
+    recipients = {(mail, ids[address], role) for mail, address, role in rows}
+    for batch in chunked(recipients, SQLITE_MAX_VARIABLES // 3):
+        Recipient.insert_many(
+            batch, fields=[Recipient.mail, Recipient.address, Recipient.role]
+        ).on_conflict_ignore().execute()
+    return len(recipients)
+
+
+def backfill_recipients(db, batch_size: int = 1000) -> int:
+    """Store senders and recipients of all stored e-mails
+
+    :param db: Database
+    :param batch_size: Number of e-mails per transaction
+    :return: Number of e-mails processed
+    """
+    total = Mail.select().count()
+    last_id, done = 0, 0
+    for _ in track(range(0, total, batch_size), description="Parsing addresses"):
+        batch = list(
+            Mail.select(Mail.id, Mail.sender, Mail.to, Mail.cc)
+            .where(Mail.id > last_id)
+            .order_by(Mail.id)
+            .limit(batch_size)
+            .dicts()
+        )
+        if not batch:
+            break
+        last_id = batch[-1]["id"]
+        with db.atomic():
+            store_recipients(batch)
+        done += len(batch)
+    return done
+
+
+def split_address_filters(keyword: str) -> tuple:
+    """Separate from:, to: and cc: terms from the rest of a keyword filter
+
+    :param keyword: Keyword filter as entered by user
+    :return: List of (role, value) and the remaining keywords
+    """
+    keyword = keyword or ""
+    terms = [(r.lower(), v.strip('"')) for r, v in ADDRESS_FILTER.findall(keyword)]
+    rest = " ".join(ADDRESS_FILTER.sub(" ", keyword).split())
+    return terms, rest
+
+
+def address_match(value: str):
+    """Expression matching addresses, exactly if value is an e-mail address"""
+    value = value.lower()
+    if "@" in value and not value.startswith("@"):
+        return Address.address == value
+    return Address.address.contains(value) | Address.name.contains(value)
+
+
+def with_address(role: str, value: str):
+    """Expression matching e-mails having an address in role, using the
+    (address, role, mail) index"""
+    mails = (
+        Recipient.select(Recipient.mail)
+        .join(Address)
+        .where((Recipient.role == role) & address_match(value))
+    )
+    return Mail.id.in_(mails)
+
+
+def top_correspondents(limit: int = 20, folder: str = None) -> list:
+    """Return addresses with most e-mails, counted by role
+
+    :param limit: Number of addresses
+    :param folder: Only count e-mails of folder
+    :return: Dicts of address, name, from, to, cc and total
+    """
+    counts = [
+        fn.SUM(Case(None, [(Recipient.role == role, 1)], 0)).alias(role)
+        for role in ROLES
+    ]
+    total = fn.COUNT(Recipient.id)
+    query = (
+        Address.select(Address.address, Address.name, *counts, total.alias("total"))
+        .join(Recipient, JOIN.INNER)
+        .group_by(Address.id)
+        .order_by(total.desc(), Address.address)
+        .limit(limit)
+    )
+    if folder:
+        query = query.switch(Recipient).join(Mail).where(Mail.folder == folder)
+    return list(query.dicts())
@@ -1,37 +1,131 @@
-import time
-from exchangelib import Credentials, Account, Configuration, DELEGATE
 from peewee import *
 from collections import namedtuple as nt
 import datetime
 from rich.console import Console
 from rich.table import Table
-from rich.progress import track
+from rich.progress import Progress
 from rich import print
 from richlog import log
-import re
-from pathlib import Path
 from bullet import ScrollBar
-from lxml_html_clean import clean_html
-from markdownify import markdownify as md
+import itertools
 import operator
-from functools import reduce
-from typing import Annotated, NamedTuple
+from functools import lru_cache, partial, reduce
+from typing import Annotated, Iterable, Iterator, NamedTuple, Optional
+from .attachments import AttachmentFetcher
+from .addresses import (
+    split_address_filters,
+    store_recipients,
+    top_correspondents,
+    with_address,
+)
+from .models import (
+    Address,
+    Attachment,
+    Blob,
+    Checkpoint,
+    FailedItem,
+    FolderStats,
+    Mail,
+    MailIndex,
+    Partition,
+    PartitionStats,
+    Recipient,
+    SyncState,
+    database_proxy,
+)
+from .search import fts_query, index_records, rebuild_index
+from .stats import create_triggers, folder_counts, summary
+from .writer import SQLITE_MAX_VARIABLES, MailWriter
+from .download import FolderDownloader, item_ids, iter_items
+from .columnar import COLUMNAR_FORMATS, export_columnar
+from .export import export_archive, export_html
+from .metrics import Metrics
+from .migrations import migrate_database
+from .partitions import MergedRecords, Partitions
+from .purge import Purger
 
 ISO_FORMAT = "%Y-%m-%d %H:%M:%S"
-database_proxy = DatabaseProxy()
+PAGE_SIZE = 100
+NEXT_PAGE, PREVIOUS_PAGE = "Next page >>", "<< Previous page"
+# columns listed when browsing, bodies are only loaded by show_record
+LIST_COLUMNS = (Mail.id, Mail.datetime, Mail.folder, Mail.subject, Mail.sender)
+# only properties read by extract_email_items are requested from Exchange
+EWS_FIELDS = (
+    "datetime_received",
+    "sender",
+    "to_recipients",
+    "cc_recipients",
+    "display_cc",
+    "subject",
+    "body",
+    "message_id",
+)
+# fields extracted from e-mails, display_cc only goes into the digest
+FIELDS = (
+    "datetime",
+    "sender",
+    "to",
+    "cc",
+    "subject",
+    "body",
+    "message_id",
+    "display_cc",
+)
 
 
-class Mail(Model):
-    datetime = DateTimeField()
-    to = TextField()
-    sender = TextField()
-    cc = TextField(null=True)
-    subject = TextField(null=True)
-    body = TextField(null=True)
-    folder = TextField(null=True)
+def ranked(keyword: str, fts: bool = True) -> bool:
+    """Whether a keyword filter searches the full-text index, ordering e-mails
+    by relevance"""
+    return bool(fts and fts_query(split_address_filters(keyword)[1]))
 
-    class Meta:
-        database = database_proxy
+
+def build_filter_query(keyword: str, date_range, folder: str, fts: bool = True):
+    """Build query of e-mails matching keyword, date range and folder
+
+    :param keyword: Keywords, including from:, to: and cc: terms
+    :param date_range: From and to date, either may be empty
+    :param folder: Folder, all if not given
+    :param fts: Search bodies through the full-text index
+    :return: Query of records
+    """
+    address_terms, search_word = split_address_filters(keyword)
+    from_to_date = date_range
+    if not any([folder, search_word, address_terms, any(from_to_date)]):
+        return Mail.select()
+
+    and_items = [with_address(role, value) for role, value in address_terms]
+    query = Mail.select()
+
+    if ranked(keyword, fts):
+        query = query.join(MailIndex, on=(MailIndex.rowid == Mail.id))
+        and_items.append(MailIndex.match(fts_query(search_word)))
+        query = query.order_by(MailIndex.rank())
+    elif search_word:
+        # bodies are compressed and only searchable through the index
+        s = search_word.lower()
+        or_items = [
+            (Mail.to.contains(s)),
+            (Mail.sender.contains(s)),
+            (Mail.subject.contains(s)),
+        ]
+        item_expression = reduce(operator.or_, or_items)
+        and_items.append(item_expression)
+
+    if any(from_to_date):
+        from_, to_ = from_to_date
+        date_expression = (Mail.datetime >= from_) & (Mail.datetime <= to_)
+        and_items.append(date_expression)
+
+    log.debug(f"filtering on folder {folder}")
+    if folder:
+        and_items.append((Mail.folder == folder))
+
+    if len(and_items) > 0:
+        expression = reduce(operator.and_, and_items)
+    else:
+        expression = and_items[0]
+
+    return query.where(expression)
 
 
 class Email:
@@ -46,12 +140,40 @@ class Email:
         archive_folders=None,
         download_now=None,
         purge_mail_older_than=None,
+        rebuild_index=None,
+        vacuum=False,
+        batch_size=100,
+        flush_interval=5.0,
+        wal=False,
+        workers=1,
+        split_size=500,
+        full_resync=False,
+        page_size=100,
+        export=None,
+        export_format="html",
+        export_batch_rows=10000,
+        export_partition=False,
+        render_cache_size=128,
+        attachments=False,
+        attachment_workers=4,
+        purge_batch_size=100,
+        purge_workers=2,
+        purge_dry_run=False,
+        purge_verify=False,
+        max_wait=3600,
+        retry_failed=False,
+        metrics_file=None,
+        metrics_interval=10.0,
+        partition=None,
+        partition_before=None,
+        partition_workers=4,
     ):
         self.filter_keyword = ""
         self.filter_range = None, None
         self.filter_folder = None
         self.filename = database
-        self.db = SqliteDatabase(self.filename)
+        # wait for writers of other processes sharing the database
+        self.db = SqliteDatabase(self.filename, timeout=60)
         database_proxy.initialize(self.db)
         self.email = email
         self.password = password
@@ -59,14 +181,76 @@ class Email:
         self.username = username
         self.archive_folders = archive_folders
         self.filtered_records = []
+        self.filter_query = Mail.select()
+        self.filter_count = 0
+        self.filter_key = None
         self.download_now = download_now
         self.purge_older_than = purge_mail_older_than
+        self.purge_batch_size = purge_batch_size
+        self.purge_workers = purge_workers
+        self.purge_dry_run = purge_dry_run
+        self.purge_verify = purge_verify
+        self.rebuild_index = rebuild_index
+        self.vacuum = vacuum
+        self.wal = wal
+        self.workers = workers
+        self.split_size = split_size
+        self.full_resync = full_resync
+        self.max_wait = max_wait
+        self.metrics = Metrics(metrics_interval, metrics_file)
+        self.progress = None
+        # background job of the menu running downloads and exports, see jobs.py
+        self.job = None
+        self.retry_failed = retry_failed
+        # since, until and start of the download in progress by folder
+        self.windows = {}
+        self.page_size = page_size
+        self.export = export
+        self.export_format = export_format
+        self.export_batch_rows = export_batch_rows
+        self.export_partition = export_partition
+        self.render_cache = lru_cache(maxsize=render_cache_size)(self.render_body)
+        self.attachments = attachments
+        self.attachment_fetcher = AttachmentFetcher(attachment_workers)
+        self.partition = partition
+        self.partition_before = partition_before
+        self.partitions = Partitions(self.db, self.filename, partition_workers)
 
+        migrate_database(self.db)
         self.db.create_tables(
             [
                 Mail,
+                SyncState,
+                Checkpoint,
+                FailedItem,
+                FolderStats,
+                Blob,
+                Attachment,
+                Address,
+                Recipient,
+                Partition,
+                PartitionStats,
             ]
         )
+        create_triggers(self.db)
+        self.fts = MailIndex.fts5_installed()
+        if self.fts:
+            # e-mails stored before the index existed would never match
+            indexed = "mailindex" in self.db.get_tables()
+            self.db.create_tables([MailIndex])
+            if not indexed and Mail.select().exists():
+                self.rebuild_search_index()
+        else:
+            log.warning("SQLite lacks FTS5, keyword filter will not search bodies")
+        self.writer = MailWriter(
+            self.db,
+            batch_size,
+            flush_interval,
+            index=self.fts,
+            account=self.email,
+            metrics=self.metrics,
+            partitions=self.partitions,
+        )
 
     @staticmethod
     def to_iso_dt(dt_string) -> datetime.datetime:
@@ -85,22 +269,43 @@ class Email:
         print("=" * 50)
         print(f"[bold]Database:[/bold] {self.filename}")
         print(f"[bold]E-mail account:[/bold] {self.email}")
-        print(f"[bold]Stored count:[/bold] {self.db_count}")
-        s, e = [_.strftime("%Y-%m-%d") for _ in self.db_date_range]
+        count, first, last = self.db_summary
+        print(f"[bold]Stored count:[/bold] {count}")
+        s, e = [_.strftime("%Y-%m-%d") for _ in (first, last)]
         print(f"[bold]Stored range:[/bold] {s} -> {e}")
+        folders = ", ".join(f"{f} ({c})" for f, c in self.db_folder_counts.items())
+        print(f"[bold]Stored folders:[/bold] {folders}")
         print(f"[bold]Filter folder:[/bold] {self.filter_folder}")
         print("[bold]Filter range:[/bold] {} <-> {}".format(*self.filter_range))
         print(f"[bold]Filter keyword:[/bold] {self.filter_keyword}")
-        print(f"[bold]Filter count:[/bold] {len(self.filtered_records)}")
+        print(f"[bold]Filter count:[/bold] {self.filter_count}")
         print("=" * 50)
 
+    @property
+    def db_summary(self) -> Annotated[tuple, "count, from and to range"]:
+        """Return count and from, to range of emails in DB from statistics,
+        including e-mails moved to partitions
+
+        :return: count, from, to tuple
+        """
+        count, first, last = summary()
+        moved, moved_first, moved_last = self.partitions.summary()
+        if moved:
+            count += moved
+            first = min(_ for _ in (first, moved_first) if _)
+            last = max(_ for _ in (last, moved_last) if _)
+        if not count:
+            _ = datetime.datetime.now()
+            return 0, _, _
+        return count, first, last
+
     @property
     def db_count(self) -> int:
         """Count DB records
 
         :return: count
         """
-        return Mail.select().count()
+        return self.db_summary[0]
 
     @property
     def db_date_range(self) -> Annotated[tuple, "from and to range"]:
@@ -108,39 +313,37 @@ class Email:
 
         :return: from, to tuple
         """
-        try:
-            return (
-                Mail.select().order_by(Mail.datetime).first().datetime,
-                Mail.select().order_by(Mail.datetime.desc()).first().datetime,
-            )
-        except AttributeError:
-            _ = datetime.datetime.now()
-            return _, _
+        return self.db_summary[1:]
+
+    @property
+    def db_folder_counts(self) -> Annotated[dict, "count by folder"]:
+        """Return number of emails by folder"""
+        counts = folder_counts()
+        for folder, count in self.partitions.folder_counts().items():
+            counts[folder] = counts.get(folder, 0) + count
+        return dict(sorted(counts.items(), key=lambda c: c[0] or ""))
 
     @property
     def db_get_folders(self) -> Annotated[tuple, "folder"]:
         """Return list of folders"""
-        return tuple(_.folder for _ in Mail.select(Mail.folder).group_by(Mail.folder))
+        return tuple(self.db_folder_counts)
 
     def process_mail(self) -> None:
         """Downloads all emails from account into database
 
+        Folders downloaded before only fetch e-mails received since, unless a
+        full resync is requested. An interrupted download resumes from its
+        checkpoint. With more than one worker folders are downloaded in
+        parallel without asking whether to abort on existing e-mails.
+
         :return: None
         """
-
-        if all((self.server_name, self.username, self.email)):
-            credentials = Credentials(username=self.username, password=self.password)
-            config = Configuration(server=self.server_name, credentials=credentials)
-            account = Account(
-                primary_smtp_address=self.email,
-                config=config,
-                autodiscover=False,
-                access_type=DELEGATE,
-            )
-        else:
-            credentials = Credentials(self.email, self.password)
-            account = Account(self.email, credentials=credentials, autodiscover=True)
-        fields = ("datetime", "sender", "to", "cc", "subject", "body")
+        # rates cover this download only, not time before or earlier downloads
+        self.metrics.reset()
+        account = self.connect()
+        fields = FIELDS
+        if self.attachments:
+            fields += ("attachments",)
 
         download_folders = {"Inbox": account.inbox, "Sent": account.sent}
 
@@ -150,89 +353,412 @@ class Email:
                     account.archive_msg_folder_root / folder
                 )
 
-        for folder, func in reversed(list(download_folders.items())):
-            count = func.total_count
-            log.info(f'processing folder "{folder}" with {count} items')
-            bail_out, passed = False, False
-            counter = 0
-            tot = func.total_count
-            # for item in track(func.all().order_by("-datetime_received"), total=tot):
-            mail_iterator = iter(func.all().order_by("-datetime_received"))
+        if self.wal:
+            self.db.pragma("journal_mode", "wal")
+            self.db.pragma("synchronous", "normal")
+
+        if self.purge_older_than:
+            self.purge_mail(account, download_folders)
+            return
+
+        if self.retry_failed:
+            self.retry_failed_items(account, fields)
+            return
+
+        try:
+            if self.workers > 1:
+                queries = {
+                    folder: self.window_query(folder, func)
+                    for folder, func in download_folders.items()
+                }
+                self.expect(sum(count or 0 for _, count in queries.values()))
+                FolderDownloader(
+                    partial(self.extract_email_items, fields),
+                    self.writer,
+                    self.workers,
+                    self.split_size,
+                    self.checkpoint,
+                    self.metrics,
+                    advance=self.step,
+                    quiet=self.background,
+                ).run(queries)
+                for folder in download_folders:
+                    self.mark_synced(folder)
+                return
+            for folder, func in reversed(list(download_folders.items())):
+                if not self.process_folder(folder, func, fields):
+                    return
+                self.mark_synced(folder)
+        finally:
+            self.writer.flush()
+            self.attachment_fetcher.close()
+            self.metrics.report(force=True)
+
+    def connect(self):
+        """Connect to Exchange account, waiting up to max_wait seconds when throttled
+
+        :return: Exchange account
+        """
+        from .ews import connect
+
+        return connect(
+            self.email, self.password, self.server_name, self.username, self.max_wait
+        )
+
+    def sync_since(self, folder) -> Optional[datetime.datetime]:
+        """Return newest e-mail received in folder at last completed download
+
+        :param folder: Name of folder
+        :return: Datetime or None if folder is to be fully downloaded
+        """
+        if self.full_resync:
+            return None
+        state = SyncState.get_or_none(
+            (SyncState.account == self.email) & (SyncState.folder == folder)
+        )
+        return state.last_received if state else None
+
+    def download_window(self, folder) -> Annotated[tuple, "since, until, started"]:
+        """Return range of e-mails to download, resuming an interrupted download
+
+        :param folder: Name of folder
+        :return: since, until (None unless resuming) and start of download
+        """
+        point = None if self.full_resync else self.get_checkpoint(folder)
+        if point:
+            log.info(f'resuming folder "{folder}" from {point.until}')
+            window = point.since, point.until, point.started
+        else:
+            window = self.sync_since(folder), None, datetime.datetime.utcnow()
+        self.windows[folder] = window
+        return window
+
+    def get_checkpoint(self, folder) -> Optional[Checkpoint]:
+        """Return checkpoint of an interrupted download of folder"""
+        return Checkpoint.get_or_none(
+            (Checkpoint.account == self.email) & (Checkpoint.folder == folder)
+        )
+
+    def checkpoint(self, folder, until) -> None:
+        """Record all e-mails of folder received since until are handed to writer
+
+        :param folder: Name of folder
+        :param until: Oldest e-mail stored so far
+        """
+        since, _, started = self.windows[folder]
+        self.writer.checkpoint(folder, since=since, until=until, started=started)
+
+    def clear_checkpoint(self, folder) -> None:
+        """Drop checkpoint of folder once its download is finished"""
+        self.writer.flush()
+        Checkpoint.delete().where(
+            (Checkpoint.account == self.email) & (Checkpoint.folder == folder)
+        ).execute()
+
+    def mark_synced(self, folder) -> None:
+        """Persist newest stored e-mail of a completely downloaded folder
+
+        After a resumed download e-mails received since the download started
+        may be missing, so the next download starts no later than that.
+
+        :param folder: Name of folder
+        """
+        self.writer.flush()
+        # other accounts sharing the database may have newer e-mails in folder
+        newest = (
+            Mail.select(fn.MAX(Mail.datetime))
+            .where((Mail.folder == folder) & (Mail.account == self.email))
+            .scalar()
+        )
+        point = self.get_checkpoint(folder)
+        if point and newest is not None:
+            newest = min(newest, point.started)
+        with self.db.atomic():
+            self.clear_checkpoint(folder)
+            if newest is None:
+                return
+            SyncState.replace(
+                account=self.email,
+                folder=folder,
+                last_received=newest,
+                synced=datetime.datetime.now(),
+            ).execute()
+        log.info(f'folder "{folder}" synced up to {newest}')
+
+    def folder_query(
+        self, func, since=None, until=None
+    ) -> Annotated[tuple, "query and count"]:
+        """Query e-mails of folder newest first, optionally only those since
+
+        :param func: Exchange folder
+        :param since: Only include e-mails received at or after (UTC)
+        :param until: Only include e-mails received at or before (UTC)
+        :return: query, number of e-mails
+        """
+        from .ews import ews_datetime
+
+        bounds = {
+            lookup: ews_datetime(value)
+            for lookup, value in (
+                ("datetime_received__gte", since),
+                ("datetime_received__lte", until),
+            )
+            if value is not None
+        }
+        if not bounds:
+            query, count = func.all(), func.total_count
+        else:
+            query = func.filter(**bounds)
+            count = query.count()
+        only = EWS_FIELDS + (("attachments",) if self.attachments else ())
+        query = query.only(*only).order_by("-datetime_received")
+        query.page_size = self.page_size
+        return query, count
+
+    def window_query(self, folder, func) -> Annotated[tuple, "query and count"]:
+        """Query e-mails of folder within its download window
+
+        E-mails received after the download started are left to the next
+        download, so e-mails arriving meanwhile do not shift the slices of the
+        query past the e-mails counted.
+
+        :param folder: Name of folder
+        :param func: Exchange folder
+        :return: query, number of e-mails
+        """
+        since, until, started = self.download_window(folder)
+        return self.folder_query(func, since, until or started)
+
+    def process_folder(self, folder, func, fields) -> bool:
+        """Downloads all emails within one folder
+
+        :param folder: Name of folder
+        :param func: Exchange folder
+        :param fields: Fields to extract from each e-mail
+        :return: False if user chose to abort
+        """
+        query, tot = self.window_query(folder, func)
+        since, until, _ = self.windows[folder]
+        log.info(f'processing folder "{folder}" with {tot} items')
+        self.expect(tot or 0)
+        # no need to ask about existing e-mails when only fetching new ones
+        bail_out, passed = False, since is not None or until is not None
+
+        def failed(position, e):
+            self.writer.fail(folder, *item_ids(query, position), repr(e))
+
+        items = self.metrics.timed_iter("fetch", iter_items(query, 0, tot, failed))
+        with Progress(disable=self.background) as self.progress:
+            bar = self.progress.add_task(folder, total=tot)
             try:
-                while True:
-                    try:
-                        item = next(mail_iterator)
-                    except KeyError as e:
-                        log.warning(f"error parsing email: {e}")
-                        time.sleep(10)
-                        continue
-                    counter += 1
-                    log.info(f"processing {counter}/{tot} in folder {folder}")
+                for item in items:
+                    self.step()
+                    rate = f"{folder} {self.metrics.rate:.0f}/s"
+                    self.progress.update(bar, advance=1, description=rate)
                     if bail_out:
-                        return
+                        self.clear_checkpoint(folder)
+                        return False
                     try:
-                        mail_fields = self.extract_email_items(fields, item)
-                    except TypeError:
-                        log.warn(f"Unable to process email, skipping: {item}")
-                        continue
-                    except AttributeError as e:
-                        log.warn(f"{e.args} - skipping")
-                        continue
-                    if self.purge_older_than:
-                        log.info(f"purging {counter}/{tot}")
-                        if mail_fields.datetime <= (
-                            datetime.datetime.now()
-                            - datetime.timedelta(days=self.purge_older_than)
-                        ):
-                            self.purge_email_from_server(item, mail_fields, folder)
-                        else:
-                            log.info(f"skipping item {counter}, not within range")
-                    else:
-                        bail_out, passed = self.store_mail_to_db(
-                            mail_fields, folder, passed, bail_out
+                        with self.metrics.time("extract"):
+                            mail_fields = self.extract_email_items(fields, item)
+                    except (TypeError, AttributeError) as e:
+                        log.warning(f"Unable to process email, skipping: {e!r}")
+                        self.writer.fail(
+                            folder,
+                            getattr(item, "id", None),
+                            getattr(item, "changekey", None),
+                            repr(e),
                         )
-            except StopIteration:
-                log.info("completed!!!")
+                        continue
+                    bail_out, passed = self.store_mail_to_db(
+                        mail_fields, folder, passed, bail_out
+                    )
+                    self.checkpoint(folder, mail_fields.datetime)
+            finally:
+                self.progress = None
+        log.info(f'completed folder "{folder}"')
+        return True
 
-    @staticmethod
-    def purge_email_from_server(item, mail_fields, folder):
-        log.info(
-            f"purging mail in {folder} [{mail_fields.datetime}] {mail_fields.subject}"
+    def purge_mail(self, account, folders: dict) -> int:
+        """Remove emails older than purge_older_than days from server
+
+        :param account: Exchange account
+        :param folders: Exchange folders by name
+        :return: Number of emails removed
+        """
+        from .ews import ews_now
+
+        cutoff = ews_now() - datetime.timedelta(
+            days=self.purge_older_than
         )
-        try:
-            item.delete()
-        except Exception as e:
-            log.warning(f"failed removing due to {e.args}")
+        purger = Purger(
+            account,
+            self.purge_batch_size,
+            self.purge_workers,
+            self.purge_dry_run,
+            self.purge_verify,
+            self.partitions,
+            self.email,
+        )
+        deleted = 0
+        for folder, func in folders.items():
+            log.info(f'purging e-mails in "{folder}" received before {cutoff}')
+            query = func.filter(datetime_received__lt=cutoff)
+            query.page_size = self.page_size
+            deleted += purger.purge(folder, query)[1]
+        log.info(f"purged {deleted} e-mails")
+        return deleted
+
+    def retry_failed_items(self, account, fields) -> int:
+        """Download again e-mails which failed before, fetched by id
+
+        :param account: Exchange account
+        :param fields: Fields to extract from each e-mail
+        :return: Number of e-mails recovered
+        """
+        failed = list(
+            FailedItem.select().where(
+                (FailedItem.account == self.email) & FailedItem.item_id.is_null(False)
+            )
+        )
+        log.info(f"retrying {len(failed)} failed e-mails")
+        only = EWS_FIELDS + (("attachments",) if self.attachments else ())
+        recovered = []
+        for batch in chunked(failed, self.page_size):
+            ids = [(f.item_id, f.changekey) for f in batch]
+            for failure, item in zip(batch, account.fetch(ids, only_fields=only)):
+                try:
+                    if isinstance(item, Exception):
+                        raise item
+                    mail_fields = self.extract_email_items(fields, item)
+                    self.writer.add(mail_fields, failure.folder)
+                except Exception as e:
+                    log.warning(f"e-mail {failure.item_id} failed again: {e!r}")
+                    FailedItem.update(
+                        attempts=FailedItem.attempts + 1,
+                        error=repr(e),
+                        failed=datetime.datetime.now(),
+                    ).where(FailedItem.id == failure.id).execute()
+                else:
+                    recovered.append(failure.id)
+        self.writer.flush()
+        for batch in chunked(recovered, SQLITE_MAX_VARIABLES):
+            FailedItem.delete().where(FailedItem.id.in_(batch)).execute()
+        log.info(f"recovered {len(recovered)} of {len(failed)} failed e-mails")
+        return len(recovered)
 
     def store_mail_to_db(self, mail_fields, current_folder, passed, bail_out_flag):
-        if Mail.select().where(Mail.datetime == mail_fields.datetime).count() == 0:
-            try:
-                Mail.insert(**mail_fields._asdict(), folder=current_folder).execute()
-            except IntegrityError as e:
-                log.warn(f"Unable to update db: {e.args}")
-                breakpoint()
-        elif not self.download_now and not passed:
-            bail_out_flag = (
+        """Queue e-mail for storage, asking whether to abort once duplicates show up
+
+        :param mail_fields: Fields extracted from e-mail
+        :param current_folder: Folder the e-mail belongs to
+        :param passed: Whether the user already was asked
+        :param bail_out_flag: Current bail out state
+        :return: bail out flag, passed
+        """
+        try:
+            duplicates = self.writer.add(mail_fields, current_folder)
+        except IntegrityError as e:
+            log.error(f"Unable to update db: {e.args}")
+            duplicates = 0
+        if duplicates and not (self.download_now or self.background or passed):
+            bail_out_flag = self.ask_abort()
+            passed = True
+        return bail_out_flag, passed
+
+    @property
+    def background(self) -> bool:
+        """Whether running within the thread of a background job"""
+        return self.job is not None and self.job.current
+
+    def expect(self, count: int) -> None:
+        """Add to the number of e-mails the background job is to process"""
+        if self.background:
+            self.job.expect(count)
+
+    def step(self, count: int = 1) -> None:
+        """Count e-mails processed by the background job, raising Cancelled
+        once the job was cancelled"""
+        if self.background:
+            self.job.step(count)
+
+    def tracked(self, records: Iterable) -> Iterator:
+        """Iterate records, counting each one as a step of the background job"""
+        for r in records:
+            self.step()
+            yield r
+
+    def ask_abort(self) -> bool:
+        """Ask whether to abort, pausing the progress display meanwhile"""
+        if self.progress:
+            self.progress.stop()
+        try:
+            return (
                 "y"
                 in input(
                     "I have found existing e-mail stored, would you like to abort (y/n):"
                 ).lower()
             )
-            passed = True
-        return bail_out_flag, passed
+        finally:
+            if self.progress:
+                self.progress.start()
 
     def add_record(self, input_dict):
-        Mail.insert(**input_dict).execute()
+        input_dict = dict(input_dict, digest=MailWriter.key(input_dict))
+        with self.db.atomic():
+            record = dict(input_dict, id=Mail.insert(**input_dict).execute())
+            self.index_records([record])
+            store_recipients([record])
+
+    def index_records(self, records) -> None:
+        """Add records to the full-text index if available
+
+        :param records: Mail records as dicts including id
+        """
+        if self.fts:
+            index_records(records)
+
+    def rebuild_search_index(self) -> int:
+        """Backfill the full-text index for existing databases
+
+        :return: Number of records indexed
+        """
+        if not self.fts:
+            log.error("SQLite lacks FTS5, unable to build search index")
+            return 0
+        count = rebuild_index()
+        log.info(f"indexed {count} records")
+        return count
+
+    def vacuum_database(self) -> int:
+        """Rewrite the database file, returning the space of removed or
+        compressed e-mails to the file system
+
+        :return: Number of bytes reclaimed
+        """
+        size = self.db.pragma("page_count") * self.db.pragma("page_size")
+        self.db.execute_sql("VACUUM")
+        freed = size - self.db.pragma("page_count") * self.db.pragma("page_size")
+        log.info(f"reclaimed {freed / 2 ** 20:.1f} MB of {self.filename}")
+        return freed
 
     def extract_email_items(self, fields, item) -> NamedTuple:
-        f: NamedTuple = nt("f", fields)(
+        values = [
             self.to_iso_dt(str(item.datetime_received.strftime(ISO_FORMAT))),
             f"{item.sender.name} <{item.sender.email_address}>",
             ",".join([f"{_.name} <{_.email_address}>" for _ in item.to_recipients]),
-            str(item.display_cc),
+            ",".join(
+                [f"{_.name} <{_.email_address}>" for _ in item.cc_recipients or []]
+            ),
             item.subject,
             item.body,
-        )
+            item.message_id,
+        ]
+        if "display_cc" in fields:
+            values.append(str(item.display_cc))
+        if "attachments" in fields:
+            values.append(self.attachment_fetcher.fetch(item))
+        f: NamedTuple = nt("f", fields)(*values)
         return f
 
     @staticmethod
@@ -247,116 +773,261 @@ class Email:
         records = Mail.select().where((Mail.id >= f) & (Mail.id <= t)).dicts()
         return records
 
-    # noinspection PyProtectedMember
+    def page_records(
+        self, filtered: bool = False, after: tuple = None, size: int = PAGE_SIZE
+    ) -> Annotated[list, "Page of records"]:
+        """Return one page of records, newest first, with listed columns only
+
+        :param filtered: Page through filtered records or all
+        :param after: datetime and id of last record on previous page
+        :param size: Number of records per page
+        :return: List of records
+        """
+        query = self.filter_query if filtered else Mail.select()
+        return self.partitions.page(
+            query.select(*LIST_COLUMNS), self.partitions_of(filtered), after, size
+        )
+
+    def iter_pages(self, filtered: bool = False, size: int = PAGE_SIZE):
+        """Iterate all records page by page
+
+        :param filtered: Page through filtered records or all
+        :param size: Number of records per page
+        """
+        after = None
+        while True:
+            records = self.page_records(filtered, after, size)
+            if not records:
+                return
+            yield records
+            after = records[-1]["datetime"], records[-1]["id"]
+
     def print_db_records_table(self, filtered: bool = False) -> None:
-        """Prints a pretty table of records
+        """Prints a pretty table of records, one page at a time
 
         :param filtered: Print either filtered records or all
         """
-        cols = Mail._meta.columns.keys()
-        table = Table(show_header=True, header_style="bold magenta", min_width=300)
-        for _ in cols:
-            table.add_column(_)
-        next(
-            c for c in table.columns if c.header in ["body", "to", "sender"]
-        ).width = 20
-        if not filtered:
-            items = self.get_db_records()
-        else:
-            items = self.filtered_records
-        for _ in items:
-            table.add_row(*[str(_[c])[:40] for c in cols])
-        Console().print(table)
+        cols = [c.name for c in LIST_COLUMNS]
+        for page, records in enumerate(self.iter_pages(filtered)):
+            table = Table(
+                show_header=page == 0, header_style="bold magenta", min_width=300
+            )
+            for _ in cols:
+                table.add_column(_)
+            next(c for c in table.columns if c.header == "sender").width = 20
+            for _ in records:
+                table.add_row(*[str(_[c])[:40] for c in cols])
+            Console().print(table)
 
-    def records_to_files(self, out: str = "./out", filtered: bool = False) -> None:
-        """Exports records to html files
+    def records_to_files(
+        self,
+        out: str = "./out",
+        filtered: bool = False,
+        workers: int = 4,
+        export_format: str = "html",
+        attachments: bool = None,
+    ) -> int:
+        """Exports records to html files, skipping those already exported, or
+        into a mbox, Maildir or tarball, or their metadata into Parquet or
+        Arrow files
 
         :param out: Path to export to
         :param filtered: Either export filtered or all records
+        :param workers: Number of html files written in parallel
+        :param export_format: One of EXPORT_FORMATS
+        :param attachments: Write attachments next to html files, default as
+            set by the attachments option
+        :return: Number of e-mails written
         """
-        if filtered:
-            items = self.filtered_records
-        else:
-            items = self.get_db_records()
-        for r in items:
-            fn_ = f"{r['datetime'].strftime('%y%m%d_%H%M')}"
-            fn_ += f"__{r['sender'].split()[0]}__"
-            fn_ += re.sub(r"[^\w]", "", f"{'_'.join(r['subject'].split()[:10])}")
-            fn_ += f".html"
-            Path(out).mkdir(parents=True, exist_ok=True)
-            f = Path(out) / Path(fn_)
-            log.info(f"writing {f}")
-            t = r["body"]
-            if "<html" not in t:
-                t = f'<meta http-equiv="Content-Type" content="text/html" charset="utf-8"/>{t}'.replace(
-                    "\n", "<br>"
-                )
-            f.write_text(t)
+        if attachments is None:
+            attachments = self.attachments
+        query = self.filter_query if filtered else Mail.select()
+        databases = self.databases(filtered)
+        self.expect(self.filter_count if filtered else self.db_count)
+        if export_format in COLUMNAR_FORMATS:
+            return export_columnar(
+                query,
+                out,
+                export_format,
+                self.export_batch_rows,
+                self.export_partition,
+                databases,
+                advance=self.step,
+            )
+        if export_format == "html":
+            query = query.select(
+                Mail.id, Mail.datetime, Mail.sender, Mail.subject, Mail.body
+            ).dicts()
+            return export_html(
+                self.tracked(
+                    itertools.chain(*(query.clone().iterator(db) for db in databases))
+                ),
+                out,
+                workers,
+                self.get_attachments if attachments else None,
+            )
+        query = query.select(*Mail._meta.sorted_fields).order_by(Mail.datetime)
+        records = self.partitions.merge(
+            [query.dicts().clone().iterator(db) for db in databases],
+            key=lambda r: r["datetime"],
+        )
+        return export_archive(self.tracked(records), out, export_format)
 
-    def apply_filter(self) -> Annotated[tuple, "List of records"]:
-        """Apply filter based on filter_keyword and filter_range criteria
+    def partitions_of(self, filtered: bool = False) -> list:
+        """Partitions holding records, those matching the folder and date range
+        filtered on if filtered
 
-        :return: List of records
+        :param filtered: Only partitions of filtered records
+        :return: List of Partition
         """
-        search_word = self.filter_keyword
-        from_to_date = self.filter_range
-        folder = self.filter_folder
-        if not any([folder, search_word, any(from_to_date)]):
-            self.filtered_records = Mail.select().dicts()
-            return self.filtered_records
+        if not filtered:
+            return self.partitions.select()
+        since, until = self.filter_range
+        return self.partitions.select(self.filter_folder, since or None, until or None)
 
-        and_items = []
+    def databases(self, filtered: bool = False) -> list:
+        """Database downloaded to followed by those of partitions holding records
 
-        if search_word:
-            s = search_word.lower()
-            or_items = [
-                (Mail.to.contains(s)),
-                (Mail.sender.contains(s)),
-                (Mail.subject.contains(s)),
-                (Mail.body.contains(s)),
-            ]
-            item_expression = reduce(operator.or_, or_items)
-            and_items.append(item_expression)
+        :param filtered: Only partitions of filtered records
+        :return: List of databases
+        """
+        partitions = self.partitions_of(filtered)
+        return [self.db] + [self.partitions.database(p) for p in partitions]
+
+    def partition_mail(self) -> int:
+        """Move e-mails received before partition_before, by default the start
+        of this year, into one database per year or folder as set by partition
+
+        :return: Number of e-mails moved
+        """
+        before = self.partition_before
+        if isinstance(before, str):
+            before = datetime.datetime.strptime(before, "%Y-%m-%d")
+        moved = self.partitions.move(self.partition or "year", before)
+        log.info(f"moved {moved} e-mails into partitions by {self.partition}")
+        self.filter_key = None
+        return moved
 
-        if any(from_to_date):
-            from_, to_ = from_to_date
-            date_expression = (Mail.datetime >= from_) & (Mail.datetime <= to_)
-            and_items.append(date_expression)
+    def get_attachments(self, record_id: int) -> Annotated[list, "name and content"]:
+        """Return name and content of the attachments of a record
+
+        :param record_id: ID of record
+        :return: List of name, content
+        """
+        return list(
+            Attachment.select(Attachment.name, Blob.content)
+            .join(Blob)
+            .where(Attachment.mail == record_id)
+            .order_by(Attachment.id)
+            .tuples()
+            .execute(self.partitions.locate(record_id))
+        )
+
+    def apply_filter(self, refresh: bool = True) -> Annotated[tuple, "List of records"]:
+        """Apply filter based on filter_keyword and filter_range criteria
 
-        log.debug(f"filtering on folder {folder}")
-        if folder:
-            and_items.append((Mail.folder == folder))
+        The query and its count are reused until the criteria or the stored
+        e-mails change.
 
-        if len(and_items) > 0:
-            expression = reduce(operator.and_, and_items)
+        :param refresh: Run again when only the stored e-mails changed, e.g.
+            not while a download keeps changing them
+        :return: List of records
+        """
+        key = (
+            self.filter_keyword,
+            tuple(self.filter_range),
+            self.filter_folder,
+            summary(),
+        )
+        if key == self.filter_key or (
+            not refresh and self.filter_key and key[:-1] == self.filter_key[:-1]
+        ):
+            return self.filtered_records
+        self.filter_query = self.build_filter_query()
+        partitions = self.partitions_of(filtered=True)
+        if any([self.filter_folder, self.filter_keyword, any(self.filter_range)]):
+            counts = self.partitions.fan_out(self.filter_query.count, partitions)
+            self.filter_count = sum(counts)
+        else:
+            self.filter_count = self.db_count
+        if partitions:
+            self.filtered_records = MergedRecords(
+                self.filter_query,
+                self.databases(filtered=True),
+                self.filter_count,
+                ranked(self.filter_keyword, self.fts),
+            )
         else:
-            expression = and_items[0]
+            self.filtered_records = self.filter_query.dicts()
+        log.info(f"found {self.filter_count} records")
+        self.filter_key = key
+        return self.filtered_records
 
-        records = Mail.select().where(expression).dicts()
-        log.info(f"found {len(records)} records")
-        self.filtered_records = records
-        return records
+    def build_filter_query(self):
+        """Build query based on filter_keyword and filter_range criteria
+
+        :return: Query of records
+        """
+        return build_filter_query(
+            self.filter_keyword, self.filter_range, self.filter_folder, self.fts
+        )
+
+    def print_top_correspondents(self, limit: int = 20) -> list:
+        """Print addresses with most e-mails, within the folder filtered on
+
+        :param limit: Number of addresses
+        :return: Dicts of address, name, from, to, cc and total
+        """
+        rows = top_correspondents(limit, self.filter_folder)
+        table = Table(title="Top correspondents")
+        table.add_column("Address")
+        table.add_column("Name")
+        for column in ("From", "To", "Cc", "Total"):
+            table.add_column(column, justify="right")
+        for r in rows:
+            table.add_row(
+                r["address"],
+                r["name"] or "",
+                *(str(r[c]) for c in ("from", "to", "cc", "total")),
+            )
+        Console().print(table)
+        return rows
 
     def select_records(
         self, filtered: bool = False, records: bool = None
     ) -> Annotated[int, "id of selected record"]:
         """Supply a selection list and ability to pick one
 
+        Unless a list of records is given records are browsed page by page.
+
         :param filtered: Only display filtered or all records
         :param records: Optional list of records as input
         :return: An ID of the record selected
         """
-        if filtered:
-            records = self.filtered_records
-        elif not records:
-            records = self.get_db_records()
+        if filtered or not records:
+            return self.browse_records(filtered)
+        return self.select_record(records)
+
+    @staticmethod
+    def select_record(records, previous=False, more=False) -> str:
+        """Let user pick one of records or change page
+
+        :param records: Records to choose from
+        :param previous: Offer going to previous page
+        :param more: Offer going to next page
+        :return: An ID of the record selected, None or page choice
+        """
         choices = ["Exit"]
+        if previous:
+            choices.append(PREVIOUS_PAGE)
         choices.extend(
             [
                 f"{r['id']} - {r['datetime'].strftime('%y%m%d %H:%M')} - [{r['folder']}] {r['subject']}"
                 for r in records
             ]
         )
+        if more:
+            choices.append(NEXT_PAGE)
         print("=" * 79)
         cli = ScrollBar(
             prompt="Which one would you like to look at?", choices=choices, height=10
@@ -364,6 +1035,25 @@ class Email:
         i = next(iter(cli.split(" - ")))
         return i if i != "Exit" else None
 
+    def browse_records(self, filtered: bool = False) -> Annotated[int, "id of selected record"]:
+        """Pick one of the records, fetching a page at a time
+
+        :param filtered: Only display filtered or all records
+        :return: An ID of the record selected
+        """
+        pages = [None]
+        while True:
+            records = self.page_records(filtered, pages[-1], PAGE_SIZE + 1)
+            more = len(records) > PAGE_SIZE
+            records = records[:PAGE_SIZE]
+            choice = self.select_record(records, len(pages) > 1, more)
+            if choice == NEXT_PAGE:
+                pages.append((records[-1]["datetime"], records[-1]["id"]))
+            elif choice == PREVIOUS_PAGE:
+                pages.pop()
+            else:
+                return choice
+
     @staticmethod
     def format_html(input_: Annotated[str, "HTML text"]) -> str:
         """Format and prints MarkDown from HTML within the terminal
@@ -371,19 +1061,34 @@ class Email:
         :param input_: Input data HTML
         :return:
         """
-        # html = htmllaundry.sanitize(input_, htmllaundry.cleaners.LineCleaner)
-        from lxml_html_clean import clean_html
-        html = clean_html(input_)
-        m = md(html)
-        lines = [line for line in m.split("\n") if line.strip() != ""]
-        return "\n".join(lines[:40])
+        # lxml and markdownify are slow to import, load them once rendering
+        from .render import html_to_markdown
+
+        return html_to_markdown(input_)
+
+    def render_body(self, record_id: int, digest: str) -> str:
+        """Render body of record as MarkDown, loading it from database
+
+        Cached by record id and digest in render_cache.
+
+        :param record_id: ID of record
+        :param digest: Content digest of record
+        :return: MarkDown
+        """
+        db = self.partitions.locate(record_id)
+        return self.format_html(
+            Mail.select(Mail.body).where(Mail.id == record_id).scalar(db)
+        )
 
     def show_record(self, record_id: int) -> None:
-        r = Mail.select().where(Mail.id == record_id).first()
-        try:
-            markdown = self.format_html(r.body)
-        except AttributeError:
+        r = (
+            Mail.select(*[f for f in Mail._meta.sorted_fields if f is not Mail.body])
+            .where(Mail.id == record_id)
+            .first(self.partitions.locate(record_id))
+        )
+        if r is None:
             return
+        markdown = self.render_cache(r.id, r.digest)
         print("[white]_[/white]" * 50)
         print(f"[bold red]Folder:[/bold red] {r.folder}")
         print(f"[bold red]From:[/bold red] {r.sender}")
@@ -0,0 +1,54 @@
+"""Download of e-mail attachments"""
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from richlog import log
+
+
+def blob_key(content: bytes) -> str:
+    """Content address of an attachment"""
+    return hashlib.sha256(content).hexdigest()
+
+
+class AttachmentFetcher:
+    """Fetches content of file attachments using a pool of threads
+
+    The pool is shared by all folders downloaded, bounding the number of
+    attachments fetched at the same time. It is started by the first fetch
+    and stopped by close, so an Email not downloading attachments runs no
+    threads.
+
+    :param workers: Maximum number of attachments fetched concurrently
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.pool = None
+
+    @staticmethod
+    def content(attachment):
+        """Return name, content type and content of an attachment"""
+        try:
+            return attachment.name, attachment.content_type, attachment.content
+        except Exception as e:
+            log.warning(f"failed fetching attachment {attachment.name}: {e.args}")
+            return None
+
+    def fetch(self, item) -> list:
+        """Fetch file attachments of an Exchange item concurrently
+
+        :param item: Exchange item
+        :return: List of name, content type and content
+        """
+        from exchangelib import FileAttachment
+
+        files = [a for a in item.attachments or () if isinstance(a, FileAttachment)]
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        return [a for a in self.pool.map(self.content, files) if a is not None]
+
+    def close(self) -> None:
+        """Stop the pool of threads, a later fetch starts it again"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,145 @@
+"""Download of many accounts using a pool of processes"""
+import csv
+import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable
+
+from rich.console import Console
+from rich.table import Table
+
+from richlog import log
+from .api import Email
+from .models import FailedItem
+
+ACCOUNT_FIELDS = (
+    "email",
+    "password",
+    "server_name",
+    "username",
+    "archive_folders",
+    "database",
+)
+
+
+def read_accounts(path: str) -> list:
+    """Read accounts from a CSV file with a header naming its columns
+
+    Columns are those of ACCOUNT_FIELDS, only email is required and empty
+    cells fall back to the command line options.
+
+    :param path: Path of accounts file
+    :return: Options by account
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    accounts = []
+    for row in rows:
+        unknown = set(row) - set(ACCOUNT_FIELDS)
+        if unknown:
+            columns = ", ".join(sorted(unknown))
+            raise ValueError(f"unknown columns in {path}: {columns}")
+        account = {k: v.strip() for k, v in row.items() if v and v.strip()}
+        if "email" in account:
+            accounts.append(account)
+    return accounts
+
+
+def account_database(database: str, email: str) -> str:
+    """Database of account, separate ones if the path contains {email}"""
+    return database.format(email=email) if "{email}" in database else database
+
+
+def download_account(options: dict) -> dict:
+    """Download one account, run within a process of the pool
+
+    :param options: Arguments of Email
+    :return: Result of the download
+    """
+    result = dict(
+        email=options["email"],
+        database=options["database"],
+        stored=0,
+        duplicates=0,
+        failed=0,
+        seconds=0.0,
+        error=None,
+    )
+    started, run_started = time.monotonic(), datetime.datetime.now()
+    try:
+        email = Email(**options)
+        try:
+            email.process_mail()
+        finally:
+            result["stored"] = email.writer.stored
+            result["duplicates"] = email.writer.duplicates
+            # failures of earlier runs are still recorded until retried
+            result["failed"] = (
+                FailedItem.select()
+                .where(
+                    (FailedItem.account == email.email)
+                    & (FailedItem.failed >= run_started)
+                )
+                .count()
+            )
+            email.db.close()
+    except Exception as e:
+        log.exception(f"download of {options['email']} failed")
+        result["error"] = repr(e)
+    result["seconds"] = time.monotonic() - started
+    return result
+
+
+def run_batch(accounts: Iterable[dict], processes: int = 2, **options) -> list:
+    """Download accounts in parallel processes and print a summary
+
+    Accounts sharing a database are stored with their account and are kept
+    apart in sync state and checkpoints. The total number of concurrent EWS
+    requests is at most processes times workers.
+
+    :param accounts: Options by account, see read_accounts
+    :param processes: Number of accounts downloaded at the same time
+    :param options: Arguments of Email common to all accounts
+    :return: Result of each account
+    """
+    tasks = []
+    for account in accounts:
+        task = dict(options, download_now=True, **account)
+        task["database"] = account_database(task["database"], task["email"])
+        tasks.append(task)
+    shared = len({t["database"] for t in tasks}) < len(tasks)
+    if shared:
+        # writers of several processes take turns on the same database
+        for task in tasks:
+            task["wal"] = True
+    log.info(f"downloading {len(tasks)} accounts using {processes} processes")
+    results = []
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(download_account, task) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            log.info(f"finished {result['email']}: {result}")
+            results.append(result)
+    results.sort(key=lambda r: r["email"])
+    print_summary(results)
+    return results
+
+
+def print_summary(results: list) -> None:
+    """Prints a table of e-mails per second and failures per account"""
+    table = Table(header_style="bold magenta")
+    columns = ("account", "database", "stored", "duplicates", "e-mails/s", "failed")
+    for column in columns + ("error",):
+        table.add_column(column)
+    for r in results:
+        rate = r["stored"] / max(r["seconds"], 1e-6)
+        table.add_row(
+            r["email"],
+            r["database"],
+            str(r["stored"]),
+            str(r["duplicates"]),
+            f"{rate:.1f}",
+            str(r["failed"]),
+            (r["error"] or "")[:60],
+        )
+    Console().print(table)
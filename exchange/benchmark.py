@@ -0,0 +1,402 @@
+"""Benchmarks of download, filtering and export against synthetic mailboxes
+
+Mailboxes are generated by a local stand-in for the exchangelib account and
+folder API, so downloads run through process_mail without a server. Results
+are written as JSON to track throughput between releases::
+
+    python -m exchange.benchmark --sizes 10000,100000 --out benchmark.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Iterator
+
+from exchangelib import UTC, EWSDateTime, Mailbox
+from rich import print
+
+from richlog import log
+from .api import FIELDS, Email
+from .models import Mail
+
+SIZES = (10_000, 100_000, 1_000_000)
+WORDS = (
+    "invoice meeting report budget project review schedule contract update "
+    "proposal quarterly release customer support holiday agenda minutes travel "
+    "approval deadline design server backup migration training survey payroll "
+    "security incident roadmap feedback workshop launch audit forecast order"
+).split()
+START = datetime.datetime(2015, 1, 1)
+
+
+class FakeQuery(list):
+    """Stands in for an exchangelib QuerySet, items are sorted newest first"""
+
+    page_size = None
+
+    def only(self, *fields):
+        return self
+
+    def order_by(self, *fields):
+        return self
+
+    def count(self) -> int:
+        return len(self)
+
+    def filter(self, **lookups):
+        """Filter on datetime_received with gte, gt, lte and lt lookups"""
+        ops = {
+            "gte": lambda a, b: a >= b,
+            "gt": lambda a, b: a > b,
+            "lte": lambda a, b: a <= b,
+            "lt": lambda a, b: a < b,
+        }
+        items = self
+        for lookup, value in lookups.items():
+            field, op = lookup.split("__")
+            items = [i for i in items if ops[op](getattr(i, field), value)]
+        return type(self)(items)
+
+    def values_list(self, *fields):
+        return [tuple(getattr(i, f) for f in fields) for i in self]
+
+    def __getitem__(self, s):
+        if isinstance(s, slice):
+            return type(self)(super().__getitem__(s))
+        return super().__getitem__(s)
+
+
+class FakeFolder:
+    """Stands in for an exchangelib folder holding generated items"""
+
+    def __init__(self, items=(), children=None):
+        newest_first = sorted(items, key=lambda i: i.datetime_received, reverse=True)
+        self.items = FakeQuery(newest_first)
+        self.children = children or {}
+
+    @property
+    def total_count(self) -> int:
+        return len(self.items)
+
+    def all(self) -> FakeQuery:
+        return FakeQuery(self.items)
+
+    def filter(self, **lookups) -> FakeQuery:
+        return self.items.filter(**lookups)
+
+    def __truediv__(self, name):
+        return self.children.setdefault(name, FakeFolder())
+
+
+class FakeAccount:
+    """Stands in for an exchangelib Account with generated folders
+
+    :param folders: Generated items by folder name, Inbox, Sent and archive
+        folders named Archive/<name>
+    """
+
+    def __init__(self, folders: dict):
+        folders = {name: FakeFolder(items) for name, items in folders.items()}
+        self.inbox = folders.pop("Inbox", FakeFolder())
+        self.sent = folders.pop("Sent", FakeFolder())
+        self.archive_msg_folder_root = FakeFolder(
+            children={name.split("/", 1)[-1]: f for name, f in folders.items()}
+        )
+
+    def fetch(self, ids, only_fields=None) -> Iterator:
+        archive = self.archive_msg_folder_root.children.values()
+        folders = [self.inbox, self.sent, *archive]
+        items = {i.id: i for folder in folders for i in folder.items}
+        for id_, _ in ids:
+            yield items.get(id_) or ValueError(f"item {id_} not found")
+
+
+def generate_items(
+    count: int,
+    folders=("Inbox", "Sent"),
+    body_size: int = 2000,
+    recipients: int = 3,
+    seed: int = 0,
+) -> Iterator[tuple]:
+    """Generate (folder, item) of a synthetic mailbox, oldest first
+
+    :param count: Number of e-mails
+    :param folders: Names of folders e-mails are spread over
+    :param body_size: Approximate number of characters of bodies
+    :param recipients: Number of recipients per e-mail
+    :param seed: Seed making mailboxes reproducible
+    """
+    rnd = random.Random(seed)
+    people = [
+        Mailbox(name=f"Person {n}", email_address=f"person{n}@example.com")
+        for n in range(max(recipients * 10, 50))
+    ]
+    received = START
+    for n in range(count):
+        received += datetime.timedelta(seconds=rnd.randint(1, 3600))
+        words = rnd.choices(WORDS, k=max(body_size // 8, 1))
+        paragraphs = [" ".join(words[i : i + 40]) for i in range(0, len(words), 40)]
+        body = "".join(f"<p>{p}</p>" for p in paragraphs)
+        if n % 2:
+            body = f"<html><body>{body}</body></html>"
+        cc = rnd.sample(people, n % 3)
+        yield rnd.choice(folders), SimpleNamespace(
+            id=f"item{n}",
+            changekey="ck",
+            datetime_received=EWSDateTime.from_datetime(received.replace(tzinfo=UTC)),
+            sender=rnd.choice(people),
+            to_recipients=rnd.sample(people, recipients),
+            cc_recipients=cc,
+            display_cc="; ".join(p.name for p in cc) or None,
+            subject=" ".join(rnd.choices(WORDS, k=6)),
+            body=body,
+            message_id=f"<{n}.{seed}@example.com>",
+            attachments=[],
+        )
+
+
+def fake_account(count: int, **options) -> FakeAccount:
+    """Return account holding a generated mailbox, see generate_items"""
+    folders = {}
+    for folder, item in generate_items(count, **options):
+        folders.setdefault(folder, []).append(item)
+    return FakeAccount(folders)
+
+
+def fill_database(email: Email, count: int, **options) -> int:
+    """Store a generated mailbox through the writer, as downloads do
+
+    :param email: Email with the database to fill
+    :param count: Number of e-mails
+    :param options: Options of generate_items
+    :return: Number of e-mails stored
+    """
+    with email.writer:
+        for folder, item in generate_items(count, **options):
+            email.writer.add(email.extract_email_items(FIELDS, item), folder)
+    return email.db_count
+
+
+def timed(func: Callable, repeat: int = 1) -> float:
+    """Median seconds taken by func with its output discarded"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+class Benchmark:
+    """Runs benchmarks and collects their results
+
+    :param workdir: Folder of generated databases, reused between runs
+    :param body_size: Approximate number of characters of bodies
+    :param recipients: Number of recipients per e-mail
+    :param workers: Number of workers downloading and exporting
+    """
+
+    def __init__(self, workdir: str, body_size=2000, recipients=3, workers=1):
+        self.workdir = Path(workdir)
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self.options = dict(body_size=body_size, recipients=recipients)
+        self.workers = workers
+        self.results = []
+
+    def record(self, name: str, rows: int, seconds: float, items: int = None):
+        """Add result, items is the number of e-mails processed if not rows"""
+        items = rows if items is None else items
+        result = dict(
+            benchmark=name,
+            rows=rows,
+            seconds=round(seconds, 6),
+            per_second=round(items / seconds, 1) if seconds and items else None,
+        )
+        print(f"[bold]{name}[/bold] ({rows} rows): {seconds:.3f}s")
+        self.results.append(result)
+
+    def download(self, count: int) -> None:
+        """Time process_mail downloading a mailbox of count e-mails"""
+        path = self.workdir / f"download_{count}.sqlite"
+        path.unlink(missing_ok=True)
+        email = Email(
+            database=str(path),
+            email="bench@example.com",
+            download_now=True,
+            workers=self.workers,
+            batch_size=500,
+        )
+        account = fake_account(count, **self.options)
+        email.connect = lambda: account
+        self.record("process_mail", count, timed(email.process_mail))
+        email.db.close()
+
+    def database(self, count: int) -> Email:
+        """Return Email of a database with count generated e-mails"""
+        path = self.workdir / f"bench_{count}.sqlite"
+        email = Email(database=str(path), batch_size=1000)
+        if email.db_count != count:
+            email.db.close()
+            path.unlink()
+            email = Email(database=str(path), batch_size=1000)
+            started = time.perf_counter()
+            fill_database(email, count, **self.options)
+            self.record("fill_database", count, time.perf_counter() - started)
+        return email
+
+    def queries(self, count: int, export_size: int = 1000) -> None:
+        """Time browsing, filtering and export against a database of count rows"""
+        email = self.database(count)
+        self.record("print_db_status", count, timed(email.print_db_status, 5), 1)
+
+        def apply_filter(keyword=None, range_=(None, None), folder=None):
+            def run():
+                email.filter_keyword, email.filter_range = keyword, range_
+                email.filter_folder = folder
+                email.apply_filter()
+                email.page_records(filtered=True)
+
+            return run
+
+        _, first, last = email.db_summary
+        month = first, first + datetime.timedelta(days=30)
+        filters = {
+            "keyword": apply_filter(keyword=WORDS[0]),
+            "range": apply_filter(range_=month),
+            "folder": apply_filter(folder="Sent"),
+            "combined": apply_filter(WORDS[1], (first, last), "Inbox"),
+            "sender": apply_filter(keyword="from:person1@example.com"),
+            "recipient": apply_filter(keyword="to:person2@example.com"),
+        }
+        for name, run in filters.items():
+            email.filter_key = None
+            self.record(f"apply_filter.{name}", count, timed(run), 1)
+
+        ids = random.Random(0).sample(range(1, count + 1), min(20, count))
+        email.render_cache.cache_clear()
+        cold = statistics.median(timed(lambda: email.show_record(i)) for i in ids)
+        cached = statistics.median(timed(lambda: email.show_record(i)) for i in ids)
+        self.record("show_record", count, cold, 1)
+        self.record("show_record.cached", count, cached, 1)
+        top = timed(email.print_top_correspondents)
+        self.record("top_correspondents", count, top, 1)
+
+        # export the newest export_size e-mails
+        since = (
+            Mail.select(Mail.datetime)
+            .order_by(Mail.datetime.desc())
+            .offset(min(export_size, count) - 1)
+            .scalar()
+        )
+        email.filter_keyword, email.filter_folder = None, None
+        email.filter_range = since, last
+        email.apply_filter()
+        for export_format in ("html", "mbox"):
+            with tempfile.TemporaryDirectory() as out:
+                target = out if export_format == "html" else f"{out}/mail.mbox"
+                exported = []
+
+                def export():
+                    exported.append(
+                        email.records_to_files(
+                            target,
+                            filtered=True,
+                            workers=max(self.workers, 4),
+                            export_format=export_format,
+                        )
+                    )
+
+                name = f"records_to_files.{export_format}"
+                self.record(name, count, timed(export), exported[0])
+        email.db.close()
+
+    def report(self, **options) -> dict:
+        """Return results along with the environment they were measured in"""
+        return dict(
+            created=datetime.datetime.now().isoformat(timespec="seconds"),
+            python=platform.python_version(),
+            sqlite=sqlite3.sqlite_version,
+            platform=platform.platform(),
+            options=dict(options, **self.options, workers=self.workers),
+            results=self.results,
+        )
+
+
+def run(
+    sizes=SIZES,
+    download_size: int = 5000,
+    out: str = "benchmark.json",
+    workdir: str = None,
+    **options,
+) -> dict:
+    """Run all benchmarks and write results as JSON
+
+    :param sizes: Numbers of rows of databases queried
+    :param download_size: Number of e-mails downloaded, 0 to skip
+    :param out: Path of JSON results
+    :param workdir: Folder keeping generated databases, temporary if None
+    :param options: Options of Benchmark
+    :return: Results
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        bench = Benchmark(workdir or tmp, **options)
+        if download_size:
+            bench.download(download_size)
+        for size in sizes:
+            bench.queries(size)
+        report = bench.report(sizes=list(sizes), download_size=download_size)
+    Path(out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"wrote results of {len(report['results'])} benchmarks to {out}")
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=list(SIZES),
+        help="Comma-separated numbers of rows of the databases queried",
+    )
+    parser.add_argument(
+        "--download_size",
+        type=int,
+        default=5000,
+        help="Number of e-mails downloaded through process_mail, 0 to skip",
+    )
+    parser.add_argument(
+        "--body_size", type=int, default=2000, help="Characters per body"
+    )
+    parser.add_argument(
+        "--recipients", type=int, default=3, help="Recipients per e-mail"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Download workers")
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        help="Folder keeping generated databases between runs, temporary by default",
+    )
+    parser.add_argument(
+        "--out", type=str, default="benchmark.json", help="Path of JSON results"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Log progress")
+    args = parser.parse_args()
+    options = vars(args)
+    if not options.pop("verbose"):
+        log.setLevel(logging.WARNING)
+    run(**options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Export of e-mail metadata to Parquet or Arrow IPC files for analysis
+
+Rows are read from the database in the order of an index and written in
+batches of fixed size, so memory stays bounded however many e-mails are
+exported. Bodies are only written as their size.
+"""
+import heapq
+import itertools
+import operator
+import os
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Callable, Iterator
+
+from richlog import log
+from .addresses import parse_addresses
+from .models import Mail
+
+COLUMNAR_FORMATS = ("parquet", "arrow")
+SUFFIXES = {"parquet": ".parquet", "arrow": ".arrow"}
+# pyarrow's name of a partition without value, i.e. e-mails without folder
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+COLUMNS = (
+    Mail.id,
+    Mail.datetime,
+    Mail.account,
+    Mail.folder,
+    Mail.sender,
+    Mail.to,
+    Mail.cc,
+    Mail.subject,
+    Mail.body,
+    Mail.digest,
+    Mail.message_id,
+)
+
+
+def schema(pa):
+    """Columns written, to and cc are lists of addresses"""
+    return pa.schema(
+        [
+            ("id", pa.int64()),
+            ("datetime", pa.timestamp("us", tz="UTC")),
+            ("account", pa.string()),
+            ("folder", pa.string()),
+            ("sender", pa.string()),
+            ("to", pa.list_(pa.string())),
+            ("cc", pa.list_(pa.string())),
+            ("subject", pa.string()),
+            ("body_size", pa.int64()),
+            ("digest", pa.string()),
+            ("message_id", pa.string()),
+        ]
+    )
+
+
+def sender_address(sender: str) -> str:
+    """Address of sender, or as stored if it has none"""
+    parsed = parse_addresses(sender)
+    return parsed[0][0] if parsed else sender
+
+
+def body_size(body: str) -> int:
+    """Size of body in bytes as UTF-8, not as stored compressed"""
+    return None if body is None else len(body.encode("utf-8"))
+
+
+def record_batch(pa, schema_, rows: list):
+    """Convert rows of COLUMNS into a record batch of schema_"""
+    columns = list(zip(*rows))
+    columns[4] = [sender_address(s) for s in columns[4]]
+    for n in (5, 6):
+        columns[n] = [[a for a, _ in parse_addresses(v)] for v in columns[n]]
+    columns[8] = [body_size(b) for b in columns[8]]
+    return pa.record_batch(
+        [pa.array(c, type=f.type) for c, f in zip(columns, schema_)], schema=schema_
+    )
+
+
+def row_order(partition: bool):
+    """Sort key of rows in the order they are queried"""
+    if partition:
+        # NULL folders sort first in SQLite
+        return lambda r: (r[3] is not None, r[3] or "", r[1], r[0])
+    return operator.itemgetter(1, 0)
+
+
+def partition_path(folder: str, month: str) -> Path:
+    """Hive style folder=.../month=YYYY-MM directory of a partition"""
+    folder = urllib.parse.quote(folder, safe="") if folder else NULL_PARTITION
+    return Path(f"folder={folder}") / f"month={month}"
+
+
+def write_batches(
+    pa,
+    path: Path,
+    rows: Iterator[tuple],
+    export_format: str,
+    batch_rows: int,
+    advance: Callable = None,
+) -> int:
+    """Write rows to a file of export_format batch by batch, atomically
+
+    :return: Number of rows written
+    """
+    tmp = path.with_name(f"{path.name}.tmp")
+    schema_ = schema(pa)
+    count = 0
+    if export_format == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(str(tmp), schema_, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(str(tmp), schema_)
+    with writer:
+        for batch in iter(lambda: list(itertools.islice(rows, batch_rows)), []):
+            writer.write_batch(record_batch(pa, schema_, batch))
+            count += len(batch)
+            if advance:
+                advance(len(batch))
+    os.replace(tmp, path)
+    return count
+
+
+def export_columnar(
+    query,
+    out: str,
+    export_format: str = "parquet",
+    batch_rows: int = 10000,
+    partition: bool = False,
+    databases: list = None,
+    advance: Callable = None,
+) -> int:
+    """Write metadata of e-mails to a Parquet or Arrow IPC file (requires pyarrow)
+
+    :param query: Query of e-mails
+    :param out: Path of file, or directory if partitioned
+    :param export_format: parquet or arrow
+    :param batch_rows: Number of rows read and written at a time
+    :param partition: Write a file per folder and month below out, as
+        folder=<folder>/month=<YYYY-MM>/part-0.<format>
+    :param databases: Databases to read, rows of each merged in order
+    :param advance: Called with the number of rows of each batch written
+    :return: Number of e-mails written
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        log.error(f"pyarrow is not installed, unable to export {export_format}")
+        return 0
+    started = time.monotonic()
+    # in the order of the (folder, datetime) and datetime indexes
+    order = (Mail.folder,) if partition else ()
+    query = query.select(*COLUMNS).order_by(*order, Mail.datetime, Mail.id).tuples()
+    results = [query.clone().iterator(db) for db in databases or [None]]
+    rows = heapq.merge(*results, key=row_order(partition))
+    suffix = SUFFIXES[export_format]
+    count, files = 0, 0
+    if partition:
+        out = Path(out)
+        months = itertools.groupby(rows, key=lambda r: (r[3], r[1].strftime("%Y-%m")))
+        for (folder, month), group in months:
+            path = out / partition_path(folder, month) / f"part-0{suffix}"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            count += write_batches(pa, path, group, export_format, batch_rows, advance)
+            files += 1
+    else:
+        count = write_batches(pa, Path(out), rows, export_format, batch_rows, advance)
+        files = 1
+    elapsed = max(time.monotonic() - started, 1e-6)
+    log.info(
+        f"exported metadata of {count} e-mails to {files} {export_format} files in "
+        f"{out} in {elapsed:.1f}s ({count / elapsed:.1f} e-mails/s)"
+    )
+    return count
@@ -0,0 +1,263 @@
+"""Concurrent download of e-mails from several folders"""
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Iterator, Optional
+
+from rich.progress import Progress
+
+from richlog import log
+from .metrics import Metrics
+
+RETRIES = 6
+MAX_BACKOFF = 300
+
+# handed from workers to the storing thread besides extracted e-mails
+Failure = namedtuple("Failure", "item_id changekey error")
+Done = namedtuple("Done", "index oldest completed")
+
+
+@lru_cache(maxsize=None)
+def transient_errors() -> tuple:
+    """Errors of throttling and connection problems, imported once needed"""
+    import requests
+    from exchangelib.errors import (
+        ErrorInternalServerTransientError,
+        ErrorMailboxStoreUnavailable,
+        ErrorServerBusy,
+        ErrorTimeoutExpired,
+        RateLimitError,
+    )
+
+    return (
+        ErrorServerBusy,
+        ErrorTimeoutExpired,
+        ErrorInternalServerTransientError,
+        ErrorMailboxStoreUnavailable,
+        RateLimitError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    )
+
+
+def is_transient(e: Exception) -> bool:
+    """Whether error is worth retrying, i.e. throttling or connection errors"""
+    from exchangelib.errors import TransportError
+
+    # errors returned by EWS subclass TransportError, plain ones are network errors
+    return isinstance(e, transient_errors()) or type(e) is TransportError
+
+
+def backoff(attempt: int, e: Exception) -> float:
+    """Seconds to wait before retry, as requested by the server or exponential"""
+    return getattr(e, "back_off", None) or min(2 ** attempt, MAX_BACKOFF)
+
+
+def item_ids(query, position: int) -> tuple:
+    """Return id and changekey of item at position without parsing the item"""
+    try:
+        for ids in query[position : position + 1].values_list("id", "changekey"):
+            return tuple(ids)
+    except Exception as e:
+        log.warning(f"unable to get id of email {position}: {e!r}")
+    return None, None
+
+
+def iter_items(
+    query, start: int, stop: int, failed: Optional[Callable] = None
+) -> Iterator:
+    """Iterate items start to stop of an Exchange query, skipping unparsable ones
+
+    exchangelib ends the iteration when an item fails to parse, so a new
+    request is made starting just after the failing item. Throttling and
+    connection errors are retried from the same item with exponential backoff.
+
+    :param query: Exchange query
+    :param start: Index of first item
+    :param stop: Index after last item
+    :param failed: Called with position and error of unparsable items
+    """
+    position, attempt = start, 0
+    while position < stop:
+        try:
+            for item in query[position:stop]:
+                position += 1
+                attempt = 0
+                yield item
+            return
+        except KeyError as e:
+            log.warning(f"error parsing email {position}: {e}")
+            if failed:
+                failed(position, e)
+            position += 1
+        except Exception as e:
+            if not is_transient(e) or attempt >= RETRIES:
+                raise
+            attempt += 1
+            delay = backoff(attempt, e)
+            log.warning(f"{e!r} at email {position}, retry {attempt} in {delay}s")
+            time.sleep(delay)
+
+
+class FolderDownloader:
+    """Fetches folders, and slices within large folders, using a pool of threads
+
+    Extracted e-mails are handed over a queue to the calling thread which alone
+    stores them through the writer, keeping all database inserts serialized.
+
+    :param extract: Function returning mail fields of an Exchange item
+    :param writer: MailWriter storing the e-mails
+    :param workers: Maximum number of concurrent EWS requests
+    :param split_size: Number of items fetched per task within a folder
+    :param checkpoint: Called with folder and the datetime down to which all
+        e-mails of the folder were handed to the writer
+    :param metrics: Metrics timing fetching and extracting e-mails
+    :param advance: Called for each e-mail handed to the writer, e.g. counting
+        progress of a job
+    :param quiet: Show no progress bars
+    """
+
+    def __init__(
+        self,
+        extract: Callable,
+        writer,
+        workers=4,
+        split_size=500,
+        checkpoint: Optional[Callable] = None,
+        metrics: Optional[Metrics] = None,
+        advance: Optional[Callable] = None,
+        quiet: bool = False,
+    ):
+        self.extract = extract
+        self.writer = writer
+        self.workers = workers
+        self.split_size = split_size
+        self.checkpoint = checkpoint
+        self.metrics = metrics or Metrics(interval=0)
+        self.advance_job = advance
+        self.quiet = quiet
+        self.results = queue.Queue(maxsize=workers * 100)
+        self.stop = threading.Event()
+
+    def put(self, folder: str, fields) -> None:
+        """Hand over result to the storing thread unless download was stopped"""
+        while not self.stop.is_set():
+            try:
+                self.results.put((folder, fields), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def slices(self, folder: str, query, count: int) -> list:
+        """Split folder into (folder, query, index, start, stop) download tasks"""
+        count = count or 0
+        return [
+            (folder, query, index, start, min(start + self.split_size, count))
+            for index, start in enumerate(range(0, count, self.split_size))
+        ]
+
+    def fetch(self, folder: str, query, index: int, start: int, stop: int) -> None:
+        """Download and extract one slice of a folder, run within a worker"""
+
+        def failed(position, e):
+            self.put(folder, Failure(*item_ids(query, position), repr(e)))
+
+        oldest, completed = None, False
+        try:
+            items = iter_items(query, start, stop, failed)
+            for item in self.metrics.timed_iter("fetch", items):
+                if self.stop.is_set():
+                    return
+                try:
+                    with self.metrics.time("extract"):
+                        fields = self.extract(item)
+                    oldest = fields.datetime
+                except (TypeError, AttributeError) as e:
+                    log.warning(f"Unable to process email, skipping: {e!r}")
+                    fields = Failure(
+                        getattr(item, "id", None),
+                        getattr(item, "changekey", None),
+                        repr(e),
+                    )
+                self.put(folder, fields)
+            completed = True
+        finally:
+            self.put(folder, Done(index, oldest, completed))
+
+    def run(self, download_folders: dict) -> int:
+        """Download all folders, storing e-mails from the calling thread
+
+        :param download_folders: Query and number of e-mails by folder name
+        :return: Number of e-mails downloaded
+        """
+        tasks = [
+            task
+            for folder, (query, count) in download_folders.items()
+            for task in self.slices(folder, query, count)
+        ]
+        totals = {folder: 0 for folder in download_folders}
+        for folder, _, _, start, stop in tasks:
+            totals[folder] += stop - start
+        log.info(
+            f"downloading {sum(totals.values())} items from {len(totals)} folders "
+            f"using {self.workers} workers"
+        )
+        # completed slices by folder, a checkpoint only moves past consecutive ones
+        completed = {folder: {} for folder in download_folders}
+        consecutive = dict.fromkeys(download_folders, 0)
+        downloaded = 0
+        started = time.monotonic()
+        with Progress(disable=self.quiet) as progress, ThreadPoolExecutor(
+            self.workers
+        ) as pool:
+            bars = {f: progress.add_task(f, total=t) for f, t in totals.items()}
+            futures = [pool.submit(self.fetch, *task) for task in tasks]
+            try:
+                remaining = len(futures)
+                while remaining:
+                    folder, fields = self.results.get()
+                    if isinstance(fields, Done):
+                        remaining -= 1
+                        if fields.completed:
+                            completed[folder][fields.index] = fields.oldest
+                            self.advance(folder, completed[folder], consecutive)
+                        continue
+                    rate = f"{folder} {self.metrics.rate:.0f}/s"
+                    progress.update(bars[folder], advance=1, description=rate)
+                    if self.advance_job:
+                        self.advance_job()
+                    if isinstance(fields, Failure):
+                        self.writer.fail(folder, *fields)
+                        continue
+                    self.writer.add(fields, folder)
+                    downloaded += 1
+            finally:
+                self.stop.set()
+                for future in futures:
+                    future.cancel()
+        for future in futures:
+            if not future.cancelled():
+                future.result()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        log.info(
+            f"downloaded {downloaded} e-mails in {elapsed:.1f}s "
+            f"({downloaded / elapsed:.1f} e-mails/s)"
+        )
+        return downloaded
+
+    def advance(self, folder: str, completed: dict, consecutive: dict) -> None:
+        """Checkpoint folder past the slices completed from its newest e-mail on
+
+        :param folder: Name of folder
+        :param completed: Oldest e-mail of completed slices by index
+        :param consecutive: Number of consecutive completed slices by folder
+        """
+        until = None
+        while consecutive[folder] in completed:
+            until = completed.pop(consecutive[folder]) or until
+            consecutive[folder] += 1
+        if until and self.checkpoint:
+            self.checkpoint(folder, until)
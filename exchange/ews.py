@@ -0,0 +1,56 @@
+"""Connection to Exchange
+
+exchangelib is slow to import, so this module is only imported once a
+download or purge actually talks to the server.
+"""
+import datetime
+
+from exchangelib import (
+    Account,
+    Configuration,
+    Credentials,
+    DELEGATE,
+    EWSDateTime,
+    FaultTolerance,
+    UTC,
+)
+
+
+def connect(email, password, server_name=None, username=None, max_wait=3600):
+    """Connect to Exchange account, waiting up to max_wait seconds when throttled
+
+    :param email: Primary e-mail address of account
+    :param password: Password
+    :param server_name: Server to connect to, autodiscover unless given along
+        with username
+    :param username: Username on server, e.g. DOMAIN\\user
+    :param max_wait: Seconds to retry a throttled or unavailable server
+    :return: Account
+    """
+    retry_policy = FaultTolerance(max_wait=max_wait)
+    if all((server_name, username, email)):
+        credentials = Credentials(username=username, password=password)
+        config = Configuration(
+            server=server_name,
+            credentials=credentials,
+            retry_policy=retry_policy,
+        )
+        return Account(
+            primary_smtp_address=email,
+            config=config,
+            autodiscover=False,
+            access_type=DELEGATE,
+        )
+    credentials = Credentials(email, password)
+    config = Configuration(credentials=credentials, retry_policy=retry_policy)
+    return Account(email, credentials=credentials, config=config, autodiscover=True)
+
+
+def ews_datetime(value: datetime.datetime) -> EWSDateTime:
+    """Convert datetime as stored, in UTC without timezone, for EWS queries"""
+    return EWSDateTime.from_datetime(value.replace(tzinfo=UTC))
+
+
+def ews_now() -> EWSDateTime:
+    """Current time for EWS queries"""
+    return EWSDateTime.now(tz=UTC)
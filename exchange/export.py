@@ -0,0 +1,272 @@
+"""Export of stored e-mails to files"""
+import datetime
+import io
+import mailbox
+import os
+import re
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.utils import format_datetime
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from richlog import log
+
+MAX_NAME_LENGTH = 150
+# parquet and arrow hold metadata only, see exchange.columnar
+EXPORT_FORMATS = ("html", "mbox", "maildir", "tar.gz", "tar.zst", "parquet", "arrow")
+
+
+def record_filename(r: dict) -> str:
+    """Unique filename of a record, the record id keeps names apart
+
+    :param r: Mail record as dict including id
+    :return: Filename
+    """
+    sender = re.sub(r"[^\w@.-]", "", next(iter((r["sender"] or "").split()), ""))
+    subject = "_".join((r["subject"] or "").split()[:10])
+    fn_ = f"{r['datetime'].strftime('%y%m%d_%H%M')}"
+    fn_ += f"__{sender}__"
+    fn_ += re.sub(r"[^\w]", "", subject)
+    return f"{fn_[:MAX_NAME_LENGTH]}__{r['id']}.html"
+
+
+def html_document(body: str) -> str:
+    """Make body a HTML document if it is plain text
+
+    :param body: Body of e-mail
+    :return: HTML
+    """
+    t = body or ""
+    if "<html" not in t:
+        t = f'<meta http-equiv="Content-Type" content="text/html" charset="utf-8"/>{t}'.replace(
+            "\n", "<br>"
+        )
+    return t
+
+
+def write_file(f: Path, data) -> None:
+    """Write text or bytes atomically so an interrupted export leaves no partial file"""
+    tmp = f.with_name(f"{f.name}.tmp")
+    if isinstance(data, str):
+        tmp.write_text(data, encoding="utf-8")
+    else:
+        tmp.write_bytes(data)
+    os.replace(tmp, f)
+
+
+def attachment_filenames(names: Iterable[str]) -> list:
+    """Safe and unique filenames of the attachments of an e-mail"""
+    filenames = []
+    for name in names:
+        stem, dot, suffix = re.sub(r"[^\w. -]", "_", Path(name).name).rpartition(".")
+        filename, n = f"{stem}{dot}{suffix}".strip(". ") or "attachment", 1
+        while filename in filenames:
+            n += 1
+            filename = f"{stem}_{n}{dot}{suffix}" if dot else f"{suffix}_{n}"
+        filenames.append(filename)
+    return filenames
+
+
+def write_record(f: Path, text: str, attachments: list) -> None:
+    """Write html file and a folder of its attachments next to it
+
+    The html file is written last, marking the record as exported.
+    """
+    if attachments:
+        folder = f.with_suffix("")
+        folder.mkdir(exist_ok=True)
+        names = attachment_filenames(name for name, _ in attachments)
+        for name, (_, content) in zip(names, attachments):
+            write_file(folder / name, content)
+    write_file(f, text)
+
+
+def export_html(
+    records: Iterable[dict],
+    out: str,
+    workers: int = 4,
+    attachments: Optional[Callable] = None,
+) -> int:
+    """Write records as html files using a pool of threads
+
+    Records are consumed as they are read and files already exported are
+    skipped, so an interrupted export resumes where it stopped.
+
+    :param records: Mail records as dicts including id
+    :param out: Path to export to
+    :param workers: Number of files written in parallel
+    :param attachments: Function returning (name, content) of attachments by id
+    :return: Number of files written
+    """
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    existing = {p.name for p in out.iterdir()}
+    in_flight = threading.BoundedSemaphore(workers * 4)
+    errors = []
+    written, skipped = 0, 0
+    started = time.monotonic()
+
+    def done(future):
+        in_flight.release()
+        if future.exception():
+            errors.append(future.exception())
+
+    with ThreadPoolExecutor(workers) as pool:
+        for r in records:
+            name = record_filename(r)
+            if name in existing:
+                skipped += 1
+                continue
+            if errors:
+                break
+            files = attachments(r["id"]) if attachments else []
+            in_flight.acquire()
+            log.debug(f"writing {name}")
+            pool.submit(
+                write_record, out / name, html_document(r["body"]), files
+            ).add_done_callback(done)
+            written += 1
+    if errors:
+        raise errors[0]
+    elapsed = max(time.monotonic() - started, 1e-6)
+    log.info(
+        f"exported {written} e-mails to {out} ({skipped} already exported) "
+        f"in {elapsed:.1f}s ({written / elapsed:.1f} e-mails/s)"
+    )
+    return written
+
+
+def record_message(r: dict) -> EmailMessage:
+    """Build an e-mail message of a record
+
+    :param r: Mail record as dict
+    :return: Message
+    """
+    msg = EmailMessage()
+    headers = {
+        "From": r["sender"],
+        "To": r["to"],
+        "Cc": r["cc"] if r["cc"] != "None" else None,
+        "Subject": r["subject"],
+        "Message-ID": r["message_id"],
+        "X-Folder": r["folder"],
+    }
+    for header, value in headers.items():
+        if value:
+            msg[header] = " ".join(value.split())
+    msg["Date"] = format_datetime(r["datetime"].replace(tzinfo=datetime.timezone.utc))
+    body = r["body"] or ""
+    msg.set_content(body, subtype="html" if "<html" in body.lower() else "plain")
+    return msg
+
+
+def timestamp(r: dict) -> float:
+    """Time e-mail was received as UNIX timestamp"""
+    return r["datetime"].replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def export_mbox(records: Iterable[dict], out: str) -> int:
+    """Write records into a single mbox file, replacing an existing one
+
+    :param records: Mail records as dicts
+    :param out: Path of mbox file
+    :return: Number of e-mails written
+    """
+    tmp = f"{out}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    box = mailbox.mbox(tmp)
+    count = 0
+    for r in records:
+        message = mailbox.mboxMessage(record_message(r))
+        message.set_from("MAILER-DAEMON", time.gmtime(timestamp(r)))
+        box.add(message)
+        count += 1
+    box.close()
+    os.replace(tmp, out)
+    return count
+
+
+def export_maildir(records: Iterable[dict], out: str) -> int:
+    """Add records to a Maildir, e-mails are marked as seen
+
+    :param records: Mail records as dicts
+    :param out: Path of Maildir
+    :return: Number of e-mails written
+    """
+    box = mailbox.Maildir(out, create=True)
+    count = 0
+    for r in records:
+        message = mailbox.MaildirMessage(record_message(r))
+        message.set_subdir("cur")
+        message.set_flags("S")
+        message.set_date(timestamp(r))
+        box.add(message)
+        count += 1
+    return count
+
+
+def export_tar(records: Iterable[dict], out: str, compression: str = "gz") -> int:
+    """Write records as html files into a compressed tarball
+
+    :param records: Mail records as dicts including id
+    :param out: Path of tarball
+    :param compression: Either gz or zst (requires zstandard)
+    :return: Number of e-mails written
+    """
+    if compression == "zst":
+        try:
+            import zstandard
+        except ImportError:
+            log.error("zstandard is not installed, unable to export tar.zst")
+            return 0
+    tmp = f"{out}.tmp"
+    count = 0
+    with open(tmp, "wb") as f:
+        if compression == "zst":
+            stream = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+            tar = tarfile.open(fileobj=stream, mode="w|")
+        else:
+            stream = None
+            tar = tarfile.open(fileobj=f, mode="w|gz")
+        with tar:
+            for r in records:
+                data = html_document(r["body"]).encode("utf-8")
+                info = tarfile.TarInfo(record_filename(r))
+                info.size = len(data)
+                info.mtime = timestamp(r)
+                tar.addfile(info, io.BytesIO(data))
+                count += 1
+        if stream:
+            stream.close()
+    os.replace(tmp, out)
+    return count
+
+
+def export_archive(records: Iterable[dict], out: str, export_format: str) -> int:
+    """Write records sequentially into one of the archive formats
+
+    :param records: Mail records as dicts including id
+    :param out: Path to export to
+    :param export_format: mbox, maildir, tar.gz or tar.zst
+    :return: Number of e-mails written
+    """
+    started = time.monotonic()
+    if export_format == "mbox":
+        count = export_mbox(records, out)
+    elif export_format == "maildir":
+        count = export_maildir(records, out)
+    elif export_format in ("tar.gz", "tar.zst"):
+        count = export_tar(records, out, export_format.split(".")[-1])
+    else:
+        raise ValueError(f"unknown export format {export_format}")
+    elapsed = max(time.monotonic() - started, 1e-6)
+    log.info(
+        f"exported {count} e-mails to {export_format} {out} "
+        f"in {elapsed:.1f}s ({count / elapsed:.1f} e-mails/s)"
+    )
+    return count
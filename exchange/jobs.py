@@ -0,0 +1,133 @@
+"""Downloads and exports run in the background of the interactive menu"""
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from richlog import log
+
+
+class Cancelled(Exception):
+    """Raised within a job once it was cancelled"""
+
+
+def duration(seconds: float) -> str:
+    """Seconds as H:MM:SS"""
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class Job:
+    """Runs a function in a worker thread, keeping track of its progress
+
+    The function reports progress through expect() and step(). Once the job
+    is cancelled step() raises Cancelled, unwinding the function through its
+    finally blocks, e.g. storing e-mails pending in the writer. Log records
+    of the worker thread are kept as the job's message instead of being
+    printed over the menu.
+
+    :param name: Name shown in the status line
+    :param func: Function run in the background
+    :param unit: What is counted, e.g. e-mails
+    """
+
+    def __init__(self, name: str, func: Callable, unit: str = "e-mails"):
+        self.name = name
+        self.func = func
+        self.unit = unit
+        self.total = 0
+        self.done = 0
+        self.message = ""
+        self.state = None
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.started = self.ended = None
+
+    def start(self) -> "Job":
+        """Start running the function in the background"""
+        log.addFilter(self.capture)
+        self.started, self.state = time.monotonic(), "running"
+        self.thread.start()
+        return self
+
+    def run(self) -> None:
+        try:
+            self.result = self.func()
+            self.state = "finished"
+        except Cancelled:
+            self.state = "cancelled"
+        except Exception as e:
+            self.error, self.state = e, "failed"
+            self.message = repr(e)
+        finally:
+            self.ended = time.monotonic()
+            log.removeFilter(self.capture)
+
+    def capture(self, record: logging.LogRecord) -> bool:
+        """Log filter keeping records of the worker thread as message"""
+        if record.thread != self.thread.ident:
+            return True
+        self.message = record.getMessage()
+        return False
+
+    @property
+    def current(self) -> bool:
+        """Whether called from the worker thread"""
+        return threading.current_thread() is self.thread
+
+    def expect(self, count: int) -> None:
+        """Add to the number of items the job is to process"""
+        self.total += count
+
+    def step(self, count: int = 1) -> None:
+        """Count items processed, raising Cancelled once the job was cancelled"""
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.done += count
+
+    def cancel(self) -> None:
+        """Ask the job to stop at its next step"""
+        self.cancelled.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait for the job to end, return whether it did"""
+        self.thread.join(timeout)
+        return not self.running
+
+    @property
+    def running(self) -> bool:
+        return self.thread.is_alive()
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return max((self.ended or time.monotonic()) - self.started, 1e-6)
+
+    @property
+    def rate(self) -> float:
+        """Items processed per second"""
+        return self.done / self.elapsed if self.started else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds until all items expected are processed, if known"""
+        if not self.rate or self.total <= self.done:
+            return None
+        return (self.total - self.done) / self.rate
+
+    def status(self) -> str:
+        """One line of progress, rate and ETA, or how the job ended"""
+        if self.state != "running" or not self.running:
+            line = f"{self.name} {self.state}: {self.done:,} {self.unit} in "
+            line += duration(self.elapsed)
+            return f"{line} - {self.message}" if self.state == "failed" else line
+        done = f"{self.done:,}/{self.total:,}" if self.total else f"{self.done:,}"
+        line = f"{self.name}: {done} {self.unit}, {self.rate:.1f}/s"
+        if self.eta is not None:
+            line += f", ETA {duration(self.eta)}"
+        if self.cancelled.is_set():
+            line += " (cancelling)"
+        return f"{line} - {self.message}" if self.message else line
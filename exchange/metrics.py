@@ -0,0 +1,181 @@
+"""Timing of the download pipeline stages
+
+Latencies of each stage, e.g. fetching from EWS, extracting fields, the
+duplicate check and inserting, are collected in histograms. A summary line
+is logged periodically and the metrics can be written as JSON or as a
+Prometheus textfile for the node exporter.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from richlog import log
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"),
+)
+PREFIX = "mail_export"
+
+
+class Histogram:
+    """Counts of observed latencies per bucket"""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[next(i for i, b in enumerate(BUCKETS) if seconds <= b)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """Estimate quantile as the upper bound of the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            max=self.max,
+            p50=self.quantile(0.5),
+            p95=self.quantile(0.95),
+            buckets={str(b): c for b, c in zip(BUCKETS, self.counts)},
+        )
+
+
+class Metrics:
+    """Thread-safe latency histograms by stage and counters
+
+    :param interval: Seconds between summary lines, 0 to disable them
+    :param path: Write metrics to this file with each summary, as a Prometheus
+        textfile if it ends with .prom, JSON otherwise
+    """
+
+    def __init__(self, interval: float = 10.0, path: Optional[str] = None):
+        self.interval = interval
+        self.path = path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Start over, e.g. when a download starts"""
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.started = time.monotonic()
+            self.last_report = self.started
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Add latency of one pass through stage"""
+        with self.lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        """Time the enclosed block as one pass through stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed_iter(self, stage: str, items: Iterable) -> Iterator:
+        """Iterate items, timing how long each one takes to get"""
+        items = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            self.observe(stage, time.perf_counter() - started)
+            yield item
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @property
+    def rate(self) -> float:
+        """Downloaded e-mails per second"""
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return self.counters.get("downloaded", 0) / elapsed
+
+    def summary(self) -> str:
+        """One line of e-mails per second and latencies by stage"""
+        with self.lock:
+            stages = [
+                f"{stage} p50 {h.quantile(0.5) * 1000:.1f}ms "
+                f"p95 {h.quantile(0.95) * 1000:.1f}ms "
+                f"total {h.sum:.1f}s"
+                for stage, h in self.stages.items()
+            ]
+        return " | ".join([f"{self.rate:.1f} e-mails/s"] + stages)
+
+    def report(self, force: bool = False) -> None:
+        """Log summary line and write metrics file once the interval passed"""
+        now = time.monotonic()
+        due = self.interval and now - self.last_report >= self.interval
+        if not (force or due):
+            return
+        self.last_report = now
+        log.info(self.summary())
+        if self.path:
+            self.write(self.path)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return dict(
+                elapsed=time.monotonic() - self.started,
+                emails_per_second=self.rate,
+                counters=dict(self.counters),
+                stages={stage: h.as_dict() for stage, h in self.stages.items()},
+            )
+
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        name = f"{PREFIX}_stage_seconds"
+        lines = [f"# TYPE {name} histogram"]
+        with self.lock:
+            for stage, h in self.stages.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+            lines.append(f"# TYPE {PREFIX}_emails_total counter")
+            for state, value in self.counters.items():
+                lines.append(f'{PREFIX}_emails_total{{state="{state}"}} {value}')
+        lines.append(f"# TYPE {PREFIX}_emails_per_second gauge")
+        lines.append(f"{PREFIX}_emails_per_second {self.rate}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Write metrics atomically, the node exporter may read any time"""
+        path = Path(path)
+        if path.suffix == ".prom":
+            data = self.prometheus()
+        else:
+            data = json.dumps(self.as_dict(), indent=2)
+        tmp = path.with_name(f"{path.name}.tmp")
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, path)
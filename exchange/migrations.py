@@ -0,0 +1,238 @@
+"""Upgrades of databases created by older versions
+
+Each migration upgrades the schema by one version, the version of a database
+is kept in SQLite's user_version.
+"""
+from pathlib import Path
+
+from peewee import SqliteDatabase, fn
+from playhouse.migrate import SqliteMigrator, migrate
+from rich.progress import track
+
+from richlog import log
+from .addresses import backfill_recipients
+from .models import Address, FolderStats, Mail, Recipient
+from .stats import create_triggers, rebuild_stats, replace_triggers
+from .writer import DIGEST_FIELDS, MailWriter
+
+
+def migrate_database(db) -> int:
+    """Run migrations not yet applied to database
+
+    A database without tables is created with the current schema and needs
+    no migrations.
+
+    :param db: Database to upgrade
+    :return: Schema version of database
+    """
+    version = db.pragma("user_version")
+    if "mail" not in db.get_tables():
+        version = len(MIGRATIONS)
+        db.pragma("user_version", version)
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        log.info(f"upgrading database to version {number} ({migration.__name__})")
+        migration(db)
+        db.pragma("user_version", number)
+        version = number
+    return version
+
+
+def add_dedup_columns(db) -> None:
+    """Add message id and content digest columns to stored e-mails"""
+    columns = {c.name for c in db.get_columns("mail")}
+    migrator = SqliteMigrator(db)
+    operations = [
+        migrator.add_column("mail", f.column_name, f)
+        for f in (Mail.message_id, Mail.digest)
+        if f.column_name not in columns
+    ]
+    if operations:
+        with db.atomic():
+            migrate(*operations)
+    backfill_digests(db)
+
+
+def backfill_digests(db, batch_size: int = 500) -> int:
+    """Calculate content digest of stored e-mails lacking one
+
+    Rows with the same content as one already having the digest are
+    duplicates and are left without.
+
+    :param db: Database to upgrade
+    :param batch_size: Number of records updated per transaction
+    :return: Number of records updated
+    """
+    missing = Mail.digest.is_null()
+    total = Mail.select().where(missing).count()
+    if not total:
+        return 0
+    updated, last_id = 0, 0
+    for _ in track(range(0, total, batch_size), description="Hashing e-mails"):
+        # columns of later migrations are missing yet
+        columns = [Mail.id] + [getattr(Mail, f) for f in DIGEST_FIELDS]
+        batch = list(
+            Mail.select(*columns)
+            .where(missing & (Mail.id > last_id))
+            .order_by(Mail.id)
+            .limit(batch_size)
+            .dicts()
+        )
+        if not batch:
+            break
+        last_id = batch[-1]["id"]
+        keys = {r["id"]: MailWriter.key(r) for r in batch}
+        query = Mail.select(Mail.digest).where(Mail.digest.in_(set(keys.values())))
+        seen = {r.digest for r in query}
+        with db.atomic():
+            for id_, key in keys.items():
+                if key not in seen:
+                    seen.add(key)
+                    Mail.update(digest=key).where(Mail.id == id_).execute()
+                    updated += 1
+    log.info(f"calculated digest of {updated} stored e-mails")
+    return updated
+
+
+def create_mail_indexes(db) -> None:
+    """Create missing indexes of stored e-mails on columns added so far"""
+    columns = {c.name for c in db.get_columns("mail")}
+    for index in Mail._meta.fields_to_index():
+        if {f.column_name for f in index._expressions} <= columns:
+            db.execute(Mail._schema._create_index(index, safe=True))
+
+
+def add_mail_indexes(db) -> None:
+    """Add indexes on datetime and folder of stored e-mails"""
+    with db.atomic():
+        create_mail_indexes(db)
+
+
+def compress_bodies(db, batch_size: int = 500) -> None:
+    """Compress bodies of stored e-mails"""
+    plain = fn.typeof(Mail.body) == "text"
+    total = Mail.select().where(plain).count()
+    before, after, last_id = 0, 0, 0
+    for _ in track(range(0, total, batch_size), description="Compressing e-mails"):
+        batch = list(
+            Mail.select(Mail.id, Mail.body)
+            .where(plain & (Mail.id > last_id))
+            .order_by(Mail.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        with db.atomic():
+            for id_, body in batch:
+                compressed = Mail.body.db_value(body)
+                Mail.update(body=compressed).where(Mail.id == id_).execute()
+                before += len(body.encode("utf-8"))
+                after += len(compressed)
+    if not total:
+        return
+    # VACUUM rewrites the whole file, left to the user as it may take minutes
+    free = db.pragma("freelist_count") * db.pragma("page_size")
+    log.info(
+        f"compressed {total} bodies from {before / 2 ** 20:.1f} MB "
+        f"to {after / 2 ** 20:.1f} MB, run mail_export --vacuum to reclaim "
+        f"{free / 2 ** 20:.1f} MB of the database file"
+    )
+
+
+def add_folder_stats(db) -> None:
+    """Add statistics of stored e-mails kept by triggers"""
+    db.create_tables([FolderStats])
+    create_triggers(db)
+    rebuild_stats(db)
+
+
+def add_mail_account(db) -> None:
+    """Add account column so e-mails of several accounts can share a database"""
+    if "account" not in {c.name for c in db.get_columns("mail")}:
+        with db.atomic():
+            migrate(SqliteMigrator(db).add_column("mail", "account", Mail.account))
+
+
+def add_recipients(db) -> None:
+    """Add normalized senders and recipients of stored e-mails"""
+    db.create_tables([Address, Recipient])
+    backfill_recipients(db)
+
+
+def fix_folder_stats(db) -> None:
+    """Key statistics of e-mails without folder the same way in every trigger"""
+    with db.atomic():
+        replace_triggers(db)
+    rebuild_stats(db)
+
+
+def scope_dedup_by_account(db) -> None:
+    """Keep e-mails of accounts sharing a database apart: message ids are
+    unique per account and digests include the account
+
+    Partitions are upgraded along with the database holding their catalog,
+    except read-only ones which are never written again. Their e-mails were
+    stored along with message ids once accounts were recorded, which still
+    find them as duplicates.
+    """
+    databases = [db]
+    if "partition" in db.get_tables():
+        directory = Path(db.database).parent
+        partitions = db.execute_sql("SELECT path, read_only FROM partition")
+        for path, read_only in partitions:
+            if read_only:
+                log.warning(f"partition {path} is read-only, leaving it unchanged")
+            elif not (directory / path).exists():
+                log.warning(f"partition {path} is missing, unable to upgrade it")
+            else:
+                databases.append(SqliteDatabase(str(directory / path)))
+    for database in databases:
+        with database.bind_ctx([Mail]):
+            with database.atomic():
+                database.execute_sql("DROP INDEX IF EXISTS mail_message_id")
+                create_mail_indexes(database)
+            redigest_accounts(database)
+        if database is not db:
+            database.close()
+
+
+def redigest_accounts(db, batch_size: int = 500) -> int:
+    """Calculate digest of stored e-mails having an account again, including it
+
+    :param db: Database to upgrade
+    :param batch_size: Number of records updated per transaction
+    :return: Number of records updated
+    """
+    owned = Mail.account.is_null(False) & Mail.digest.is_null(False)
+    total = Mail.select().where(owned).count()
+    columns = [Mail.id, Mail.account] + [getattr(Mail, f) for f in DIGEST_FIELDS]
+    last_id = 0
+    for _ in track(range(0, total, batch_size), description="Hashing e-mails"):
+        batch = list(
+            Mail.select(*columns)
+            .where(owned & (Mail.id > last_id))
+            .order_by(Mail.id)
+            .limit(batch_size)
+            .dicts()
+        )
+        if not batch:
+            break
+        last_id = batch[-1]["id"]
+        with db.atomic():
+            for r in batch:
+                query = Mail.update(digest=MailWriter.key(r))
+                query.where(Mail.id == r["id"]).execute()
+    return total
+
+
+MIGRATIONS = [
+    add_dedup_columns,
+    add_mail_indexes,
+    compress_bodies,
+    add_folder_stats,
+    add_mail_account,
+    add_recipients,
+    fix_folder_stats,
+    scope_dedup_by_account,
+]
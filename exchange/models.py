@@ -0,0 +1,194 @@
+"""Database models"""
+import zlib
+
+from peewee import *
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
+
+database_proxy = DatabaseProxy()
+# bound parameters per statement, SQLite before 3.32 allows 999
+SQLITE_MAX_VARIABLES = 900
+
+
+class CompressedTextField(BlobField):
+    """Text stored zlib compressed, rows stored as plain text are read as is"""
+
+    def db_value(self, value):
+        if value is None or isinstance(value, (bytes, memoryview)):
+            return super().db_value(value)
+        return super().db_value(zlib.compress(value.encode("utf-8")))
+
+    def python_value(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return zlib.decompress(value).decode("utf-8")
+
+
+class Mail(Model):
+    datetime = DateTimeField(index=True)
+    to = TextField()
+    sender = TextField()
+    cc = TextField(null=True)
+    subject = TextField(null=True)
+    body = CompressedTextField(null=True)
+    folder = TextField(null=True)
+    account = TextField(null=True)
+    message_id = TextField(null=True, index=True)
+    # digest of content and account, see MailWriter.key
+    digest = CharField(null=True, unique=True)
+
+    class Meta:
+        database = database_proxy
+        indexes = (
+            # also serves lookups by folder only
+            (("folder", "datetime"), False),
+            # accounts sharing a database each store their copy of an e-mail
+            (("account", "message_id"), True),
+        )
+
+
+class Blob(Model):
+    """Content of attachments, stored once however many e-mails have it"""
+
+    digest = CharField(primary_key=True)
+    size = IntegerField()
+    content = BlobField()
+
+    class Meta:
+        database = database_proxy
+
+
+class Attachment(Model):
+    """File attached to an e-mail"""
+
+    mail = ForeignKeyField(Mail, backref="attachments", on_delete="CASCADE")
+    name = TextField()
+    content_type = TextField(null=True)
+    blob = ForeignKeyField(Blob, backref="attachments")
+
+    class Meta:
+        database = database_proxy
+
+
+class Address(Model):
+    """Sender or recipient, address is the lower case e-mail address or the
+    display name when no address is known (cc of older downloads)"""
+
+    address = TextField(unique=True)
+    name = TextField(null=True)
+
+    class Meta:
+        database = database_proxy
+
+
+class Recipient(Model):
+    """Addresses of an e-mail by role, from, to or cc"""
+
+    mail = ForeignKeyField(Mail, backref="recipients", on_delete="CASCADE")
+    address = ForeignKeyField(Address, backref="recipients")
+    role = CharField()
+
+    class Meta:
+        database = database_proxy
+        indexes = ((("address", "role", "mail"), True),)
+
+
+class SyncState(Model):
+    """Newest e-mail received per account and folder at last completed download"""
+
+    account = TextField()
+    folder = TextField()
+    last_received = DateTimeField()
+    synced = DateTimeField()
+
+    class Meta:
+        database = database_proxy
+        indexes = ((("account", "folder"), True),)
+
+
+class Checkpoint(Model):
+    """Progress of an interrupted download per account and folder
+
+    E-mails are downloaded newest first, all e-mails received from since up
+    to until were stored when the download stopped.
+    """
+
+    account = TextField()
+    folder = TextField()
+    since = DateTimeField(null=True)
+    until = DateTimeField()
+    started = DateTimeField()
+    updated = DateTimeField()
+
+    class Meta:
+        database = database_proxy
+        indexes = ((("account", "folder"), True),)
+
+
+class FailedItem(Model):
+    """E-mail which failed to download, kept to be retried by id"""
+
+    account = TextField()
+    folder = TextField()
+    item_id = TextField(null=True, unique=True)
+    changekey = TextField(null=True)
+    error = TextField()
+    failed = DateTimeField()
+    attempts = IntegerField(default=1)
+
+    class Meta:
+        database = database_proxy
+
+
+class FolderStats(Model):
+    """Number and datetime range of stored e-mails per folder, kept up to date
+    by triggers on mail (see stats.py)"""
+
+    folder = TextField(primary_key=True)  # "" for e-mails without folder
+    count = IntegerField()
+    first = DateTimeField(null=True)
+    last = DateTimeField(null=True)
+
+    class Meta:
+        database = database_proxy
+
+
+class Partition(Model):
+    """Database file holding e-mails moved out of this database, by year or
+    folder (see partitions.py)"""
+
+    name = TextField(unique=True)
+    path = TextField()  # relative to the directory of this database
+    read_only = BooleanField(default=False)
+    min_id = IntegerField()
+    max_id = IntegerField()
+
+    class Meta:
+        database = database_proxy
+
+
+class PartitionStats(Model):
+    """FolderStats of a partition, to pick partitions without opening them"""
+
+    partition = ForeignKeyField(Partition, backref="stats", on_delete="CASCADE")
+    folder = TextField()  # "" for e-mails without folder
+    count = IntegerField()
+    first = DateTimeField(null=True)
+    last = DateTimeField(null=True)
+
+    class Meta:
+        database = database_proxy
+        indexes = ((("partition", "folder"), True),)
+
+
+class MailIndex(FTS5Model):
+    """Full-text index of Mail, rowid is shared with Mail.id"""
+
+    rowid = RowIDField()
+    sender = SearchField()
+    to = SearchField()
+    subject = SearchField()
+    text = SearchField()
+
+    class Meta:
+        database = database_proxy
+        options = {"tokenize": "unicode61 remove_diacritics 2", "prefix": "'2 3'"}
@@ -0,0 +1,385 @@
+"""E-mails partitioned into one SQLite file per year or folder
+
+The database given by --database stays the one downloads are stored to.
+E-mails received before a cutoff are moved into partition files next to it,
+which are listed in its Partition table along with the statistics of each,
+so a query only opens those partitions matching the folder and date range
+filtered on. Partitions of years before the cutoff no longer change and are
+opened read-only and immutable, letting SQLite skip locking.
+"""
+import datetime
+import heapq
+import itertools
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable
+
+from peewee import SqliteDatabase, fn
+
+from richlog import log
+from .models import (
+    Address,
+    Attachment,
+    Blob,
+    FolderStats,
+    Mail,
+    MailIndex,
+    Partition,
+    PartitionStats,
+    Recipient,
+)
+from .stats import create_triggers
+
+PARTITION_SCHEMES = ("year", "folder")
+# partition of each e-mail, in SQL
+PARTITION_KEYS = {"year": "strftime('%Y', datetime)", "folder": "IFNULL(folder, '')"}
+# tables partitions have, account state stays in the database downloaded to
+PARTITION_MODELS = [Mail, FolderStats, Blob, Attachment, Address, Recipient]
+MOVING = "SELECT id FROM temp.moving"
+
+
+def columns(model, primary_key: bool = True) -> str:
+    """Quoted column names of a model, in the order of its fields"""
+    return ", ".join(
+        f'"{f.column_name}"'
+        for f in model._meta.sorted_fields
+        if primary_key or f is not model._meta.primary_key
+    )
+
+
+def partition_filename(scheme: str, key: str) -> str:
+    """File name of a partition, folder names made safe"""
+    name = re.sub(r"[^\w.-]", "_", key) if scheme == "folder" else key
+    return f"{scheme}-{name or '_'}.sqlite"
+
+
+def create_partition(path: Path, fts: bool) -> None:
+    """Create a partition database with the schema of stored e-mails"""
+    from .migrations import MIGRATIONS
+
+    db = SqliteDatabase(str(path))
+    models = PARTITION_MODELS + ([MailIndex] if fts else [])
+    with db.bind_ctx(models):
+        db.create_tables(models)
+    create_triggers(db)
+    db.pragma("user_version", len(MIGRATIONS))
+    db.close()
+
+
+class MergedRecords:
+    """Records of a query in several databases, newest first or by relevance
+
+    Like a query the records are read again each time they are iterated.
+    Relevance is ranked by each database on its own, so ranks of databases
+    holding few matching e-mails are less precise.
+
+    :param query: Query of e-mails
+    :param databases: Databases to run the query in
+    :param count: Number of records, as counted before
+    :param ranked: Query searches the full-text index, merge by rank
+    """
+
+    def __init__(self, query, databases: list, count: int, ranked: bool = False):
+        if ranked:
+            rank = MailIndex.rank()
+            query = query.select_extend(rank.alias("rank")).order_by(rank, Mail.id)
+            self.key, self.reverse = (lambda r: (r["rank"], r["id"])), False
+        else:
+            query = query.order_by(Mail.datetime.desc(), Mail.id.desc())
+            self.key, self.reverse = (lambda r: (r["datetime"], r["id"])), True
+        self.query = query.dicts()
+        self.databases = databases
+        self.count = count
+
+    def __iter__(self):
+        return heapq.merge(
+            *(self.query.clone().iterator(db) for db in self.databases),
+            key=self.key,
+            reverse=self.reverse,
+        )
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class Partitions:
+    """Partitions of e-mails moved out of a database, queried in parallel
+
+    :param db: Database downloaded to, holding the catalog of partitions
+    :param filename: Path of that database, partitions are stored next to it
+    :param workers: Number of partitions queried in parallel
+    """
+
+    def __init__(self, db, filename: str, workers: int = 4):
+        self.db = db
+        self.directory = Path(filename).parent
+        self.workers = workers
+        self.databases = {}
+        self.pool = None
+
+    def __bool__(self) -> bool:
+        """Whether any e-mails were moved to partitions"""
+        return Partition.select().exists()
+
+    def catalog(self) -> list:
+        """All partitions"""
+        return list(Partition.select().order_by(Partition.name))
+
+    def select(self, folder=None, since=None, until=None) -> list:
+        """Partitions holding e-mails of folder received within since and until
+
+        :param folder: Folder, all if not given
+        :param since: Earliest datetime of e-mails
+        :param until: Latest datetime of e-mails
+        :return: List of Partition
+        """
+        criteria = [PartitionStats.count > 0]
+        if folder:
+            criteria.append(PartitionStats.folder == folder)
+        if since:
+            criteria.append(PartitionStats.last >= since)
+        if until:
+            criteria.append(PartitionStats.first <= until)
+        return list(
+            Partition.select()
+            .join(PartitionStats)
+            .where(*criteria)
+            .distinct()
+            .order_by(Partition.name)
+        )
+
+    def database(self, partition: Partition) -> SqliteDatabase:
+        """Database of a partition, opened once"""
+        if partition.name not in self.databases:
+            path = (self.directory / partition.path).absolute()
+            if partition.read_only:
+                uri = f"{path.as_uri()}?mode=ro&immutable=1"
+                self.databases[partition.name] = SqliteDatabase(uri, uri=True)
+            else:
+                db = SqliteDatabase(str(path), timeout=60)
+                self.databases[partition.name] = db
+        return self.databases[partition.name]
+
+    def close(self) -> None:
+        """Close databases of partitions, e.g. after they changed"""
+        for db in self.databases.values():
+            db.close()
+        self.databases = {}
+
+    def fan_out(self, func: Callable, partitions: Iterable[Partition]) -> list:
+        """Call func with the database downloaded to and those of partitions
+
+        Partitions are queried by a pool of threads while the database
+        downloaded to is queried by the calling thread, which holds its
+        connection.
+
+        :param func: Function of a database
+        :param partitions: Partitions to query
+        :return: Results, the one of the database downloaded to first
+        """
+        partitions = list(partitions)
+        if not partitions:
+            return [func(self.db)]
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        futures = [self.pool.submit(func, self.database(p)) for p in partitions]
+        return [func(self.db)] + [f.result() for f in futures]
+
+    def page(
+        self, query, partitions: Iterable[Partition], after: tuple = None, size=100
+    ) -> list:
+        """One page of records of query, newest first, from the database
+        downloaded to and partitions
+
+        :param query: Query of e-mails, selecting the columns of the page
+        :param partitions: Partitions to query
+        :param after: datetime and id of last record on previous page
+        :param size: Number of records per page
+        :return: List of records
+        """
+        query = query.order_by(Mail.datetime.desc(), Mail.id.desc())
+        if after:
+            dt, id_ = after
+            query = query.where(
+                (Mail.datetime < dt) | ((Mail.datetime == dt) & (Mail.id < id_))
+            )
+        query = query.limit(size).dicts()
+        pages = self.fan_out(lambda db: list(query.clone().execute(db)), partitions)
+        records = self.merge(
+            pages, key=lambda r: (r["datetime"], r["id"]), reverse=True
+        )
+        return list(itertools.islice(records, size))
+
+    @staticmethod
+    def merge(results: Iterable[Iterable], key: Callable, reverse: bool = False):
+        """Merge results sorted by key into one sorted iterator"""
+        return heapq.merge(*results, key=key, reverse=reverse)
+
+    def locate(self, record_id: int) -> SqliteDatabase:
+        """Database holding an e-mail, the one downloaded to unless the e-mail
+        was moved to a partition"""
+        # exists() of peewee ignores the database given
+        query = Mail.select(Mail.id).where(Mail.id == record_id)
+        if query.scalar(self.db) is not None:
+            return self.db
+        for partition in Partition.select().where(
+            (Partition.min_id <= record_id) & (Partition.max_id >= record_id)
+        ):
+            if query.scalar(self.database(partition)) is not None:
+                return self.database(partition)
+        return self.db
+
+    @staticmethod
+    def summary() -> tuple:
+        """Return count, first and last datetime of e-mails in partitions"""
+        count, first, last = PartitionStats.select(
+            fn.SUM(PartitionStats.count),
+            fn.MIN(PartitionStats.first),
+            fn.MAX(PartitionStats.last),
+        ).scalar(as_tuple=True)
+        return count or 0, first, last
+
+    @staticmethod
+    def folder_counts() -> dict:
+        """Return number of e-mails in partitions by folder"""
+        query = PartitionStats.select(
+            PartitionStats.folder, fn.SUM(PartitionStats.count)
+        ).group_by(PartitionStats.folder)
+        return {folder or None: count for folder, count in query.tuples()}
+
+    @staticmethod
+    def max_id() -> int:
+        """Highest id of e-mails moved to partitions"""
+        return Partition.select(fn.MAX(Partition.max_id)).scalar() or 0
+
+    def move(self, scheme: str = "year", before: datetime.datetime = None) -> int:
+        """Move e-mails received before a cutoff into partitions
+
+        E-mails keep their id, also in the full-text index. Partitions of
+        years ending before the cutoff are marked read-only and never written
+        again, as readers open them immutable. E-mails of those years stored
+        later, e.g. by a full resync, stay in the database downloaded to.
+
+        :param scheme: Partition by year or by folder
+        :param before: Cutoff, the start of the current year if not given
+        :return: Number of e-mails moved
+        """
+        if scheme not in PARTITION_SCHEMES:
+            raise ValueError(f"unknown partition scheme {scheme}")
+        schemes = {p.path.split("-")[0] for p in self.catalog()}
+        if schemes - {scheme}:
+            raise ValueError(f"database is already partitioned by {schemes.pop()}")
+        before = before or datetime.datetime(datetime.date.today().year, 1, 1)
+        cutoff = before.strftime("%Y-%m-%d %H:%M:%S")
+        key = PARTITION_KEYS[scheme]
+        keys = [
+            k
+            for k, in self.db.execute_sql(
+                f"SELECT DISTINCT {key} FROM mail WHERE datetime < ? ORDER BY 1",
+                (cutoff,),
+            )
+        ]
+        fts = "mailindex" in self.db.get_tables()
+        self.close()
+        moved = 0
+        for k in keys:
+            partition = Partition.get_or_none(Partition.name == k) or Partition(
+                name=k, path=partition_filename(scheme, k), min_id=0, max_id=0
+            )
+            if partition.read_only:
+                log.warning(
+                    f"partition {partition.path} is read-only, keeping its e-mails "
+                    "received since it was made in the database"
+                )
+                continue
+            path = self.directory / partition.path
+            create_partition(path, fts)
+            self.db.execute_sql("ATTACH DATABASE ? AS part", (str(path),))
+            try:
+                with self.db.atomic():
+                    count = self.move_partition(key, k, cutoff, fts)
+                    self.update_catalog(partition, scheme, before)
+            finally:
+                self.db.execute_sql("DETACH DATABASE part")
+            log.info(f"moved {count} e-mails to partition {partition.path}")
+            moved += count
+        if moved:
+            self.db.execute_sql("VACUUM")
+        return moved
+
+    def move_partition(self, key: str, value: str, cutoff: str, fts: bool) -> int:
+        """Move e-mails of one partition into the database attached as part"""
+        sql = self.db.execute_sql
+        sql("DROP TABLE IF EXISTS temp.moving")
+        sql(
+            f"CREATE TEMP TABLE moving AS SELECT id FROM main.mail "
+            f"WHERE datetime < ? AND {key} = ?",
+            (cutoff, value),
+        )
+        mail, attachment = columns(Mail), columns(Attachment, primary_key=False)
+        sql(
+            f"INSERT INTO part.mail ({mail}) SELECT {mail} FROM main.mail "
+            f"WHERE id IN ({MOVING})"
+        )
+        sql(
+            f"INSERT OR IGNORE INTO part.blob ({columns(Blob)}) "
+            f"SELECT {columns(Blob)} FROM main.blob WHERE digest IN "
+            f"(SELECT blob_id FROM main.attachment WHERE mail_id IN ({MOVING}))"
+        )
+        sql(
+            f"INSERT INTO part.attachment ({attachment}) SELECT {attachment} "
+            f"FROM main.attachment WHERE mail_id IN ({MOVING})"
+        )
+        sql(
+            "INSERT OR IGNORE INTO part.address (address, name) "
+            "SELECT address, name FROM main.address WHERE id IN "
+            f"(SELECT address_id FROM main.recipient WHERE mail_id IN ({MOVING}))"
+        )
+        # addresses have ids of their own in each database
+        sql(
+            "INSERT OR IGNORE INTO part.recipient (mail_id, address_id, role) "
+            "SELECT r.mail_id, p.id, r.role FROM main.recipient AS r "
+            "JOIN main.address AS a ON a.id = r.address_id "
+            "JOIN part.address AS p ON p.address = a.address "
+            f"WHERE r.mail_id IN ({MOVING})"
+        )
+        if fts:
+            sql(
+                'INSERT OR REPLACE INTO part.mailindex (rowid, sender, "to", subject, '
+                'text) SELECT rowid, sender, "to", subject, text FROM main.mailindex '
+                f"WHERE rowid IN ({MOVING})"
+            )
+            sql(f"DELETE FROM main.mailindex WHERE rowid IN ({MOVING})")
+        for table, column in (("recipient", "mail_id"), ("attachment", "mail_id")):
+            sql(f"DELETE FROM main.{table} WHERE {column} IN ({MOVING})")
+        count = sql(f"DELETE FROM main.mail WHERE id IN ({MOVING})").rowcount
+        sql(
+            "DELETE FROM main.blob "
+            "WHERE digest NOT IN (SELECT blob_id FROM main.attachment)"
+        )
+        sql("DROP TABLE temp.moving")
+        return count
+
+    def update_catalog(self, partition: Partition, scheme: str, before) -> None:
+        """Copy statistics of the partition attached as part into the catalog"""
+        sql = self.db.execute_sql
+        partition.min_id, partition.max_id = sql(
+            "SELECT MIN(id), MAX(id) FROM part.mail"
+        ).fetchone()
+        if scheme == "year":
+            end = datetime.datetime(int(partition.name) + 1, 1, 1)
+            partition.read_only = end <= before
+        partition.save()
+        PartitionStats.delete().where(PartitionStats.partition == partition).execute()
+        stats = sql("SELECT folder, count, first, last FROM part.folderstats")
+        PartitionStats.insert_many(
+            [(partition.id, *s) for s in stats],
+            fields=[
+                PartitionStats.partition,
+                PartitionStats.folder,
+                PartitionStats.count,
+                PartitionStats.first,
+                PartitionStats.last,
+            ],
+        ).execute()
@@ -0,0 +1,112 @@
+"""Removal of old e-mails from Exchange"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated
+
+from peewee import chunked
+
+from richlog import log
+from .models import Mail
+from .writer import SQLITE_MAX_VARIABLES
+
+
+class Purger:
+    """Deletes e-mails received before a cutoff using batched EWS calls
+
+    Only ids of matching e-mails are fetched, using a server-side filter.
+
+    :param account: Exchange account
+    :param batch_size: Number of e-mails deleted per EWS call
+    :param workers: Number of delete calls running concurrently
+    :param dry_run: Only count e-mails which would be deleted
+    :param verify: Only delete e-mails stored locally, matched by Message-ID
+    :param partitions: Partitions old e-mails were moved to, also checked
+        when verifying
+    :param email: Address of the account, only its own e-mails or those
+        stored before accounts were recorded verify a deletion
+    """
+
+    def __init__(
+        self,
+        account,
+        batch_size=100,
+        workers=2,
+        dry_run=False,
+        verify=False,
+        partitions=None,
+        email=None,
+    ):
+        self.account = account
+        self.batch_size = batch_size
+        self.workers = workers
+        self.dry_run = dry_run
+        self.verify = verify
+        self.partitions = partitions
+        self.email = email
+
+    def archived(self, items: list) -> list:
+        """Return those (id, changekey, message id) items stored locally,
+        in the database downloaded to or any partition"""
+        message_ids = [message_id for _, _, message_id in items if message_id]
+        # copies of other accounts sharing the database are no archive of this one
+        own = (Mail.account == self.email) | Mail.account.is_null()
+
+        def lookup(db) -> set:
+            stored = set()
+            for batch in chunked(message_ids, SQLITE_MAX_VARIABLES):
+                query = Mail.select(Mail.message_id).where(
+                    Mail.message_id.in_(batch) & own
+                )
+                stored.update(m for m, in query.tuples().execute(db))
+            return stored
+
+        if self.partitions is None:
+            stored = lookup(None)
+        else:
+            found = self.partitions.fan_out(lookup, self.partitions.select())
+            stored = set().union(*found)
+        return [item for item in items if item[2] in stored]
+
+    def delete(self, ids: list) -> int:
+        """Delete one batch of e-mails, return number deleted"""
+        deleted = 0
+        for result in self.account.bulk_delete(ids, chunk_size=self.batch_size):
+            if result is True:
+                deleted += 1
+            else:
+                log.warning(f"failed removing due to {result}")
+        return deleted
+
+    def purge(self, folder: str, query) -> Annotated[tuple, "found and deleted"]:
+        """Delete all e-mails of a query
+
+        E-mails are deleted a chunk at a time taken from the start of the
+        query, those kept (unverified or failed) are skipped over.
+
+        :param folder: Name of folder
+        :param query: Exchange query of e-mails to delete
+        :return: Number of e-mails found and deleted
+        """
+        if self.dry_run:
+            count = query.count()
+            log.info(f'would purge {count} e-mails in "{folder}"')
+            return count, 0
+        query = query.order_by("datetime_received").values_list(
+            "id", "changekey", "message_id"
+        )
+        chunk = self.batch_size * self.workers
+        found, deleted, kept = 0, 0, 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                items = list(query[kept : kept + chunk])
+                if not items:
+                    break
+                found += len(items)
+                targets = self.archived(items) if self.verify else items
+                ids = [(id_, changekey) for id_, changekey, _ in targets]
+                removed = sum(pool.map(self.delete, chunked(ids, self.batch_size)))
+                deleted += removed
+                kept += len(items) - removed
+                log.info(f'purged {deleted} of {found} e-mails in "{folder}"')
+        if kept:
+            log.warning(f'kept {kept} e-mails in "{folder}" not archived or failing')
+        return found, deleted
@@ -0,0 +1,69 @@
+"""Rendering of e-mail bodies as Markdown within the terminal"""
+import html
+from typing import Annotated, Iterator
+
+import lxml.html
+from lxml.etree import ParserError
+from lxml_html_clean import clean_html
+from markdownify import markdownify as md
+
+MAX_LINES = 40
+SKIPPED_TAGS = {"head", "title", "style", "script"}
+BLOCK_TAGS = {
+    "html", "body", "div", "center", "section", "article", "header", "footer",
+    "table", "thead", "tbody", "tfoot", "tr", "td", "th", "p", "ul", "ol",
+    "blockquote", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "pre",
+}
+
+
+def iter_fragments(element) -> Iterator[str]:
+    """Split document into HTML fragments in reading order
+
+    Elements holding block elements are split into their children so a
+    fragment is roughly a paragraph, inline content is kept together.
+
+    :param element: lxml element
+    """
+    if not isinstance(element.tag, str) or element.tag in SKIPPED_TAGS:
+        return
+    if not any(child.tag in BLOCK_TAGS for child in element):
+        yield lxml.html.tostring(element, encoding="unicode", with_tail=False)
+        return
+    inline = [html.escape(element.text or "")]
+    for child in element:
+        if child.tag in BLOCK_TAGS:
+            if "".join(inline).strip():
+                yield "".join(inline)
+            inline = []
+            yield from iter_fragments(child)
+        elif isinstance(child.tag, str) and child.tag not in SKIPPED_TAGS:
+            inline.append(
+                lxml.html.tostring(child, encoding="unicode", with_tail=False)
+            )
+        inline.append(html.escape(child.tail or ""))
+    if "".join(inline).strip():
+        yield "".join(inline)
+
+
+def html_to_markdown(
+    input_: Annotated[str, "HTML text"], max_lines: int = MAX_LINES
+) -> str:
+    """Convert HTML to Markdown, stopping once enough lines are rendered
+
+    :param input_: Input data HTML
+    :param max_lines: Number of non-empty lines to render
+    :return: Markdown
+    """
+    if not input_:
+        return ""
+    try:
+        doc = clean_html(lxml.html.fromstring(input_))
+    except (ParserError, ValueError):
+        lines = [line for line in input_.split("\n") if line.strip() != ""]
+        return "\n".join(lines[:max_lines])
+    lines = []
+    for fragment in iter_fragments(doc):
+        lines.extend(line for line in md(fragment).split("\n") if line.strip() != "")
+        if len(lines) >= max_lines:
+            break
+    return "\n".join(lines[:max_lines])
@@ -0,0 +1,96 @@
+"""Full-text search of stored e-mails using SQLite FTS5"""
+import re
+from typing import Annotated, Iterable
+
+from rich.progress import track
+
+from .models import Mail, MailIndex, database_proxy
+
+WHITESPACE = re.compile(r"\s+")
+SEARCH_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def html_to_text(html: Annotated[str, "HTML text"]) -> str:
+    """Extract plain text from an e-mail body
+
+    :param html: Body as HTML (or plain text)
+    :return: Text with collapsed whitespace
+    """
+    if not html:
+        return ""
+    # lxml is slow to import, only load it once e-mails are indexed
+    import lxml.html
+    from lxml.etree import ParserError
+
+    try:
+        doc = lxml.html.fromstring(html)
+    except (ParserError, ValueError):
+        return WHITESPACE.sub(" ", html).strip()
+    for element in doc.xpath("//script|//style|//head"):
+        if element.getparent() is not None:
+            element.drop_tree()
+    return WHITESPACE.sub(" ", " ".join(doc.itertext())).strip()
+
+
+def fts_query(keyword: str) -> str:
+    """Translate a keyword filter into an FTS5 query
+
+    Words are matched as tokens (all must be present), "quoted words" as a
+    phrase and a trailing * makes the word a prefix match.
+
+    :param keyword: Keyword filter as entered by user
+    :return: FTS5 MATCH expression
+    """
+    terms = []
+    for phrase, word in SEARCH_TERM.findall(keyword):
+        tokens = re.findall(r"\w+", phrase or word)
+        if not tokens:
+            continue
+        term = '"{}"'.format(" ".join(tokens))
+        if word.endswith("*"):
+            term += "*"
+        terms.append(term)
+    return " ".join(terms)
+
+
+def index_records(records: Iterable[dict]) -> None:
+    """Add (or replace) records in the full-text index
+
+    :param records: Mail records as dicts including id
+    """
+    rows = [
+        {
+            "rowid": r["id"],
+            "sender": r["sender"] or "",
+            "to": r["to"] or "",
+            "subject": r["subject"] or "",
+            "text": html_to_text(r["body"]),
+        }
+        for r in records
+    ]
+    if rows:
+        MailIndex.replace_many(rows).execute()
+
+
+def rebuild_index(batch_size: int = 500) -> int:
+    """Backfill the full-text index from all stored e-mails
+
+    :param batch_size: Number of records indexed per transaction
+    :return: Number of records indexed
+    """
+    db = database_proxy.obj
+    total = Mail.select().count()
+    MailIndex.delete().execute()
+    batch = []
+    query = Mail.select().order_by(Mail.id).dicts().iterator()
+    for r in track(query, total=total, description="Indexing"):
+        batch.append(r)
+        if len(batch) >= batch_size:
+            with db.atomic():
+                index_records(batch)
+            batch = []
+    with db.atomic():
+        index_records(batch)
+    # FTS5 merges the index segments written batch by batch
+    db.execute_sql("INSERT INTO mailindex (mailindex) VALUES ('optimize')")
+    return total
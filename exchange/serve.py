@@ -0,0 +1,350 @@
+"""Read-only JSON API over stored e-mails, run by mail_export serve
+
+All endpoints answer GET requests with JSON:
+
+    /status                      number and date range of e-mails, by folder
+    /mails?keyword=&folder=&since=&until=&cursor=&limit=
+                                 filtered e-mails newest first, listed columns
+    /mails/<id>                  one e-mail with its body as HTML and MarkDown
+    /records?from_id=&to_id=&cursor=&limit=
+                                 e-mails with all columns by id
+
+Pages end with the cursor of the next page, passed as cursor to get it. The
+database is queried through a pool of read-only connections in WAL mode, so
+requests are answered while a download writes to it. Responses are cached
+until the stored e-mails change.
+"""
+import base64
+import datetime
+import json
+import re
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from playhouse.pool import PooledSqliteDatabase
+
+from richlog import log
+from .api import LIST_COLUMNS, PAGE_SIZE, build_filter_query
+from .models import Attachment, Blob, Mail, database_proxy
+from .partitions import Partitions
+from .stats import folder_counts, summary
+
+MAX_LIMIT = 1000
+DATE = re.compile(r"^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?$")
+
+
+class ApiError(Exception):
+    """Request that can not be answered, with the HTTP status to respond"""
+
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def json_value(value):
+    """JSON value of types json does not know, i.e. datetimes"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=" ")
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def encode_cursor(*values) -> str:
+    """Opaque cursor of the last record on a page"""
+    text = json.dumps(values, default=json_value)
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types) -> tuple:
+    """Values of a cursor made by encode_cursor, converted to types"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+        if len(values) != len(types):
+            raise ValueError(cursor)
+        return tuple(t(v) for t, v in zip(types, values))
+    except (TypeError, ValueError):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"invalid cursor {cursor}")
+
+
+def int_param(params: dict, name: str, default: int = None, minimum=0) -> int:
+    """Integer query parameter"""
+    try:
+        value = int(params.get(name, default))
+    except (TypeError, ValueError):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+    if value < minimum:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be at least {minimum}")
+    return value
+
+
+def date_param(params: dict, name: str) -> str:
+    """Date query parameter, YYYY-MM-DD optionally followed by a time"""
+    value = params.get(name, "")
+    if value and not DATE.match(value):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be YYYY-MM-DD")
+    return value
+
+
+class ResponseCache:
+    """Least recently used responses
+
+    :param size: Number of responses kept
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value) -> None:
+        if not self.size:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class Archive:
+    """Queries of the JSON API, each request on a pooled read-only connection
+
+    Models are bound to the pool, so the process no longer writes to the
+    database.
+
+    :param filename: Path of database
+    :param fts: Whether the database has a full-text index
+    :param pool_size: Maximum number of connections, i.e. concurrent requests
+    :param cache_size: Number of responses cached
+    :param partition_workers: Number of partitions queried in parallel
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        fts: bool = True,
+        pool_size: int = 8,
+        cache_size: int = 256,
+        partition_workers: int = 4,
+    ):
+        self.filename = filename
+        self.fts = fts
+        # requests are served by a new thread each, connections move between them
+        self.db = PooledSqliteDatabase(
+            f"{Path(filename).absolute().as_uri()}?mode=ro",
+            uri=True,
+            max_connections=pool_size,
+            stale_timeout=300,
+            timeout=60,
+            check_same_thread=False,
+        )
+        database_proxy.initialize(self.db)
+        self.partitions = Partitions(self.db, filename, partition_workers)
+        self.cache = ResponseCache(cache_size)
+
+    def close(self) -> None:
+        self.partitions.close()
+        self.db.close_all()
+
+    @staticmethod
+    def version() -> tuple:
+        """Changes whenever e-mails are stored, removed or moved"""
+        return summary(), Partitions.summary()
+
+    def respond(self, path: str, params: dict) -> bytes:
+        """Answer a request, from cache unless e-mails changed since
+
+        :param path: Path of URL
+        :param params: Query parameters
+        :return: JSON
+        """
+        with self.db.connection_context():
+            key = path, tuple(sorted(params.items())), self.version()
+            body = self.cache.get(key)
+            if body is None:
+                body = json.dumps(self.route(path, params), default=json_value)
+                body = body.encode()
+                self.cache.put(key, body)
+            return body
+
+    def route(self, path: str, params: dict):
+        parts = path.strip("/").split("/")
+        if parts == ["status"]:
+            return self.status()
+        if parts == ["mails"]:
+            return self.mails(params)
+        if len(parts) == 2 and parts[0] == "mails" and parts[1].isdigit():
+            return self.mail(int(parts[1]))
+        if parts == ["records"]:
+            return self.records(params)
+        raise ApiError(HTTPStatus.NOT_FOUND, f"no such endpoint {path}")
+
+    def status(self) -> dict:
+        """Number and date range of e-mails, as in the menu"""
+        count, first, last = summary()
+        moved, moved_first, moved_last = Partitions.summary()
+        folders = folder_counts()
+        for folder, n in Partitions.folder_counts().items():
+            folders[folder] = folders.get(folder, 0) + n
+        return {
+            "database": self.filename,
+            "count": count + moved,
+            "first": min(filter(None, (first, moved_first)), default=None),
+            "last": max(filter(None, (last, moved_last)), default=None),
+            "folders": [{"folder": f, "count": n} for f, n in folders.items()],
+        }
+
+    def mails(self, params: dict) -> dict:
+        """Filtered e-mails newest first, as apply_filter and page_records
+
+        The count of matching e-mails is only given on the first page.
+        """
+        limit = min(int_param(params, "limit", PAGE_SIZE, minimum=1), MAX_LIMIT)
+        since, until = date_param(params, "since"), date_param(params, "until")
+        folder = params.get("folder")
+        date_range = None, None
+        if since or until:
+            date_range = since or "0001-01-01", until or "9999-12-31"
+        keyword = params.get("keyword")
+        query = build_filter_query(keyword, date_range, folder, self.fts)
+        partitions = self.partitions.select(folder, since or None, until or None)
+        after = None
+        if "cursor" in params:
+            after = decode_cursor(
+                params["cursor"], datetime.datetime.fromisoformat, int
+            )
+        records = self.partitions.page(
+            query.select(*LIST_COLUMNS), partitions, after, limit + 1
+        )
+        page = {"mails": records[:limit], "next": None}
+        if len(records) > limit:
+            last = records[limit - 1]
+            page["next"] = encode_cursor(last["datetime"], last["id"])
+        if after is None:
+            counts = self.partitions.fan_out(query.count, partitions)
+            page["count"] = sum(counts)
+        return page
+
+    def mail(self, record_id: int) -> dict:
+        """One e-mail with its body and attachments, as show_record"""
+        from .render import html_to_markdown
+
+        db = self.partitions.locate(record_id)
+        record = Mail.select().where(Mail.id == record_id).dicts().first(db)
+        if record is None:
+            raise ApiError(HTTPStatus.NOT_FOUND, f"no e-mail {record_id}")
+        record["markdown"] = html_to_markdown(record["body"])
+        record["attachments"] = list(
+            Attachment.select(Attachment.name, Attachment.content_type, Blob.size)
+            .join(Blob)
+            .where(Attachment.mail == record_id)
+            .order_by(Attachment.id)
+            .dicts()
+            .execute(db)
+        )
+        return record
+
+    def records(self, params: dict) -> dict:
+        """E-mails with all columns by id within from_id and to_id, as
+        get_db_records"""
+        limit = min(int_param(params, "limit", PAGE_SIZE, minimum=1), MAX_LIMIT)
+        from_id = int_param(params, "from_id", 0)
+        if "cursor" in params:
+            (last_id,) = decode_cursor(params["cursor"], int)
+            from_id = max(from_id, last_id + 1)
+        query = Mail.select().where(Mail.id >= from_id)
+        if "to_id" in params:
+            query = query.where(Mail.id <= int_param(params, "to_id"))
+        query = query.order_by(Mail.id).limit(limit + 1).dicts()
+        pages = self.partitions.fan_out(
+            lambda db: list(query.clone().execute(db)), self.partitions.select()
+        )
+        records = list(self.partitions.merge(pages, key=lambda r: r["id"]))
+        page = {"records": records[:limit], "next": None}
+        if len(records) > limit:
+            page["next"] = encode_cursor(records[limit - 1]["id"])
+        return page
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            body = self.server.archive.respond(url.path, params)
+            status = HTTPStatus.OK
+        except ApiError as e:
+            status, body = e.status, json.dumps({"error": str(e)}).encode()
+        except Exception as e:
+            log.exception(f"failed to answer {self.path}")
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            body = json.dumps({"error": repr(e)}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(format % args)
+
+
+class Server(ThreadingHTTPServer):
+    """HTTP server answering each request in a thread of its own
+
+    :param address: Host and port to listen on, port 0 picks a free one
+    :param archive: Archive answering requests
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, archive: Archive):
+        super().__init__(address, Handler)
+        self.archive = archive
+
+
+def serve(
+    email,
+    host: str = "127.0.0.1",
+    port: int = 8025,
+    pool_size: int = 8,
+    cache_size: int = 256,
+) -> None:
+    """Serve the database of email read-only until interrupted
+
+    :param email: Email, its database migrated to the current version
+    :param host: Interface to listen on, only this machine by default
+    :param port: Port to listen on
+    :param pool_size: Maximum number of concurrent database connections
+    :param cache_size: Number of responses cached
+    """
+    # readers do not wait for a download writing, nor the download for readers
+    email.db.pragma("journal_mode", "wal")
+    email.db.close()
+    archive = Archive(
+        email.filename, email.fts, pool_size, cache_size, email.partitions.workers
+    )
+    server = Server((host, port), archive)
+    url = f"http://{host}:{server.server_port}"
+    log.info(f"serving {email.filename} read-only on {url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        archive.close()
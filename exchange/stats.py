@@ -0,0 +1,87 @@
+"""Statistics of stored e-mails kept in a summary table by triggers
+
+E-mails without folder are counted along with those of folder '', every
+trigger keys on IFNULL(folder, '') as rebuild_stats does.
+"""
+from peewee import fn
+
+from .models import FolderStats, Mail
+
+# lets REMOVE look up first and last of a folder by the same expression
+INDEX = "mail_folder_key_datetime ON mail (IFNULL(folder, ''), datetime)"
+ADD = """
+    INSERT INTO folderstats (folder, count, first, last)
+    VALUES (IFNULL(NEW.folder, ''), 1, NEW.datetime, NEW.datetime)
+    ON CONFLICT (folder) DO UPDATE SET
+        count = count + 1,
+        first = MIN(first, excluded.first),
+        last = MAX(last, excluded.last);
+"""
+REMOVE = """
+    UPDATE folderstats SET
+        count = count - 1,
+        first = (SELECT MIN(datetime) FROM mail
+                 WHERE IFNULL(folder, '') = IFNULL(OLD.folder, '')),
+        last = (SELECT MAX(datetime) FROM mail
+                WHERE IFNULL(folder, '') = IFNULL(OLD.folder, ''))
+    WHERE folder = IFNULL(OLD.folder, '');
+    DELETE FROM folderstats WHERE folder = IFNULL(OLD.folder, '') AND count <= 0;
+"""
+TRIGGERS = {
+    "mail_stats_insert": f"AFTER INSERT ON mail BEGIN {ADD} END",
+    "mail_stats_delete": f"AFTER DELETE ON mail BEGIN {REMOVE} END",
+    "mail_stats_update": f"AFTER UPDATE OF folder, datetime ON mail BEGIN {REMOVE} {ADD} END",
+}
+
+
+def create_triggers(db) -> None:
+    """Create triggers keeping FolderStats up to date if missing
+
+    :param db: Database
+    """
+    db.execute_sql(f"CREATE INDEX IF NOT EXISTS {INDEX}")
+    for name, trigger in TRIGGERS.items():
+        db.execute_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {trigger}")
+
+
+def replace_triggers(db) -> None:
+    """Create triggers again, e.g. after their definition changed
+
+    :param db: Database
+    """
+    for name in TRIGGERS:
+        db.execute_sql(f"DROP TRIGGER IF EXISTS {name}")
+    create_triggers(db)
+
+
+def rebuild_stats(db) -> None:
+    """Calculate FolderStats from all stored e-mails
+
+    :param db: Database
+    """
+    folder = fn.IFNULL(Mail.folder, "")
+    query = Mail.select(
+        folder, fn.COUNT(Mail.id), fn.MIN(Mail.datetime), fn.MAX(Mail.datetime)
+    ).group_by(folder)
+    with db.atomic():
+        FolderStats.delete().execute()
+        FolderStats.insert_from(
+            query,
+            [FolderStats.folder, FolderStats.count, FolderStats.first, FolderStats.last],
+        ).execute()
+
+
+def summary() -> tuple:
+    """Return count, first and last datetime of all stored e-mails"""
+    count, first, last = FolderStats.select(
+        fn.SUM(FolderStats.count), fn.MIN(FolderStats.first), fn.MAX(FolderStats.last)
+    ).scalar(as_tuple=True)
+    return count or 0, first, last
+
+
+def folder_counts() -> dict:
+    """Return number of stored e-mails by folder"""
+    return {
+        s.folder or None: s.count
+        for s in FolderStats.select().order_by(FolderStats.folder)
+    }
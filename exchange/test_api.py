@@ -1,12 +1,35 @@
 import datetime
+import json
+import operator
 
 import pytest
 from unittest.mock import Mock, MagicMock, patch
-from exchange import Email
+from exchange import Email, Mail
+from exchange.api import FIELDS
+from exchange.models import Attachment, Blob, FailedItem, Partition, Recipient, SyncState
+from exchange.addresses import parse_addresses, split_address_filters
+from exchangelib import FileAttachment, Mailbox
+from exchangelib.errors import ErrorServerBusy
+from exchange.download import iter_items
+from exchange.migrations import MIGRATIONS, migrate_database, scope_dedup_by_account
+from exchange.purge import Purger
+from exchange.writer import MailWriter
+from exchange.batch import read_accounts, run_batch
+from exchange.jobs import Job
+from richlog import log
+from exchange.benchmark import fake_account, fill_database, run as run_benchmark
+from exchange.serve import Archive, Server
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from collections import namedtuple as nt
 from functools import wraps
 from peewee import SqliteDatabase
 import re
+import mailbox
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+import tarfile
 
 
 def with_test_db(dbs: tuple):
@@ -61,20 +84,82 @@ def test_print_db_status(capsys, mocked_email_db):
     assert 'Database:' in out
 
 
-def test_collect_mail(mocker, faker, mocked_email_db: Mock, mocked_data):
-    mocker.patch('exchange.api.Credentials', return_value=MagicMock())
+def test_collect_mail(tmp_path):
+    email = Email(database=':memory:', email='a@b.c', download_now=True, archive_folders='2020')
+    account = fake_account(30, folders=('Inbox', 'Sent', 'Archive/2020'), body_size=100)
+    email.connect = lambda: account
+    email.process_mail()
+    assert email.db_count == 30
+    assert set(email.db_get_folders) == {'Inbox', 'Sent', 'Archive/2020'}
+    record = email.get_db_records().where(Mail.id == 1).get()
+    assert record['sender'].startswith('Person ') and record['message_id'].endswith('@example.com>')
 
-    # method needs Mock while property no
-    inbox_mock = Mock(total_count=2, all=Mock(return_value=Mock(order_by=Mock(return_value=[mocked_data]))))
-    account_mock = Mock(inbox=inbox_mock)
-    mocker.patch('exchange.api.Account', return_value=account_mock)
-    mocker.patch('exchange.api.Email.extract_email_items', return_value=mocked_data)
-    mocker.patch('exchange.api.Mail',
-                 select=Mock(return_value=Mock(where=Mock(return_value=Mock(count=Mock(return_value=0))))))
-    mocker.patch('exchange.api.track', return_value=(Mock(),))
-    mocker.patch('datetime.datetime', return_value=faker.date_time())
-    mocked_email_db.collect_mail()
-    assert mocked_email_db.extract_email_items.called is True
+
+def test_metrics(tmp_path):
+    metrics_file = tmp_path / 'metrics.prom'
+    email = Email(database=':memory:', email='a@b.c', download_now=True, workers=2, metrics_file=str(metrics_file))
+    account = fake_account(30, body_size=100)
+    email.connect = lambda: account
+    email.process_mail()
+    stages = email.metrics.stages
+    assert {'fetch', 'extract', 'dedup', 'insert', 'flush'} <= set(stages)
+    assert stages['extract'].count == 30 and email.metrics.counters['stored'] == 30
+    assert 0 < stages['extract'].quantile(0.5) <= stages['extract'].quantile(0.95) <= stages['extract'].max
+    text = metrics_file.read_text()
+    assert 'mail_export_stage_seconds_count{stage="extract"} 30' in text
+    assert 'mail_export_stage_seconds_bucket{stage="extract",le="+Inf"} 30' in text
+    assert 'e-mails/s' in email.metrics.summary()
+    started, email.full_resync = email.metrics.started, True
+    email.process_mail()
+    assert email.metrics.started > started and email.metrics.counters['downloaded'] == 30
+
+
+def test_benchmark(tmp_path):
+    out = tmp_path / 'benchmark.json'
+    report = run_benchmark(sizes=[40], download_size=20, out=str(out), workdir=str(tmp_path / 'dbs'), body_size=100)
+    assert json.loads(out.read_text()) == report
+    results = {r['benchmark']: r for r in report['results']}
+    assert {'process_mail', 'fill_database', 'apply_filter.keyword', 'show_record', 'records_to_files.html',
+            'print_db_status'} <= set(results)
+    assert results['records_to_files.html']['rows'] == 40 and results['process_mail']['per_second'] > 0
+
+
+def test_job(caplog):
+    caplog.set_level('INFO')
+
+    def work():
+        job.expect(4)
+        for _ in range(3):
+            job.step()
+        log.info('halfway there')
+        return 'done'
+    job = Job('Work', work)
+    assert job.start().wait(5) and job.result == 'done' and job.state == 'finished'
+    assert (job.done, job.total, job.message) == (3, 4, 'halfway there')
+    assert job.status().startswith('Work finished: 3 e-mails in 0:00:00')
+    failing = Job('Fail', lambda: 1 / 0).start()
+    assert failing.wait(5) and failing.state == 'failed' and 'ZeroDivisionError' in failing.status()
+
+
+def test_job_cancel_download(tmp_path):
+    email = Email(database=str(tmp_path / 'emails.sqlite'), email='a@b.c', download_now=True)
+    account = fake_account(300, body_size=100)
+    email.connect = lambda: account
+    extract, calls = email.extract_email_items, []
+
+    def cancel_after(fields, item):
+        calls.append(item)
+        if len(calls) == 50:
+            email.job.cancel()
+        return extract(fields, item)
+    email.extract_email_items = cancel_after
+    email.job = Job('Download', email.process_mail)
+    assert email.job.start().wait(30) and email.job.state == 'cancelled'
+    assert email.job.done == 50 and 50 < email.job.total < 300
+    assert email.db_count == 50 and email.get_checkpoint('Sent') is not None
+    email.job = None
+    email.process_mail()
+    assert email.db_count == 300
 
 
 def test_print_db_records_table(capsys, mocked_email_db, mocked_data):
@@ -83,3 +168,649 @@ def test_print_db_records_table(capsys, mocked_email_db, mocked_data):
     out, err = capsys.readouterr()
     print(out)
     assert re.search(r'\S+@\S+', out), 'No email found in output'
+
+
+def test_apply_filter_keyword(mocked_email_db, mocked_data):
+    mocked_email_db.add_record(mocked_data._asdict())
+    mocked_email_db.add_record(mocked_data._replace(subject='quarterly budget review')._asdict())
+    mocked_email_db.filter_keyword = 'budget'
+    assert [r['subject'] for r in mocked_email_db.apply_filter()] == ['quarterly budget review']
+    mocked_email_db.filter_keyword = '"budget review" quart*'
+    assert len(mocked_email_db.apply_filter()) == 1
+    mocked_email_db.filter_keyword = '"review budget"'
+    assert len(mocked_email_db.apply_filter()) == 0
+
+
+@pytest.mark.parametrize('text, parsed', [
+    ('Bob <Bob@Example.com>,"Smith, Al" <al@example.com>', [('bob@example.com', 'Bob'), ('al@example.com', 'Smith, Al')]),
+    ('None <a@example.com>', [('a@example.com', None)]),
+    ('Bob Smith; al@example.com', [('bob smith', 'Bob Smith'), ('al@example.com', None)]),
+    ('None', []),
+])
+def test_parse_addresses(text, parsed):
+    assert parse_addresses(text) == parsed
+
+
+def test_apply_filter_address(mocked_email_db, mocked_data):
+    assert split_address_filters('from:bob budget TO:"Al Smith"') == ([('from', 'bob'), ('to', 'Al Smith')], 'budget')
+    mocked_email_db.add_record(mocked_data._replace(sender='Bob <bob@example.com>', to='Al Smith <al@example.com>',
+                                                    cc='Carol <carol@example.com>', subject='budget')._asdict())
+    mocked_email_db.add_record(mocked_data._replace(sender='Al Smith <al@example.com>', to='Bob <bob@example.com>',
+                                                    subject='re: budget')._asdict())
+    mocked_email_db.filter_keyword = 'from:bob@example.com'
+    assert [r['subject'] for r in mocked_email_db.apply_filter()] == ['budget']
+    mocked_email_db.filter_keyword = 'to:bob re'
+    assert [r['subject'] for r in mocked_email_db.apply_filter()] == ['re: budget']
+    mocked_email_db.filter_keyword = 'cc:carol to:bob'
+    assert len(mocked_email_db.apply_filter()) == mocked_email_db.filter_count == 0
+    top = mocked_email_db.print_top_correspondents()
+    assert [(r['address'], r['from'], r['to'], r['cc'], r['total']) for r in top][:2] == [
+        ('al@example.com', 1, 1, 0, 2), ('bob@example.com', 1, 1, 0, 2)]
+
+
+def test_store_mail_batched(mocked_email_db, mocked_data):
+    mocked_email_db.writer.batch_size = 3
+    for n in range(2):
+        mocked_email_db.store_mail_to_db(mocked_data._replace(datetime=f'2021-01-0{n + 1} 01:00:00'), 'Inbox', False, False)
+    assert mocked_email_db.db_count == 0, 'Stored before batch was full'
+    mocked_email_db.store_mail_to_db(mocked_data, 'Inbox', False, False)
+    assert mocked_email_db.db_count == 3
+    mocked_email_db.download_now = True
+    mocked_email_db.store_mail_to_db(mocked_data, 'Inbox', False, False)
+    assert mocked_email_db.writer.flush() == 1
+    assert mocked_email_db.db_count == 3
+    mocked_email_db.filter_keyword = mocked_data.subject.split()[0]
+    assert len(mocked_email_db.apply_filter()) >= 1
+
+
+class FakeQuery(list):
+    """List standing in for an exchangelib QuerySet"""
+    page_size = None
+
+    def only(self, *fields):
+        return self
+
+    def order_by(self, *fields):
+        return self
+
+    def count(self, *args):
+        return len(self)
+
+    def filter(self, **bounds):
+        ops = {'gte': operator.ge, 'lte': operator.le}
+        return type(self)(i for i in self if all(ops[k.split('__')[1]](i.datetime, v.strftime('%Y-%m-%d %H:%M:%S'))
+                                                 for k, v in bounds.items()))
+
+    def __getitem__(self, s):
+        return type(self)(super().__getitem__(s)) if isinstance(s, slice) else super().__getitem__(s)
+
+
+def mocked_folder(items):
+    query = FakeQuery(items)
+    return Mock(total_count=len(items), all=Mock(return_value=query), filter=Mock(side_effect=query.filter))
+
+
+def test_process_mail_concurrent(mocker, mocked_data):
+    def folder(count, day):
+        return mocked_folder([mocked_data._replace(datetime=f'2021-01-{day:02} 01:{n:02}:00') for n in range(count)])
+
+    mocker.patch('exchange.ews.Credentials', return_value=MagicMock())
+    mocker.patch('exchange.ews.Configuration', return_value=MagicMock())
+    mocker.patch('exchange.ews.Account', return_value=Mock(inbox=folder(7, 1), sent=folder(3, 2)))
+    mocker.patch('exchange.api.Email.extract_email_items', side_effect=lambda fields, item: item)
+    email = Email(database=':memory:', email='a@b.c', workers=3, split_size=2)
+    email.process_mail()
+    assert email.db_count == 10
+    assert set(email.db_get_folders) == {'Inbox', 'Sent'}
+
+
+def test_process_mail_incremental(mocker, mocked_data):
+    items = [mocked_data._replace(datetime=f'2021-01-0{n} 01:00:00') for n in (3, 2, 1)]
+    newer = mocked_data._replace(datetime='2021-01-04 01:00:00')
+    inbox = mocked_folder(items)
+    mocker.patch('exchange.ews.Credentials', return_value=MagicMock())
+    mocker.patch('exchange.ews.Configuration', return_value=MagicMock())
+    mocker.patch('exchange.ews.Account', return_value=Mock(inbox=inbox, sent=mocked_folder([])))
+    mocker.patch('exchange.api.Email.extract_email_items', side_effect=lambda fields, item: item)
+    email = Email(database=':memory:', email='a@b.c', download_now=True, page_size=50)
+    email.process_mail()
+    assert email.db_count == 3
+    assert email.sync_since('Inbox') == datetime.datetime(2021, 1, 3, 1)
+    # e-mails arriving during the download are left to the next one
+    assert inbox.filter.call_args.kwargs.keys() == {'datetime_received__lte'}
+    assert email.folder_query(inbox)[0].page_size == 50
+
+    inbox.filter.side_effect = FakeQuery([newer] + items).filter
+
+    mocker.patch('builtins.input', side_effect=AssertionError('prompted'))
+    email.download_now = False
+    email.process_mail()
+    assert inbox.filter.call_args.kwargs['datetime_received__gte'].day == 3
+    assert email.db_count == 4
+    assert email.sync_since('Inbox') == datetime.datetime(2021, 1, 4, 1)
+    email.full_resync = True
+    assert email.sync_since('Inbox') is None
+
+    # newer e-mail of another account sharing the database
+    Mail.insert(datetime='2021-01-09 01:00:00', to='', sender='', folder='Inbox', account='x@b.c').execute()
+    email.mark_synced('Inbox')
+    assert SyncState.get(SyncState.account == 'a@b.c').last_received == datetime.datetime(2021, 1, 4, 1)
+
+
+def test_accounts_share_database(tmp_path, mocked_data):
+    path = str(tmp_path / 'shared.sqlite')
+    mail = mocked_data._replace(datetime='2021-01-01 01:00:00')
+    team = nt('f', mail._fields + ('message_id',))(*mail, '<team@x.org>')
+    for account in ('a@x.org', 'b@x.org', 'a@x.org'):
+        email = Email(database=path, email=account)
+        email.writer.add(team, 'Inbox')
+        email.writer.flush()
+    assert sorted(Mail.select(Mail.account, Mail.folder).tuples()) == [('a@x.org', 'Inbox'), ('b@x.org', 'Inbox')]
+    assert email.writer.stored == 0 and email.writer.duplicates == 1
+
+    # e-mails stored before accounts were recorded are the account's
+    legacy = mail._replace(subject='legacy')._asdict()
+    Mail.insert(**legacy, folder='Inbox', digest=MailWriter.key(legacy)).execute()
+    email.writer.add(nt('f', legacy)(**legacy), 'Inbox')
+    assert email.writer.flush() == 1
+
+    # databases shared before message ids were unique per account
+    Mail.delete().where(Mail.account == 'a@x.org').execute()
+    email.db.execute_sql('DROP INDEX mail_account_message_id')
+    email.db.execute_sql('DROP INDEX mail_message_id')
+    email.db.execute_sql('CREATE UNIQUE INDEX mail_message_id ON mail (message_id)')
+    Mail.update(digest=MailWriter.key(team._asdict())).where(Mail.account == 'b@x.org').execute()
+    email.db.pragma('user_version', len(MIGRATIONS) - 1)
+    email.db.close()
+    email = Email(database=path, email='a@x.org')
+    indexes = {i.name: i.unique for i in email.db.get_indexes('mail')}
+    assert indexes['mail_message_id'] is False and indexes['mail_account_message_id'] is True
+    assert Mail.get(Mail.account == 'b@x.org').digest == MailWriter.key(dict(team._asdict(), account='b@x.org'))
+    email.writer.add(team, 'Inbox')
+    assert email.writer.flush() == 0 and Mail.select().where(Mail.message_id == '<team@x.org>').count() == 2
+
+
+def write_shared(path, account, count):
+    """Store count e-mails of account, each in a transaction of its own"""
+    email = Email(database=path, email=account)
+    email.writer.batch_size = 1
+    fields = ('datetime', 'sender', 'to', 'cc', 'subject', 'body', 'message_id')
+    for n in range(count):
+        email.writer.add(nt('f', fields)(f'2021-01-01 00:{n // 60:02}:{n % 60:02}', 'a@x.org', 'b@x.org', '',
+                                         f'mail {n}', 'body', f'<{n}@x.org>'), 'Inbox')
+    email.db.close()
+    return email.writer.stored
+
+
+def test_processes_share_database(tmp_path):
+    path = str(tmp_path / 'shared.sqlite')
+    Email(database=path).db.pragma('journal_mode', 'wal')
+    accounts = [f'{n}@x.org' for n in range(4)]
+    with ProcessPoolExecutor(len(accounts)) as pool:
+        assert list(pool.map(write_shared, [path] * 4, accounts, [100] * 4)) == [100] * 4
+    assert Mail.select().count() == 400
+
+
+def test_legacy_cc_digest(tmp_path):
+    email = Email(database=str(tmp_path / 'mail.sqlite'), email='a@x.org')
+    bob = Mailbox(name='Bob', email_address='bob@x.org')
+    item = Mock(datetime_received=datetime.datetime(2021, 1, 1, 1), sender=bob, to_recipients=[bob],
+                cc_recipients=[bob], display_cc='Bob', subject='s', body='b', message_id=None)
+    # older downloads stored display_cc and digested it before accounts were recorded
+    legacy = dict(datetime='2021-01-01 01:00:00', sender='Bob <bob@x.org>', to='Bob <bob@x.org>', cc='Bob',
+                  subject='s', body='b')
+    Mail.insert(**legacy, folder='Inbox', digest=MailWriter.key(legacy)).execute()
+    email.writer.add(email.extract_email_items(FIELDS, item), 'Inbox')
+    assert email.writer.flush() == 1
+    item.subject = 'new'
+    email.writer.add(email.extract_email_items(FIELDS, item), 'Inbox')
+    assert email.writer.flush() == 0 and Mail.get(Mail.subject == 'new').cc == 'Bob <bob@x.org>'
+
+
+def test_iter_items_skips_unparsable():
+    class BrokenQuery(FakeQuery):
+        def __iter__(self):
+            for item in super().__iter__():
+                if item == 'bad':
+                    raise KeyError(item)
+                yield item
+
+    query = BrokenQuery(['a', 'bad', 'b', 'c'])
+    assert list(iter_items(query, 0, 4)) == ['a', 'b', 'c']
+    assert list(iter_items(query, 2, 3)) == ['b']
+
+
+def test_iter_items_retries_throttled(mocker):
+    class BusyQuery(FakeQuery):
+        busy = [ErrorServerBusy('busy', back_off=7), ErrorServerBusy('busy')]
+
+        def __iter__(self):
+            for item in super().__iter__():
+                if item == 'b' and self.busy:
+                    raise self.busy.pop(0)
+                yield item
+
+    sleep = mocker.patch('exchange.download.time.sleep')
+    assert list(iter_items(BusyQuery(['a', 'b', 'c']), 0, 3)) == ['a', 'b', 'c']
+    assert [c.args[0] for c in sleep.call_args_list] == [7, 4]
+    sleep.reset_mock()
+    BusyQuery.busy = [ValueError('not transient')]
+    with pytest.raises(ValueError):
+        list(iter_items(BusyQuery(['a', 'b']), 0, 2))
+    sleep.assert_not_called()
+
+
+def test_process_mail_resumes(mocker, mocked_data):
+    items = [mocked_data._replace(datetime=f'2021-01-0{n} 01:00:00') for n in (5, 4, 3, 2, 1)]
+    inbox = mocked_folder(items)
+
+    def crash(fields, item):
+        if item is items[1]:
+            raise AttributeError('sender')
+        if item is items[3]:
+            raise RuntimeError('connection lost')
+        return item
+
+    mocker.patch('exchange.ews.Credentials', return_value=MagicMock())
+    mocker.patch('exchange.ews.Configuration', return_value=MagicMock())
+    mocker.patch('exchange.ews.Account', return_value=Mock(inbox=inbox, sent=mocked_folder([])))
+    extract = mocker.patch('exchange.api.Email.extract_email_items', side_effect=crash)
+    email = Email(database=':memory:', email='a@b.c', download_now=True)
+    with pytest.raises(RuntimeError):
+        email.process_mail()
+    assert email.db_count == 2
+    assert email.get_checkpoint('Inbox').until == datetime.datetime(2021, 1, 3, 1)
+    assert FailedItem.select().count() == 1
+
+    extract.side_effect = lambda fields, item: item
+    email.process_mail()
+    assert inbox.filter.call_args.kwargs.keys() == {'datetime_received__lte'}
+    assert email.db_count == 4
+    assert email.get_checkpoint('Inbox') is None
+    assert email.sync_since('Inbox') == datetime.datetime(2021, 1, 5, 1)
+
+
+def test_store_mail_same_second(mocked_email_db, mocked_data):
+    mocked_email_db.download_now = True
+    for subject in ('first', 'second', 'first'):
+        mocked_email_db.store_mail_to_db(mocked_data._replace(subject=subject), 'Inbox', False, False)
+    assert mocked_email_db.writer.flush() == 1
+    assert mocked_email_db.db_count == 2
+
+
+def test_migrate_database(tmp_path, mocked_data):
+    db = SqliteDatabase(str(tmp_path / 'old.sqlite'))
+    db.execute_sql('CREATE TABLE mail (id INTEGER PRIMARY KEY, datetime DATETIME NOT NULL, "to" TEXT NOT NULL, '
+                   'sender TEXT NOT NULL, cc TEXT, subject TEXT, body TEXT, folder TEXT)')
+    for n in range(3):
+        db.execute_sql('INSERT INTO mail (datetime, "to", sender, subject, folder) VALUES (?, ?, ?, ?, ?)',
+                       ('2021-01-01 01:00:00', mocked_data.to, mocked_data.sender, f'{n % 2}', 'Inbox'))
+    db.execute_sql('INSERT INTO mail (datetime, "to", sender, body) VALUES (?, ?, ?, ?)',
+                   ('2021-01-02 01:00:00', mocked_data.to, mocked_data.sender, mocked_data.body))
+    db.close()
+    email = Email(database=str(tmp_path / 'old.sqlite'))
+    digests = [r['digest'] for r in email.get_db_records()]
+    assert len(set(digests)) == 4 and digests.count(None) == 1
+    email.writer.add(mocked_data._replace(datetime='2021-01-01 01:00:00', cc=None, body=None, subject='1'), 'Inbox')
+    assert email.writer.flush() == 1
+    assert {'mail_datetime', 'mail_folder_datetime'} <= {i.name for i in email.db.get_indexes('mail')}
+    assert email.db.pragma('user_version') == len(MIGRATIONS)
+    assert migrate_database(email.db) == len(MIGRATIONS)
+    assert email.db.execute_sql('SELECT typeof(body) FROM mail WHERE id = 4').fetchone() == ('blob',)
+    assert Mail.get_by_id(4).body == mocked_data.body
+    assert email.db_folder_counts == {None: 1, 'Inbox': 3}
+    assert Recipient.select().where(Recipient.role == 'from').count() == 4
+    email.filter_keyword = re.findall(r'\w{4,}', mocked_data.body)[0]
+    assert 4 in [r['id'] for r in email.apply_filter()]
+
+
+def test_compressed_body(mocked_email_db, mocked_data):
+    body = '<html>' + mocked_data.body * 50 + '</html>'
+    mocked_email_db.add_record(mocked_data._replace(body=body)._asdict())
+    stored, = mocked_email_db.db.execute_sql('SELECT body FROM mail').fetchone()
+    assert isinstance(stored, bytes) and len(stored) < len(body) / 5
+    assert mocked_email_db.get_db_records()[0]['body'] == body
+
+
+def test_vacuum_database(tmp_path, mocked_data):
+    email = Email(database=str(tmp_path / 'emails.sqlite'))
+    for n in range(20):
+        email.add_record(mocked_data._replace(subject=f'{n}', body=f'{n}'.join(map(str, range(5000))))._asdict())
+    Mail.delete().execute()
+    assert email.db.pragma('freelist_count') > 0
+    assert email.vacuum_database() > 0 and email.db.pragma('freelist_count') == 0
+
+
+def test_new_database_version(mocked_email_db):
+    assert mocked_email_db.db.pragma('user_version') == len(MIGRATIONS)
+
+
+def test_page_records(mocked_email_db, mocked_data):
+    for n in range(5):
+        mocked_email_db.add_record(dict(mocked_data._replace(datetime=datetime.datetime(2021, 1, 1 + n % 3),
+                                                             subject=f'mail {n}')._asdict(), folder=f'{n % 2}'))
+    pages = list(mocked_email_db.iter_pages(size=2))
+    assert [len(p) for p in pages] == [2, 2, 1]
+    records = [r for p in pages for r in p]
+    assert sorted(r['id'] for r in records) == [1, 2, 3, 4, 5]
+    assert [r['datetime'].day for r in records] == [3, 2, 2, 1, 1]
+    assert 'body' not in records[0]
+    mocked_email_db.filter_folder = '1'
+    mocked_email_db.apply_filter()
+    assert [r['id'] for r in mocked_email_db.page_records(filtered=True)] == [2, 4]
+
+
+def test_browse_records(mocker, mocked_email_db, mocked_data):
+    for n in range(3):
+        mocked_email_db.add_record(mocked_data._replace(datetime=datetime.datetime(2021, 1, 1 + n))._asdict())
+    mocker.patch('exchange.api.PAGE_SIZE', 2)
+    launch = mocker.patch('exchange.api.ScrollBar')
+    launch.return_value.launch.side_effect = ['Next page >>', '<< Previous page', '3 - 210103 00:00 - x']
+    assert mocked_email_db.select_records() == '3'
+    assert launch.call_args_list[1].kwargs['choices'][-1].startswith('1 - ')
+
+
+def test_records_to_files(tmp_path, mocked_email_db, mocked_data):
+    for body in ('first', 'second <html>'):
+        mocked_email_db.add_record(mocked_data._replace(datetime=datetime.datetime(2021, 1, 1), body=body)._asdict())
+    assert mocked_email_db.records_to_files(out=str(tmp_path), workers=2) == 2
+    files = sorted(tmp_path.iterdir())
+    assert [f.name.rsplit('__', 1)[-1] for f in files] == ['1.html', '2.html']
+    assert files[0].read_text().endswith('first') and files[1].read_text() == 'second <html>'
+    files[0].unlink()
+    assert mocked_email_db.records_to_files(out=str(tmp_path)) == 1
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+@pytest.mark.parametrize('export_format', ['mbox', 'maildir', 'tar.gz'])
+def test_records_to_archive(tmp_path, mocked_email_db, mocked_data, export_format):
+    for body in ('plain\ntext', '<html><body>html</body></html>'):
+        record = mocked_data._replace(datetime=datetime.datetime(2021, 1, 1), body=body, sender='Bob, Jr <bob@x.org>')
+        mocked_email_db.add_record(dict(record._asdict(), folder='Inbox'))
+    out = str(tmp_path / 'export')
+    assert mocked_email_db.records_to_files(out=out, export_format=export_format) == 2
+    if export_format == 'tar.gz':
+        with tarfile.open(out) as tar:
+            assert [m.name.rsplit('__', 1)[-1] for m in tar.getmembers()] == ['1.html', '2.html']
+        return
+    box = mailbox.mbox(out) if export_format == 'mbox' else mailbox.Maildir(out)
+    messages = sorted(box, key=lambda m: m.get_content_type())
+    assert [m.get_content_type() for m in messages] == ['text/html', 'text/plain']
+    assert messages[1]['X-Folder'] == 'Inbox' and 'bob@x.org' in messages[1]['From']
+
+
+@pytest.mark.parametrize('export_format', ['parquet', 'arrow'])
+def test_records_to_columnar(tmp_path, mocked_email_db, mocked_data, export_format):
+    pytest.importorskip('pyarrow')
+    import pyarrow.dataset as ds
+    for n, folder in enumerate(('Inbox', 'Inbox', 'Sent/Old', None)):
+        record = mocked_data._replace(datetime=datetime.datetime(2021, 1 + n // 2, 1, n), subject=f'mail {n}',
+                                      to='Al <al@x.org>,Bo <bo@x.org>', cc='None', body='é' * n)
+        mocked_email_db.add_record(dict(record._asdict(), folder=folder))
+    mocked_email_db.export_batch_rows = 3
+    out = tmp_path / f'mail.{export_format}'
+    assert mocked_email_db.records_to_files(out=str(out), export_format=export_format) == 4
+    table = ds.dataset(out, format='ipc' if export_format == 'arrow' else export_format).to_table()
+    assert table.column('id').to_pylist() == [1, 2, 3, 4]
+    assert table.column('to').to_pylist()[0] == ['al@x.org', 'bo@x.org'] and table.column('cc').to_pylist()[0] == []
+    assert table.column('body_size').to_pylist() == [0, 2, 4, 6]
+    assert table.column('datetime').to_pylist()[3] == datetime.datetime(2021, 2, 1, 3, tzinfo=datetime.timezone.utc)
+
+    mocked_email_db.export_partition = True
+    out = tmp_path / 'partitioned'
+    assert mocked_email_db.records_to_files(out=str(out), export_format=export_format) == 4
+    files = sorted(str(p.relative_to(out).parent) for p in out.rglob('part-0.*'))
+    assert files == ['folder=Inbox/month=2021-01', 'folder=Sent%2FOld/month=2021-02',
+                     'folder=__HIVE_DEFAULT_PARTITION__/month=2021-02']
+    dataset = ds.dataset(out, format='ipc' if export_format == 'arrow' else export_format, partitioning='hive')
+    table = dataset.to_table(filter=ds.field('month') == '2021-02')
+    assert sorted(zip(table.column('id').to_pylist(), table.column('folder').to_pylist())) == [(3, 'Sent/Old'), (4, None)]
+
+
+def test_show_record_cached(mocker, capsys, mocked_email_db, mocked_data):
+    body = '<html><body>' + ''.join(f'<div><p>line {n}</p></div>' for n in range(500)) + '</body></html>'
+    mocked_email_db.add_record(mocked_data._replace(body=body)._asdict())
+    convert = mocker.patch('exchange.render.md', side_effect=lambda h: h)
+    for _ in range(2):
+        mocked_email_db.show_record(1)
+    assert convert.call_count == 40
+    out, err = capsys.readouterr()
+    assert 'line 39' in out and 'line 40' not in out
+    assert mocked_email_db.render_cache.cache_info().hits == 1
+
+
+def test_db_stats(mocked_email_db, mocked_data):
+    assert mocked_email_db.db_count == 0
+    for n, folder in enumerate(('Inbox', 'Sent', 'Inbox', None)):
+        mocked_email_db.writer.add(mocked_data._replace(datetime=datetime.datetime(2021, 1, 1 + n)), folder)
+    mocked_email_db.writer.flush()
+    assert mocked_email_db.db_summary == (4, datetime.datetime(2021, 1, 1), datetime.datetime(2021, 1, 4))
+    assert mocked_email_db.db_folder_counts == {None: 1, 'Inbox': 2, 'Sent': 1}
+    Mail.delete().where(Mail.datetime == datetime.datetime(2021, 1, 3)).execute()
+    Mail.update(folder='Inbox').where(Mail.folder == 'Sent').execute()
+    assert mocked_email_db.db_folder_counts == {None: 1, 'Inbox': 2}
+    assert mocked_email_db.db_date_range == (datetime.datetime(2021, 1, 1), datetime.datetime(2021, 1, 4))
+    # no folder and folder '' are counted together, also when removed
+    mocked_email_db.writer.add(mocked_data._replace(datetime=datetime.datetime(2021, 1, 5)), '')
+    mocked_email_db.writer.flush()
+    Mail.delete().where(Mail.folder.is_null()).execute()
+    assert mocked_email_db.db_folder_counts == {None: 1, 'Inbox': 2}
+    assert mocked_email_db.db_date_range == (datetime.datetime(2021, 1, 1), datetime.datetime(2021, 1, 5))
+
+
+def test_apply_filter_cached(mocked_email_db, mocked_data):
+    mocked_email_db.add_record(mocked_data._asdict())
+    records = mocked_email_db.apply_filter()
+    assert mocked_email_db.apply_filter() is records and mocked_email_db.filter_count == 1
+    mocked_email_db.filter_keyword = 'nothing'
+    assert mocked_email_db.apply_filter() is not records and mocked_email_db.filter_count == 0
+    mocked_email_db.filter_keyword = None
+    mocked_email_db.add_record(mocked_data._replace(subject='other')._asdict())
+    mocked_email_db.apply_filter()
+    assert mocked_email_db.filter_count == 2
+
+
+def test_attachments(tmp_path, mocked_email_db, mocked_data):
+    report = FileAttachment(name='report.pdf', content_type='application/pdf', content=b'%PDF')
+    assert mocked_email_db.attachment_fetcher.pool is None
+    mocked_email_db.attachments = True
+    fields = mocked_data._fields + ('attachments',)
+    for n in range(2):
+        item = Mock(attachments=[report, Mock(), FileAttachment(name='report.pdf', content=f'{n}'.encode())])
+        files = mocked_email_db.attachment_fetcher.fetch(item)
+        mail = nt('f', fields)(*mocked_data._replace(subject=f'mail {n}'), files)
+        mocked_email_db.writer.add(mail, 'Inbox')
+    mocked_email_db.writer.flush()
+    assert Blob.select().count() == 3 and Attachment.select().count() == 4
+    mocked_email_db.attachment_fetcher.close()
+    assert mocked_email_db.attachment_fetcher.pool is None
+    assert mocked_email_db.get_attachments(2) == [('report.pdf', b'%PDF'), ('report.pdf', b'1')]
+    assert mocked_email_db.records_to_files(out=str(tmp_path)) == 2
+    folder = next(p for p in tmp_path.iterdir() if p.is_dir() and p.name.endswith('__2'))
+    assert sorted(f.name for f in folder.iterdir()) == ['report.pdf', 'report_2.pdf']
+
+
+def test_partitions(mocker, tmp_path, mocked_data):
+    email = Email(database=str(tmp_path / 'live.sqlite'))
+    report = FileAttachment(name='report.pdf', content=b'%PDF')
+    email.attachments = True
+    fields = mocked_data._fields + ('attachments',)
+    for n, (year, folder) in enumerate([(2019, 'Inbox'), (2019, 'Sent'), (2020, 'Inbox'), (2021, 'Inbox')]):
+        files = email.attachment_fetcher.fetch(Mock(attachments=[report]))
+        record = mocked_data._replace(datetime=datetime.datetime(year, 6, 1, n), sender=f'P{n} <p{n}@x.org>',
+                                      subject=f'mail {n}')
+        email.writer.add(nt('f', fields)(*record, files), folder)
+    email.writer.flush()
+    email.partition_before = '2021-01-01'
+    assert email.partition_mail() == 3
+    assert sorted(p.name for p in tmp_path.glob('year-*')) == ['year-2019.sqlite', 'year-2020.sqlite']
+    assert [(p.name, p.read_only, p.min_id, p.max_id) for p in email.partitions.catalog()] == [
+        ('2019', True, 1, 2), ('2020', True, 3, 3)]
+    assert Mail.select().count() == 1 and email.db_summary == (4, datetime.datetime(2019, 6, 1),
+                                                               datetime.datetime(2021, 6, 1, 3))
+    assert email.db_folder_counts == {'Inbox': 3, 'Sent': 1}
+
+    email.filter_range = '2020-01-01', '2021-12-31'
+    assert [p.name for p in email.partitions_of(filtered=True)] == ['2020']
+    assert [r['id'] for r in email.apply_filter()] == [4, 3] and email.filter_count == 2
+    email.filter_range, email.filter_keyword = (None, None), 'from:p1@x.org'
+    assert [r['subject'] for r in email.apply_filter()] == ['mail 1']
+    email.filter_keyword = 'mail'
+    records = list(email.apply_filter())
+    assert sorted(r['id'] for r in records) == [1, 2, 3, 4] and [r['rank'] for r in records] == sorted(r['rank'] for r in records)
+    email.filter_keyword = None
+    assert [r['id'] for r in email.page_records(size=3)] == [4, 3, 2]
+    assert [r['id'] for r in email.page_records(after=(datetime.datetime(2020, 6, 1, 2), 3))] == [2, 1]
+    assert email.get_attachments(2) == [('report.pdf', b'%PDF')]
+    render = mocker.patch.object(email, 'format_html', side_effect=lambda h: h)
+    email.show_record(2)
+    assert render.call_args.args == (mocked_data.body,)
+    assert email.records_to_files(out=str(tmp_path / 'out.mbox'), export_format='mbox') == 4
+    assert [m['Subject'] for m in mailbox.mbox(str(tmp_path / 'out.mbox'))] == [f'mail {n}' for n in range(4)]
+
+    # downloading again skips e-mails moved and keeps ids unique
+    email.writer.add(mocked_data._replace(datetime=datetime.datetime(2019, 6, 1, 0), sender='P0 <p0@x.org>',
+                                          subject='mail 0'), 'Inbox')
+    email.writer.add(mocked_data._replace(datetime=datetime.datetime(2021, 7, 1), subject='new'), 'Inbox')
+    assert email.writer.flush() == 1
+    assert [r['id'] for r in email.page_records(size=2)] == [5, 4]
+
+    # partitions marked read-only are never written again
+    frozen = (tmp_path / 'year-2019.sqlite').read_bytes()
+    email.writer.add(mocked_data._replace(datetime=datetime.datetime(2019, 7, 1), subject='late'), 'Inbox')
+    email.writer.flush()
+    assert email.partition_mail() == 0 and (tmp_path / 'year-2019.sqlite').read_bytes() == frozen
+    assert Mail.select().where(Mail.subject == 'late').count() == 1
+    Partition.create(name='2018', path='year-2018.sqlite', min_id=0, max_id=0)
+    scope_dedup_by_account(email.db)
+    assert (tmp_path / 'year-2019.sqlite').read_bytes() == frozen and not (tmp_path / 'year-2018.sqlite').exists()
+
+
+def test_serve(tmp_path):
+    email = Email(database=str(tmp_path / 'emails.sqlite'))
+    fill_database(email, 30, body_size=100)
+    email.db.pragma('journal_mode', 'wal')
+    newest_first = [r['id'] for r in email.page_records(size=30)]
+    archive = Archive(email.filename, email.fts, pool_size=2, cache_size=8)
+    server = Server(('127.0.0.1', 0), archive)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def get(path):
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}{path}') as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+    try:
+        status = get('/status')[1]
+        assert status['count'] == 30 and sum(f['count'] for f in status['folders']) == 30
+        page = get('/mails?limit=12')[1]
+        assert page['count'] == 30 and len(page['mails']) == 12 and set(page['mails'][0]) == {
+            'id', 'datetime', 'folder', 'subject', 'sender'}
+        ids = [r['id'] for r in page['mails']]
+        while page['next']:
+            page = get(f"/mails?limit=12&cursor={page['next']}")[1]
+            assert 'count' not in page
+            ids += [r['id'] for r in page['mails']]
+        assert ids == newest_first
+        assert get('/mails?folder=Sent&since=2000-01-01')[1]['count'] == email.db_folder_counts['Sent']
+        mail = get('/mails/3')[1]
+        assert mail['id'] == 3 and mail['body'] and mail['markdown'] and mail['attachments'] == []
+        records = get('/records?from_id=5&limit=10')[1]
+        assert [r['id'] for r in records['records']] == list(range(5, 15))
+        assert [r['id'] for r in get(f"/records?to_id=16&cursor={records['next']}")[1]['records']] == [15, 16]
+        assert get('/mails/999')[0] == 404 and get('/nothing')[0] == 404
+        assert get('/mails?limit=x')[0] == 400 and get('/mails?cursor=x')[0] == 400
+        assert get('/mails?since=yesterday')[0] == 400
+
+        hits = archive.cache.hits
+        assert get('/status')[1]['count'] == 30 and archive.cache.hits == hits + 1
+        # a download storing e-mails meanwhile
+        with sqlite3.connect(email.filename) as writer:
+            writer.execute("INSERT INTO mail (datetime, \"to\", sender, folder) VALUES ('2030-01-01 00:00:00', '', '', 'Inbox')")
+        assert get('/status')[1]['count'] == 31 and archive.cache.hits == hits + 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        archive.close()
+
+
+def test_purge_verify_partitions(tmp_path, mocked_data):
+    email = Email(database=str(tmp_path / 'live.sqlite'))
+    for n, year in enumerate((2019, 2021)):
+        record = mocked_data._replace(datetime=datetime.datetime(year, 1, 1), subject=f'{n}')
+        email.add_record(dict(record._asdict(), message_id=f'<{n}@x>'))
+    email.partition_before = '2020-01-01'
+    assert email.partition_mail() == 1
+    items = [('id0', 'ck', '<0@x>'), ('id1', 'ck', '<1@x>'), ('id2', 'ck', '<2@x>')]
+    assert Purger(Mock(), verify=True).archived(items) == items[1:2]
+    assert Purger(Mock(), verify=True, partitions=email.partitions).archived(items) == items[:2]
+
+
+def test_purge_verify_account(tmp_path, mocked_data):
+    path = str(tmp_path / 'shared.sqlite')
+    for account in ('a@x.org', 'b@x.org'):
+        email = Email(database=path, email=account)
+        email.writer.add(nt('f', mocked_data._fields + ('message_id',))(*mocked_data, f'<{account}>'), 'Inbox')
+        email.writer.flush()
+    Mail.insert(**mocked_data._asdict(), folder='Inbox', message_id='<legacy>').execute()
+    items = [('id0', 'ck', '<a@x.org>'), ('id1', 'ck', '<b@x.org>'), ('id2', 'ck', '<legacy>')]
+    assert Purger(Mock(), verify=True, email='a@x.org').archived(items) == [items[0], items[2]]
+
+
+def test_purge(mocked_email_db, mocked_data):
+    server = [(f'id{n}', 'ck', f'<{n}@x>') for n in range(25)]
+
+    class ServerQuery(FakeQuery):
+        def values_list(self, *fields):
+            return self
+
+        def __getitem__(self, s):
+            return server[s]
+
+    def bulk_delete(ids, chunk_size=None):
+        assert len(ids) <= 4
+        for id_, _ in ids:
+            server.remove(next(i for i in server if i[0] == id_))
+        return [True] * len(ids)
+
+    account = Mock(bulk_delete=Mock(side_effect=bulk_delete))
+    query = ServerQuery(server)
+    assert Purger(account, dry_run=True).purge('Inbox', query) == (25, 0)
+    for n in range(0, 25, 2):
+        mocked_email_db.add_record(dict(mocked_data._replace(subject=f'{n}')._asdict(), message_id=f'<{n}@x>'))
+    assert Purger(account, batch_size=4, workers=3, verify=True).purge('Inbox', query) == (25, 13)
+    assert [i[0] for i in server] == [f'id{n}' for n in range(1, 25, 2)]
+    assert Purger(account, batch_size=4).purge('Inbox', query) == (12, 12)
+    assert server == []
+
+
+def test_run_batch(mocker, tmp_path, mocked_data):
+    accounts = tmp_path / 'accounts.csv'
+    accounts.write_text('email,password,archive_folders\na@b.c,secret,\nbad@b.c,,\n,,\n')
+    assert read_accounts(str(accounts)) == [{'email': 'a@b.c', 'password': 'secret'}, {'email': 'bad@b.c'}]
+
+    def account(email, **kwargs):
+        if email == 'bad@b.c':
+            raise ValueError('wrong password')
+        items = [mocked_data._replace(datetime=f'2021-01-0{n} 01:00:00', subject=f'{n}') for n in (3, 2, 1)]
+        return Mock(inbox=mocked_folder(items), sent=mocked_folder([]))
+
+    def extract(fields, item):
+        if item.subject == '3':
+            raise AttributeError('sender')
+        return item
+
+    mocker.patch('exchange.ews.Credentials', return_value=MagicMock())
+    mocker.patch('exchange.ews.Configuration', return_value=MagicMock())
+    mocker.patch('exchange.ews.Account', side_effect=account)
+    mocker.patch('exchange.api.Email.extract_email_items', side_effect=extract)
+    mocker.patch('exchange.batch.ProcessPoolExecutor', ThreadPoolExecutor)
+    # failures of earlier runs are not counted
+    Email(database=str(tmp_path / 'a@b.c.sqlite'))
+    FailedItem.create(account='a@b.c', folder='Inbox', item_id='old', error='', failed=datetime.datetime(2020, 1, 1))
+    results = run_batch(read_accounts(str(accounts)), 1, database=str(tmp_path / '{email}.sqlite'))
+    assert [(r['email'], r['stored'], r['failed'], bool(r['error'])) for r in results] == [
+        ('a@b.c', 2, 1, False), ('bad@b.c', 0, 0, True)]
+    assert results[0]['database'] == str(tmp_path / 'a@b.c.sqlite')
+    assert Email(database=results[0]['database']).db_count == 2
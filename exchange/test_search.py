@@ -0,0 +1,15 @@
+from exchange.search import html_to_text, fts_query
+
+
+def test_html_to_text():
+    html = '<html><head><style>p {color: red}</style></head><body><p>Hello</p><p>world</p></body></html>'
+    assert html_to_text(html) == 'Hello world'
+    assert html_to_text('plain  text\nbody') == 'plain text body'
+    assert html_to_text(None) == ''
+
+
+def test_fts_query():
+    assert fts_query('budget') == '"budget"'
+    assert fts_query('"annual budget" rev*') == '"annual budget" "rev"*'
+    assert fts_query('bob@example.com') == '"bob example com"'
+    assert fts_query('--') == ''
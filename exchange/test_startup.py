@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ('exchangelib', 'requests', 'lxml', 'markdownify', 'bs4', 'loguru', 'rich', 'bullet', 'peewee')
+
+
+def imported_after(code: str, tmp_path) -> set:
+    """Return heavy top-level packages imported by running code in a fresh interpreter"""
+    script = f'{code}\nimport sys\nprint(" ".join(sorted({{m.split(".")[0] for m in sys.modules}})))'
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, cwd=tmp_path,
+                         env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))).stdout
+    return set(out.splitlines()[-1].split()) & set(HEAVY)
+
+
+def test_help_imports_nothing_heavy(tmp_path):
+    code = ('import sys\nfrom mail_export.__main__ import get_args\nsys.argv = ["mail_export", "--help"]\n'
+            'try:\n    get_args()\nexcept SystemExit:\n    pass')
+    assert imported_after(code, tmp_path) == set()
+
+
+@pytest.mark.parametrize('action', ['print_db_status()', 'records_to_files("out")', 'records_to_files("out.mbox", export_format="mbox")'])
+def test_status_and_export_skip_ews_and_html(tmp_path, action):
+    code = f'from exchange import Email\nEmail(database="emails.sqlite").{action}'
+    assert not imported_after(code, tmp_path) & {'exchangelib', 'requests', 'lxml', 'markdownify', 'bs4'}
+
+
+def test_render_loads_html_stack(tmp_path):
+    code = 'from exchange import Email\nEmail(database=":memory:").format_html("<p>hi</p>")'
+    assert {'lxml', 'markdownify'} <= imported_after(code, tmp_path)
@@ -0,0 +1,279 @@
+"""Buffered storage of downloaded e-mails"""
+import datetime
+import hashlib
+import time
+from typing import NamedTuple
+
+from peewee import chunked, fn
+
+from richlog import log
+from .addresses import store_recipients
+from .attachments import blob_key
+from .metrics import Metrics
+from .models import (
+    SQLITE_MAX_VARIABLES,
+    Attachment,
+    Blob,
+    Checkpoint,
+    FailedItem,
+    Mail,
+)
+from .search import index_records
+
+DIGEST_FIELDS = ("datetime", "sender", "to", "cc", "subject", "body")
+# fields of records not stored in the mail table
+UNSTORED = ("attachments", "display_cc")
+
+
+class MailWriter:
+    """Collects e-mails and stores them in batches within a single transaction
+
+    :param db: Database to store to
+    :param batch_size: Number of e-mails to collect before storing
+    :param flush_interval: Maximum seconds to hold e-mails before storing
+    :param index: Also add stored e-mails to the full-text index
+    :param account: Account checkpoints and failed e-mails are recorded for
+    :param metrics: Metrics timing the duplicate check and inserts
+    :param partitions: Partitions e-mails were moved to, also checked for
+        duplicates
+    """
+
+    def __init__(
+        self,
+        db,
+        batch_size=100,
+        flush_interval=5.0,
+        index=True,
+        account=None,
+        metrics=None,
+        partitions=None,
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.index = index
+        self.account = account or ""
+        self.metrics = metrics or Metrics(interval=0)
+        self.partitions = partitions
+        self.pending = []
+        self.checkpoints = {}
+        self.failures = []
+        self.stored = 0
+        self.duplicates = 0
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    @staticmethod
+    def key(record: dict) -> str:
+        """Duplicate detection key of a record, a digest of its content and
+        account
+
+        Records without account, e.g. stored before accounts were recorded,
+        are digested by their content only. Cc is digested as display_cc if
+        given, the way older downloads stored it.
+        """
+        values = dict(record, cc=record.get("display_cc", record["cc"]))
+        content = "\x1f".join(str(values[f] or "") for f in DIGEST_FIELDS)
+        if record.get("account"):
+            content = f"{record['account']}\x1f{content}"
+        return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+    @property
+    def own(self):
+        """Expression matching e-mails of the account"""
+        return Mail.account == self.account if self.account else Mail.account.is_null()
+
+    @staticmethod
+    def stored_values(db, field, values, criteria) -> set:
+        """Return those values of field stored in e-mails matching criteria"""
+        found = set()
+        for batch in chunked(list(values), SQLITE_MAX_VARIABLES):
+            query = Mail.select(field).where(field.in_(batch) & criteria).tuples()
+            found.update(value for value, in query.execute(db))
+        return found
+
+    def add(self, mail_fields: NamedTuple, folder: str) -> int:
+        """Add e-mail to be stored, flushing if the batch is due
+
+        :param mail_fields: Fields extracted from e-mail
+        :param folder: Folder the e-mail belongs to
+        :return: Number of duplicates found if flushed
+        """
+        record = dict(**mail_fields._asdict(), folder=folder)
+        record.setdefault("message_id", None)
+        record.setdefault("account", self.account or None)
+        record["digest"] = self.key(record)
+        self.pending.append(record)
+        self.metrics.count("downloaded")
+        self.metrics.report()
+        if (
+            len(self.pending) >= self.batch_size
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            return self.flush()
+        return 0
+
+    def checkpoint(self, folder: str, **fields) -> None:
+        """Record download progress of folder along with the pending e-mails
+
+        The checkpoint is stored within the same transaction as the e-mails
+        added before, so it never points past e-mails lost in a crash.
+
+        :param folder: Folder being downloaded
+        :param fields: since, until and started of the Checkpoint
+        """
+        self.checkpoints[folder] = dict(
+            fields, account=self.account, folder=folder, updated=datetime.datetime.now()
+        )
+
+    def fail(self, folder: str, item_id, changekey, error: str) -> None:
+        """Record e-mail which failed to download, to be retried later
+
+        :param folder: Folder the e-mail belongs to
+        :param item_id: Exchange id of the e-mail if known
+        :param changekey: Exchange change key of the e-mail
+        :param error: Description of the error
+        """
+        self.failures.append(
+            dict(
+                account=self.account,
+                folder=folder,
+                item_id=item_id,
+                changekey=changekey,
+                error=error,
+                failed=datetime.datetime.now(),
+            )
+        )
+
+    def existing_keys(self, records: list) -> set:
+        """Return digests and message ids already stored using indexed lookups,
+        also in partitions holding e-mails received at the same time"""
+
+        def lookup(db):
+            keys = set()
+            for field in (Mail.digest, Mail.message_id):
+                values = {r[field.name] for r in records if r[field.name]}
+                keys.update(self.stored_values(db, field, values, self.own))
+            if self.account:
+                # e-mails stored before accounts were recorded, as the account's
+                unowned = Mail.account.is_null()
+                legacy = {self.key(dict(r, account=None)): r["digest"] for r in records}
+                found = self.stored_values(db, Mail.digest, legacy, unowned)
+                keys.update(legacy[digest] for digest in found)
+                ids = {r["message_id"] for r in records if r["message_id"]}
+                keys.update(self.stored_values(db, Mail.message_id, ids, unowned))
+            return keys
+
+        if not (self.partitions and records):
+            return lookup(self.db)
+        received = [r["datetime"] for r in records]
+        partitions = self.partitions.select(since=min(received), until=max(received))
+        return set().union(*self.partitions.fan_out(lookup, partitions))
+
+    @staticmethod
+    def is_duplicate(record: dict, seen: set) -> bool:
+        """Whether digest or message id of record is among those seen"""
+        return record["digest"] in seen or record["message_id"] in seen
+
+    def flush(self) -> int:
+        """Store pending e-mails not already in database
+
+        :return: Number of duplicates skipped
+        """
+        pending, self.pending = self.pending, []
+        checkpoints, self.checkpoints = self.checkpoints, {}
+        failures, self.failures = self.failures, []
+        self.last_flush = time.monotonic()
+        if not (pending or checkpoints or failures):
+            return 0
+        # flush includes the commit, insert covers storing all but the commit.
+        # The write lock is taken before reading, a read lock could not be
+        # upgraded while another process writes to a shared database
+        with self.metrics.time("flush"), self.db.atomic("IMMEDIATE"):
+            with self.metrics.time("dedup"):
+                seen = self.existing_keys(pending)
+                new = []
+                for r in pending:
+                    if not self.is_duplicate(r, seen):
+                        seen.update(k for k in (r["digest"], r["message_id"]) if k)
+                        new.append(r)
+            with self.metrics.time("insert"):
+                self.insert(new, checkpoints, failures)
+        duplicates = len(pending) - len(new)
+        self.stored += len(new)
+        self.duplicates += duplicates
+        self.metrics.count("stored", len(new))
+        self.metrics.count("duplicates", duplicates)
+        log.debug(f"stored {len(new)} e-mails, skipped {duplicates} duplicates")
+        return duplicates
+
+    def insert(self, new: list, checkpoints: dict, failures: list) -> None:
+        """Insert new e-mails along with checkpoints and failed e-mails"""
+        rows = [{k: v for k, v in r.items() if k not in UNSTORED} for r in new]
+        if self.partitions and rows:
+            # ids of e-mails moved to partitions are not to be used again
+            last_id = Mail.select(fn.MAX(Mail.id)).scalar() or 0
+            start = max(last_id, self.partitions.max_id()) + 1
+            rows = [dict(r, id=start + n) for n, r in enumerate(rows)]
+        rows_per_insert = SQLITE_MAX_VARIABLES // len(Mail._meta.columns)
+        for batch in chunked(rows, rows_per_insert):
+            Mail.insert_many(batch).on_conflict_ignore().execute()
+        if new:
+            ids = self.ids_by_digest(rows)
+            inserted = [dict(r, id=ids[r["digest"]]) for r in rows if r["digest"] in ids]
+            if self.index:
+                index_records(inserted)
+            store_recipients(inserted)
+            self.store_attachments(new, ids)
+        for checkpoint in checkpoints.values():
+            Checkpoint.replace(**checkpoint).execute()
+        for batch in chunked(failures, SQLITE_MAX_VARIABLES // 7):
+            FailedItem.insert_many(batch).on_conflict_replace().execute()
+
+    def ids_by_digest(self, records: list) -> dict:
+        """Return ids of inserted records by their digest"""
+        ids = {}
+        for batch in chunked([r["digest"] for r in records], SQLITE_MAX_VARIABLES):
+            query = Mail.select(Mail.id, Mail.digest).where(
+                Mail.digest.in_(batch) & self.own
+            )
+            ids.update({r.digest: r.id for r in query})
+        return ids
+
+    @staticmethod
+    def store_attachments(records: list, ids: dict) -> None:
+        """Store attachments of inserted records, each content only once
+
+        :param records: Records including attachments as (name, type, content)
+        :param ids: Ids of records by digest
+        """
+        blobs, links = {}, []
+        for r in records:
+            for name, content_type, content in r.get("attachments") or ():
+                if r["digest"] not in ids:
+                    continue
+                key = blob_key(content)
+                blobs[key] = content
+                links.append(
+                    {
+                        "mail": ids[r["digest"]],
+                        "name": name,
+                        "content_type": content_type,
+                        "blob": key,
+                    }
+                )
+        stored = {
+            b.digest
+            for batch in chunked(list(blobs), SQLITE_MAX_VARIABLES)
+            for b in Blob.select(Blob.digest).where(Blob.digest.in_(batch))
+        }
+        for key, content in blobs.items():
+            if key not in stored:
+                Blob.insert(digest=key, size=len(content), content=content).execute()
+        for batch in chunked(links, SQLITE_MAX_VARIABLES // 4):
+            Attachment.insert_many(batch).execute()
@@ -1,17 +1,11 @@
 import os
 import sys
 
-from rich.traceback import install
-from rich.console import Console
-from exchange import Email
+from exchange.export import EXPORT_FORMATS
 import argparse
-from loguru import logger
-from bullet import Bullet, Input, Password, SlidePrompt, ScrollBar
-from collections import namedtuple
 
-install()  # install rich print
-
-dt = namedtuple("dt", "text pattern")("YYYY-MM-DD", "(\d{4}-\d{2}-\d{2})|^$")
+# modules with heavy dependencies (exchangelib, lxml, rich, bullet) are
+# imported once arguments are parsed and only by the paths using them
 
 
 def get_args() -> argparse.Namespace:
@@ -22,6 +16,12 @@ def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Application for creating a local copy of your exchange mail account"
     )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=("serve",),
+        help="(Optional) serve: answer read-only JSON queries of the database over HTTP",
+    )
     parser.add_argument(
         "--database",
         type=str,
@@ -53,6 +53,185 @@ def get_args() -> argparse.Namespace:
         type=int,
         help="(Optional) Instead of download mail, remove it if older than X days",
     )
+    parser.add_argument(
+        "--purge_batch_size",
+        type=int,
+        default=100,
+        help="(Optional) Number of e-mails removed per request when purging",
+    )
+    parser.add_argument(
+        "--purge_workers",
+        type=int,
+        default=2,
+        help="(Optional) Number of concurrent remove requests when purging",
+    )
+    parser.add_argument(
+        "--purge_dry_run",
+        action="store_true",
+        help="(Optional) Only count the e-mails that would be purged",
+    )
+    parser.add_argument(
+        "--purge_verify",
+        action="store_true",
+        help="(Optional) Only purge e-mails stored in the database (by Message-ID)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=100,
+        help="(Optional) Number of e-mails stored per database transaction",
+    )
+    parser.add_argument(
+        "--flush_interval",
+        type=float,
+        default=5.0,
+        help="(Optional) Maximum seconds to hold downloaded e-mails before storing",
+    )
+    parser.add_argument(
+        "--wal",
+        action="store_true",
+        help="(Optional) Use SQLite WAL journal with relaxed syncing while downloading",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="(Optional) Number of folders, or parts of folders, downloaded in parallel",
+    )
+    parser.add_argument(
+        "--split_size",
+        type=int,
+        default=500,
+        help="(Optional) Number of e-mails per parallel download task within a folder",
+    )
+    parser.add_argument(
+        "--page_size",
+        type=int,
+        default=100,
+        help="(Optional) Number of e-mails requested from Exchange per round trip",
+    )
+    parser.add_argument(
+        "--full_resync",
+        action="store_true",
+        help="(Optional) Walk all e-mails of each folder instead of only those since last download",
+    )
+    parser.add_argument(
+        "--max_wait",
+        type=int,
+        default=3600,
+        help="(Optional) Maximum seconds to keep retrying a throttled or unavailable server",
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="(Optional) Download again e-mails which failed to download before and exit",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        default=10.0,
+        help="(Optional) Seconds between summary lines of download rate and stage latencies",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        help="(Optional) Write download metrics to this file, a Prometheus textfile if it ends with .prom, JSON otherwise",
+    )
+    parser.add_argument(
+        "--attachments",
+        action="store_true",
+        help="(Optional) Download attachments and export them next to html files",
+    )
+    parser.add_argument(
+        "--attachment_workers",
+        type=int,
+        default=4,
+        help="(Optional) Number of attachments downloaded in parallel",
+    )
+    parser.add_argument(
+        "--export",
+        type=str,
+        help="(Optional) Export all stored e-mails to this path and exit",
+    )
+    parser.add_argument(
+        "--export_format",
+        choices=EXPORT_FORMATS,
+        default="html",
+        help="(Optional) Export as html files, mbox, Maildir or compressed tarball, "
+        "or metadata only as Parquet or Arrow (requires pyarrow)",
+    )
+    parser.add_argument(
+        "--export_batch_rows",
+        type=int,
+        default=10000,
+        help="(Optional) Number of e-mails per batch written to Parquet or Arrow",
+    )
+    parser.add_argument(
+        "--export_partition",
+        action="store_true",
+        help="(Optional) Write Parquet or Arrow files by folder and month below the export path",
+    )
+    parser.add_argument(
+        "--accounts",
+        type=str,
+        help="(Optional) CSV file of accounts to download in parallel processes and exit, "
+        "columns: email, password, server_name, username, archive_folders, database",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=2,
+        help="(Optional) Number of accounts downloaded at the same time with --accounts",
+    )
+    parser.add_argument(
+        "--partition",
+        choices=("year", "folder"),
+        help="(Optional) Move e-mails received before --partition_before into one "
+        "database per year or folder next to the database and exit",
+    )
+    parser.add_argument(
+        "--partition_before",
+        type=str,
+        help="(Optional) Date (YYYY-MM-DD) up to which e-mails are moved by --partition, "
+        "default the start of this year",
+    )
+    parser.add_argument(
+        "--partition_workers",
+        type=int,
+        default=4,
+        help="(Optional) Number of partitions queried in parallel",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="(Optional) Interface serve listens on, only this machine by default",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8025, help="(Optional) Port serve listens on"
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        default=8,
+        help="(Optional) Number of read-only database connections of serve",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=256,
+        help="(Optional) Number of responses serve keeps for repeated queries",
+    )
+    parser.add_argument(
+        "--rebuild_index",
+        action="store_true",
+        help="Build the keyword search index for an existing database and exit",
+    )
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="Reclaim space of removed or compressed e-mails in the database file and exit",
+    )
     args = parser.parse_args()
     if args.download_now and args.purge_mail_older_than:
         print(
@@ -65,121 +244,56 @@ def get_args() -> argparse.Namespace:
     return args
 
 
-def bitem(bullet_item) -> str:
-    """Helper function for selecting email.
-
-    :param bullet_item:
-    :return:
-    """
-    return next(iter(bullet_item.split(" - ")))
-
-
-class Menu:
-    def __init__(self, args, email: Email):
-        self.args = args
-        self.email = email
-
-    def info(self) -> None:
-        """Display info in menu"""
-        self.email.print_db_status()
-
-    def main(self) -> None:
-        """Main menu"""
-        while True:
-            Console().clear()
-            self.email.apply_filter()
-            self.info()
-            items = {
-                "Exit": exit,
-                "E-mail settings": self.get_mail_creds,
-                "Update date range filter": self.get_range,
-                "Update folder to filter": self.get_folder,
-                "Update keyword filter": self.get_search_word,
-                "Reset filters": self.reset_filters,
-                "Show filtered e-mails": self.display_filtered_email,
-                "Save filtered e-mails to folder": self.save_filtered_emails,
-            }
-            if all([self.email.email, self.email.password]):
-                items["Download from account"] = self.email.process_mail
-            cli = Bullet(prompt="Choose:", choices=list(items.keys())).launch()
-            items.get(cli)()
-
-    def get_mail_creds(self) -> list:
-        """Return credentials.
-
-        :return: List with username and password
-        """
-        cli = SlidePrompt([Input("E-mail address: "), Password("Password: ")]).launch()
-        v = dict(cli).values()
-        self.email.email, self.email.password = v
-        return cli
-
-    def get_range(self) -> None:
-        """Get and set date range filter."""
-
-        cli = SlidePrompt(
-            [
-                Input(prompt=f"From date [{dt.text}]: ", pattern=dt.pattern),
-                Input(prompt=f"To date [{dt.text}]: ", pattern=dt.pattern),
-            ]
-        ).launch()
-        self.email.filter_range = [_[-1] for _ in cli]
-
-    def get_folder(self) -> None:
-        """Get folder to filter"""
-
-        current_folders = self.email.db_get_folders
-        cli = ScrollBar(
-            prompt="Which folder would you like to filter?",
-            choices=current_folders,
-            height=10,
-        ).launch()
-        self.email.filter_folder = cli
-
-    def get_search_word(self) -> None:
-        """Get and set search for to filter."""
-
-        words = input("What filter words to use: ")
-        self.email.filter_keyword = words
-
-    def reset_filters(self) -> None:
-        """Reset filters."""
-
-        self.email.filter_keyword = None
-        self.email.filter_range = None, None
-        self.email.filter_folder = None
-
-    def display_filtered_email(self) -> None:
-        """Display those filtered emails."""
-
-        while True:
-            record = self.email.select_records(filtered=True)
-            if record is None:
-                break
-            self.email.show_record(record)
-
-    def save_filtered_emails(self) -> None:
-        """Save filtered emails as files."""
-
-        self.email.print_db_records_table(filtered=True)
-        folder = input(f"Export folder: ")
-        self.email.records_to_files(out=folder, filtered=True)
-
-
 def init_log() -> None:
     """Initialize logging"""
+    from loguru import logger
+
     logger.remove()
     logger.add("app.log", rotation="100 MB")
     logger.level("DEBUG")
 
 
 def main():
-    init_log()
     args = get_args()
+    from rich.traceback import install
+
+    install()  # install rich print
+    init_log()
+    accounts, processes = args.__dict__.pop("accounts"), args.__dict__.pop("processes")
+    command = args.__dict__.pop("command")
+    server = {
+        k: args.__dict__.pop(k) for k in ("host", "port", "pool_size", "cache_size")
+    }
+    if accounts:
+        from exchange.batch import read_accounts, run_batch
+
+        results = run_batch(read_accounts(accounts), processes, **args.__dict__)
+        exit(1 if any(r["error"] for r in results) else 0)
+    from exchange import Email
+
     email = Email(**args.__dict__)
-    if args.download_now or args.purge_mail_older_than:
+    if command == "serve":
+        from exchange.serve import serve
+
+        serve(email, **server)
+        exit(0)
+    if args.rebuild_index:
+        email.rebuild_search_index()
+        exit(0)
+    if args.vacuum:
+        email.vacuum_database()
+        exit(0)
+    if args.partition:
+        email.partition_mail()
+        exit(0)
+    if args.export:
+        email.records_to_files(args.export, export_format=args.export_format)
+        exit(0)
+    if args.download_now or args.purge_mail_older_than or args.retry_failed:
         email.process_mail()
         exit(0)
+    from mail_export.menu import Menu
+
     menu = Menu(args, email)
     menu.main()
 
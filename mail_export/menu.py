@@ -0,0 +1,185 @@
+"""Interactive menu to browse, filter and export stored e-mails"""
+from bullet import Bullet, Input, Password, SlidePrompt, ScrollBar
+from collections import namedtuple
+from functools import partial
+from typing import Callable
+from rich.console import Console
+from rich.live import Live
+
+from exchange.api import Email
+from exchange.export import EXPORT_FORMATS
+from exchange.jobs import Job
+
+dt = namedtuple("dt", "text pattern")("YYYY-MM-DD", "(\d{4}-\d{2}-\d{2})|^$")
+
+
+def bitem(bullet_item) -> str:
+    """Helper function for selecting email.
+
+    :param bullet_item:
+    :return:
+    """
+    return next(iter(bullet_item.split(" - ")))
+
+
+class Menu:
+    def __init__(self, args, email: Email):
+        self.args = args
+        self.email = email
+        self.job = None
+
+    @property
+    def busy(self) -> bool:
+        """Whether a download or export is running in the background"""
+        return self.job is not None and self.job.running
+
+    def start_job(self, name: str, func: Callable) -> None:
+        """Run func in the background, one job at a time
+
+        :param name: Name of the job shown in the menu
+        :param func: Function to run
+        """
+        if self.busy:
+            input(f"{self.job.name} is still running, press enter to continue")
+            return
+        # assigned before starting, the job reports its progress through email
+        self.email.job = self.job = Job(name, func)
+        self.job.start()
+
+    def info(self) -> None:
+        """Display info in menu"""
+        self.email.print_db_status()
+        if self.job is not None:
+            Console().print(f"[bold]Job:[/bold] {self.job.status()}")
+
+    def watch_job(self) -> None:
+        """Show progress of the running job until it ends or Ctrl+C"""
+        try:
+            with Live(self.job.status(), refresh_per_second=4) as live:
+                while not self.job.wait(0.25):
+                    live.update(self.job.status())
+                live.update(self.job.status())
+        except KeyboardInterrupt:
+            return
+        input("Press enter to continue")
+
+    def cancel_job(self) -> None:
+        """Cancel the running job, waiting for what it downloaded to be stored"""
+        self.job.cancel()
+        with Console().status(f"Cancelling {self.job.name}..."):
+            self.job.wait()
+
+    def exit(self) -> None:
+        """Exit, cancelling the running job"""
+        if self.busy:
+            self.cancel_job()
+        exit()
+
+    def main(self) -> None:
+        """Main menu"""
+        while True:
+            Console().clear()
+            # the stored e-mails keep changing while downloading
+            self.email.apply_filter(refresh=not self.busy)
+            self.info()
+            items = {
+                "Exit": self.exit,
+                "E-mail settings": self.get_mail_creds,
+                "Update date range filter": self.get_range,
+                "Update folder to filter": self.get_folder,
+                "Update keyword filter": self.get_search_word,
+                "Reset filters": self.reset_filters,
+                "Show filtered e-mails": self.display_filtered_email,
+                "Save filtered e-mails to folder": self.save_filtered_emails,
+                "Top correspondents": self.show_top_correspondents,
+            }
+            if all([self.email.email, self.email.password]):
+                items["Download from account"] = partial(
+                    self.start_job, "Download", self.email.process_mail
+                )
+            if self.busy:
+                items["Refresh"] = lambda: None
+                items["Watch running job"] = self.watch_job
+                items["Cancel running job"] = self.cancel_job
+            cli = Bullet(prompt="Choose:", choices=list(items.keys())).launch()
+            items.get(cli)()
+
+    def get_mail_creds(self) -> list:
+        """Return credentials.
+
+        :return: List with username and password
+        """
+        cli = SlidePrompt([Input("E-mail address: "), Password("Password: ")]).launch()
+        v = dict(cli).values()
+        self.email.email, self.email.password = v
+        return cli
+
+    def get_range(self) -> None:
+        """Get and set date range filter."""
+
+        cli = SlidePrompt(
+            [
+                Input(prompt=f"From date [{dt.text}]: ", pattern=dt.pattern),
+                Input(prompt=f"To date [{dt.text}]: ", pattern=dt.pattern),
+            ]
+        ).launch()
+        self.email.filter_range = [_[-1] for _ in cli]
+
+    def get_folder(self) -> None:
+        """Get folder to filter"""
+
+        current_folders = self.email.db_get_folders
+        cli = ScrollBar(
+            prompt="Which folder would you like to filter?",
+            choices=current_folders,
+            height=10,
+        ).launch()
+        self.email.filter_folder = cli
+
+    def get_search_word(self) -> None:
+        """Get and set search for to filter."""
+
+        words = input(
+            'What filter words to use ("exact phrase", prefix*, from:/to:/cc:addr): '
+        )
+        self.email.filter_keyword = words
+
+    def reset_filters(self) -> None:
+        """Reset filters."""
+
+        self.email.filter_keyword = None
+        self.email.filter_range = None, None
+        self.email.filter_folder = None
+
+    def display_filtered_email(self) -> None:
+        """Display those filtered emails."""
+
+        while True:
+            record = self.email.select_records(filtered=True)
+            if record is None:
+                break
+            self.email.show_record(record)
+
+    def show_top_correspondents(self) -> None:
+        """Show addresses with most e-mails."""
+
+        self.email.print_top_correspondents()
+        input("Press enter to continue")
+
+    def save_filtered_emails(self) -> None:
+        """Save filtered emails as files."""
+
+        self.email.print_db_records_table(filtered=True)
+        export_format = Bullet(
+            prompt="Export format:", choices=list(EXPORT_FORMATS)
+        ).launch()
+        folder = input(f"Export folder or file: ")
+        self.start_job(
+            "Export",
+            partial(
+                self.email.records_to_files,
+                out=folder,
+                filtered=True,
+                export_format=export_format,
+            ),
+        )
@@ -1,8 +1,22 @@
 """Log using rich"""
 import logging
-from rich.logging import RichHandler
+
+
+class RichHandler(logging.Handler):
+    """Hands records to rich's handler, importing rich only once logging"""
+
+    handler = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.handler is None:
+            from rich.logging import RichHandler
+
+            self.handler = RichHandler()
+            self.handler.setFormatter(self.formatter)
+        self.handler.emit(record)
+
 
 logging.basicConfig(
     level="INFO", format="%(message)s", datefmt="[%X]", handlers=[RichHandler()]
 )
-log = logging.getLogger(__name__)
\ No newline at end of file
+log = logging.getLogger(__name__)